@@ -1,52 +1,36 @@
-from pathlib import Path
-import pdb
-from astropy.table import Table
-import numpy as np
-import datetime
-import glob
+'''
+Catalog-only version of adjust_products.py: demotes trails at bad angles
+without remaking the masks. Kept for existing scripts; it takes the same
+arguments as adjust_products.py (the glob and theta ranges default to
+catalog_glob and bad_theta_ranges in config.yaml), e.g.
 
-#(0,3),(87,94),(176,180)
+    python adjust_catalogs.py 'path/to/satellites/*mrt_catalog.fits' --dry-run
+'''
 
-def adjust_catalog(catalog, bad_theta_ranges = [(0,3),(87,94),(176,180)], logfile='catalog_adjustments.txt'):
+import sys
 
-    # set up the log
-    catalog = Path(catalog)
-    dir = catalog.parent
-    logfile = Path.joinpath(dir, logfile)
-    log = open(logfile,'a')
+import adjust_products
+from adjust_products import default_bad_theta_ranges
 
-    now = datetime.datetime.now()
 
-    # note the starting time and the file being adjusted
-    #log.write('\n Started at '+now.strftime("%m/%d/%Y, %H:%M:%S")+ '\n')  
-    #log.write(str(catalog) + '\n') 
+def adjust_catalog(catalog, bad_theta_ranges=default_bad_theta_ranges,
+                   logfile='catalog_adjustments.txt'):
+    '''Demotes the trails of one catalog at bad angles (see
+    adjust_products.adjust_catalog); the masks are left as they are'''
 
-    # load the catalog
-    tbl = Table.read(catalog)
+    adjust_products.adjust_catalog(catalog, bad_theta_ranges=bad_theta_ranges,
+                                   logfile=logfile, remake_masks=False)
 
-    # see if it has any length
-    if len(tbl) == 0:
-        return
-    
-    # if has length, check the conditions
-    conditions = [np.logical_and(tbl['theta'] > b[0], tbl['theta'] < b[1]) for b in bad_theta_ranges]
 
+def adjust_catalogs(catalogs, bad_theta_ranges=default_bad_theta_ranges,
+                    logfile='catalog_adjustments.txt', dry_run=False, workers=1):
+    '''Many catalogs at once (see adjust_products.adjust_catalogs); the
+    masks are left as they are'''
 
-    # adust status to 1 for cases that need adjusting
-    sel=np.any(conditions, axis=0) & (tbl['status'] == 2)
-    tbl['status'][sel] = 1
+    return adjust_products.adjust_catalogs(catalogs, bad_theta_ranges=bad_theta_ranges,
+                                           logfile=logfile, remake_masks=False,
+                                           dry_run=dry_run, workers=workers)
 
-    subtbl = tbl[sel]
-    sep = '    '
-    if len(subtbl) > 0:
-        log.write(str(catalog) + '\n') 
-        for row in subtbl:
-            log.write(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S") + sep + str(row['id']) + sep + 'status' + sep + '2' + sep + '1\n')
 
-    tbl.write(catalog, overwrite=True)
-    log.close()
-
-
-catalogs = glob.glob('/ifs/cs/astro/koekemoer/SUPERCAL/data-fields/GOODSS/satmask_acs_wfc_flcfiles/09500/satellites/*mrt_catalog.fits')
-for catalog in catalogs:
-    adjust_catalog(catalog)
\ No newline at end of file
+if __name__ == '__main__':
+    adjust_products.main(sys.argv[1:] + ['--no-masks'])
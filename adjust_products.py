@@ -1,22 +1,168 @@
+'''
+Batch adjustment of findsat_mrt catalogs (and their masks).
+
+Right now the only adjustment is demoting (status 2 -> 1) trails whose
+angle falls in one of the bad theta ranges, but more could be added later.
+All catalogs matching a glob are read into one stacked table and the rules
+are evaluated on it in a single pass; only the catalogs with trails to
+demote are then rewritten (and their masks remade), spread over a process
+pool.
+
+Usage:
+
+    python adjust_products.py 'path/to/satellites/*mrt_catalog.fits' --dry-run
+    python adjust_products.py 'path/to/satellites/*mrt_catalog.fits' --workers 8
+    python adjust_products.py --theta-ranges 0,3 87,94 176,180 ...
+
+The glob and theta ranges default to catalog_glob and bad_theta_ranges in
+config.yaml.
+'''
+
 from pathlib import Path
 import pdb
 import numpy as np
 import datetime
 import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import yaml
 from astropy.table import Table
 from astropy.io import fits
 from acstools import utils_findsat_mrt as u
+from trail_masks import IncrementalMask
+import products
+from mask_storage import (mask_shape, read_segment, write_segment, write_mask,
+                          formats, default_format)
+
+default_bad_theta_ranges = [(0,3),(87,94),(176,180)]
 
 
+def demotion_mask(theta, status, bad_theta_ranges=default_bad_theta_ranges):
+    '''
+    Which trails to demote: status 2 trails with theta inside any of the
+    bad ranges (exclusive). Evaluated for all trails at once.
+    '''
 
-def adjust_catalog(catalog, bad_theta_ranges = [(0,3),(87,94),(176,180)], logfile='catalog_adjustments.txt', remake_masks=True):
+    theta = np.asarray(theta, dtype=float)
+    ranges = np.asarray(bad_theta_ranges, dtype=float).reshape(-1, 2)
+    inside = (theta[:, None] > ranges[None, :, 0]) & (theta[:, None] < ranges[None, :, 1])
+
+    return np.any(inside, axis=1) & (np.asarray(status) == 2)
+
+
+def stack_catalogs(catalogs):
+    '''
+    Reads the id, theta and status of every trail in a list of catalogs
+    into one table, with the catalog each trail came from.
+    '''
+
+    columns = {'catalog': [], 'id': [], 'theta': [], 'status': []}
+    for catalog in catalogs:
+        tbl = products.read_table(catalog)
+        if len(tbl) == 0:
+            continue
+        columns['catalog'].append(np.full(len(tbl), str(catalog)))
+        for name in ['id', 'theta', 'status']:
+            columns[name].append(np.asarray(tbl[name]))
+
+    if len(columns['id']) == 0:
+        return Table(names=['catalog', 'id', 'theta', 'status'],
+                     dtype=[str, int, float, int])
+
+    return Table({name: np.concatenate(values) for name, values in columns.items()})
+
+
+def remake_mask(catalog, original_tbl, demoted_ids, product_format=None):
+    '''Takes the demoted trails out of the mask and segmentation map of a
+    catalog. original_tbl is the catalog the current masks were made from;
+    product_format is the mask_storage format they are written in (None:
+    product_format in config.yaml).'''
+
+    # get the original mask shape
+    mask_file = str(catalog).replace('catalog', 'mask')
+    segment_file = str(catalog).replace('catalog', 'segment')
+    shape = mask_shape(mask_file)
+    min_mask_width = int(40 * shape[1]/4096)
+
+    # rasterize the catalog trails (checked against the existing
+    # segmentation map) and only take out the demoted trails
+    engine = IncrementalMask.from_catalog(original_tbl, shape,
+                                          min_mask_width=min_mask_width,
+                                          segment=read_segment(segment_file)[0])
+    for trail_id in demoted_ids:
+        engine.remove(trail_id)
+    segment = engine.segment
+    mask = engine.mask
+
+    # write the new masks
+    write_segment(segment_file, segment, product_format=product_format)
+    write_mask(mask_file, mask, product_format=product_format)
+
+
+def demote_trails(catalog, trail_ids, remake_masks=True, product_format=None):
+    '''
+    Sets the given trails of a catalog to status 1, rewrites it and
+    (optionally) remakes its mask and segmentation map, in product_format
+    (see remake_mask). Trails that are no longer status 2 are left alone.
+    Returns the ids actually demoted.
+    '''
+
+    tbl = products.read_table(catalog)
+
+    # keep the catalog as it was when the current masks were made
+    original_tbl = tbl.copy()
+
+    sel = np.isin(tbl['id'], trail_ids) & (tbl['status'] == 2)
+    if not np.any(sel):
+        return []
+    tbl['status'][sel] = 1
+
+    products.invalidate(catalog)
+    tbl.write(catalog, overwrite=True)
+
+    demoted = [int(i) for i in tbl['id'][sel]]
+    if remake_masks:
+        remake_mask(catalog, original_tbl, demoted, product_format=product_format)
+
+    return demoted
+
+
+def _demote_trails_safe(catalog, trail_ids, remake_masks, product_format=None):
+    '''demote_trails for the process pool; returns (catalog, demoted ids,
+    error message)'''
+
+    try:
+        return catalog, demote_trails(catalog, trail_ids, remake_masks=remake_masks,
+                                      product_format=product_format), ''
+    except Exception as e:
+        return catalog, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def write_log(catalog, demoted_ids, logfile='catalog_adjustments.txt'):
+    '''Appends the demoted trails of a catalog to the log in its directory'''
+
+    if len(demoted_ids) == 0:
+        return
+
+    catalog = Path(catalog)
+    logfile = Path.joinpath(catalog.parent, logfile)
+    now = datetime.datetime.now()
+    sep = '    '
+    with open(logfile, 'a') as log:
+        log.write(str(catalog) + sep + now.strftime("%m/%d/%Y, %H:%M:%S") + '\n')
+        for trail_id in demoted_ids:
+            log.write(str(trail_id) + sep + 'status' + sep + '2' + sep + '1\n')
+
+
+def adjust_catalog(catalog, bad_theta_ranges = default_bad_theta_ranges, logfile='catalog_adjustments.txt', remake_masks=True,
+                   product_format=None):
 
     '''Code to make adjustments to findsat_mrt catalog. Right now it just adjusts the status of trails overlapping certain angles, but more could be added later.
 
     By default, it remakes the masks and segmentation files for any
     image where an adjustment was made.
-    
+
     Input:
 
     catalog = findsat_mrt catalog (should be .fits file)
@@ -29,88 +175,136 @@ def adjust_catalog(catalog, bad_theta_ranges = [(0,3),(87,94),(176,180)], logfil
 
     remake_masks = bool flag to remake masks. True by default.
 
-    '''
-
-    print('Checking catalog ' + catalog)
+    product_format = mask_storage format of the remade masks (None:
+    product_format in config.yaml)
 
-    # set up the log
-    catalog = Path(catalog)
-    dir = catalog.parent
-    logfile = Path.joinpath(dir, logfile)
-    log = open(logfile,'a')
-
-    now = datetime.datetime.now()
+    '''
 
-    # note the starting time and the file being adjusted
-    #log.write('\n ' + now.strftime("%m/%d/%Y, %H:%M:%S") + '\n')  
-    #log.write(str(catalog) + '\n') 
+    print('Checking catalog ' + str(catalog))
 
-    # load the catalog
-    tbl = Table.read(catalog)
+    stacked = stack_catalogs([catalog])
+    sel = demotion_mask(stacked['theta'], stacked['status'], bad_theta_ranges)
 
-    # see if it has any length
-    if len(tbl) == 0:
+    if not np.any(sel):
         print('No changes necessary')
         return
-    
-    # if has length, check the conditions
-    conditions = [np.logical_and(tbl['theta'] > b[0], tbl['theta'] < b[1]) for b in bad_theta_ranges]
 
+    print('Making adjustments to catalog')
+    demoted = demote_trails(catalog, stacked['id'][sel], remake_masks=remake_masks,
+                            product_format=product_format)
+    write_log(catalog, demoted, logfile=logfile)
 
-    # adust status to 1 for cases that need adjusting
-    sel=np.any(conditions, axis=0) & (tbl['status'] == 2)
-    tbl['status'][sel] = 1
-
-    subtbl = tbl[sel]
-    sep = '    '
-    if len(subtbl) == 0:
-
-        print('No changes necessary')
-
-    else:
 
-        print('Making adjustments to catalog')
-
-        log.write(str(catalog) + sep + now.strftime("%m/%d/%Y, %H:%M:%S") + '\n') 
-        for row in subtbl:
-            log.write(str(row['id']) + sep + 'status' + sep + '2' + sep + '1\n')
-
-        tbl.write(catalog, overwrite=True)
-
-        # remake hte mask
-        if remake_masks:
-
-            # get the original mask shape
-            mask_file = str(catalog).replace('catalog', 'mask')
-            segment_file = str(catalog).replace('catalog', 'segment')
-            mask_hdr = fits.getheader(mask_file, ext=1)
-            mask_image = np.zeros((mask_hdr['NAXIS2'], mask_hdr['NAXIS1']))
-            min_mask_width = int(40 * mask_hdr['NAXIS1']/4096)
+def adjust_catalogs(catalogs, bad_theta_ranges=default_bad_theta_ranges,
+                    logfile='catalog_adjustments.txt', remake_masks=True,
+                    dry_run=False, workers=1, product_format=None):
+    '''
+    Adjusts many catalogs at once.
 
-            include = [s['status'] in [2] for s in tbl]
-            if np.sum(include) > 0:
-                trail_id = tbl['id'][include]
-                endpoints = tbl['endpoints'][include]
-                widths = tbl['width'][include]
-                segment, mask = u.create_mask(mask_image, trail_id, endpoints, widths, min_mask_width=min_mask_width)
-            else:
-                mask = np.zeros(mask_image.shape, dtype=bool)
-                segment = np.zeros(mask_image.shape, dtype=int)    
+    catalogs = list of catalogs, or a glob pattern
 
-            # write the new masks
-            with fits.open(segment_file, mode='update') as h:
-                h[0].data = segment
-                h.flush()
-                h.close()
+    dry_run = only report which trails would be demoted
 
-            with fits.open(mask_file, mode='update') as h:
-                h[1].data = mask.astype(int)
-                h.flush()
-                h.close()
+    workers = number of processes used to rewrite the affected catalogs
+    and masks
 
-    log.close()
+    product_format = mask_storage format of the remade masks (None:
+    product_format in config.yaml)
 
+    Returns the stacked table of trails that were (or, for a dry run, would
+    be) demoted.
+    '''
 
-catalogs = glob.glob('/ifs/cs/astro/koekemoer/SUPERCAL/data-fields/GOODSS/satmask_acs_wfc_flcfiles/09500/satellites/*mrt_catalog.fits')
-for catalog in catalogs:
-    adjust_catalog(catalog)
+    if isinstance(catalogs, str):
+        catalogs = sorted(glob.glob(catalogs))
+
+    print('Checking {} catalogs'.format(len(catalogs)))
+    stacked = stack_catalogs(catalogs)
+    demote = stacked[demotion_mask(stacked['theta'], stacked['status'], bad_theta_ranges)]
+
+    affected = list(dict.fromkeys(demote['catalog']))
+    print('{} of {} trails to demote, in {} catalogs'.format(len(demote), len(stacked),
+                                                             len(affected)))
+
+    if dry_run:
+        if len(demote) > 0:
+            demote['status_new'] = 1
+            demote.pprint(max_lines=-1, max_width=-1)
+        return demote
+
+    jobs = [(catalog, list(demote['id'][demote['catalog'] == catalog])) for catalog in affected]
+    errors = {}
+
+    if (workers is None) or (workers <= 1) or (len(jobs) <= 1):
+        results = (_demote_trails_safe(catalog, ids, remake_masks, product_format)
+                   for catalog, ids in jobs)
+        for catalog, demoted, message in results:
+            write_log(catalog, demoted, logfile=logfile)
+            if message:
+                errors[catalog] = message
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_demote_trails_safe, catalog, ids, remake_masks,
+                                   product_format)
+                       for catalog, ids in jobs]
+            for future in as_completed(futures):
+                catalog, demoted, message = future.result()
+                write_log(catalog, demoted, logfile=logfile)
+                if message:
+                    errors[catalog] = message
+
+    for catalog, message in errors.items():
+        print('Error adjusting {}: {}'.format(catalog, message))
+    print('Adjusted {} catalogs ({} errors)'.format(len(jobs) - len(errors), len(errors)))
+
+    return demote
+
+
+def _theta_range(text):
+    low, high = text.split(',')
+    return (float(low), float(high))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Demote findsat_mrt trails at bad angles '
+                                     'and remake the affected masks.')
+    parser.add_argument('catalogs', nargs='?', default=None,
+                        help='glob of the catalogs to adjust (default: catalog_glob in the config)')
+    parser.add_argument('--theta-ranges', nargs='+', type=_theta_range, default=None,
+                        metavar='LOW,HIGH',
+                        help='bad theta ranges (default: bad_theta_ranges in the config)')
+    parser.add_argument('--config', default='config.yaml', help='configuration file')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report which trails would be demoted')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes rewriting catalogs/masks')
+    parser.add_argument('--no-masks', action='store_true', help='do not remake the masks')
+    parser.add_argument('--logfile', default='catalog_adjustments.txt',
+                        help='log written next to each adjusted catalog')
+    args = parser.parse_args(args)
+
+    config = {}
+    if Path(args.config).exists():
+        with open(args.config) as stream:
+            config = yaml.safe_load(stream) or {}
+
+    catalogs = args.catalogs if args.catalogs is not None else config.get('catalog_glob')
+    if catalogs is None:
+        parser.error('no catalogs given and no catalog_glob in ' + args.config)
+
+    bad_theta_ranges = args.theta_ranges
+    if bad_theta_ranges is None:
+        bad_theta_ranges = config.get('bad_theta_ranges', default_bad_theta_ranges)
+
+    # masks are written in the format of this config, not config.yaml
+    product_format = config.get('product_format', default_format)
+    if product_format not in formats:
+        parser.error('unknown product_format {} in {}'.format(product_format, args.config))
+
+    adjust_catalogs(catalogs, bad_theta_ranges=bad_theta_ranges, logfile=args.logfile,
+                    remake_masks=not args.no_masks, dry_run=args.dry_run,
+                    workers=args.workers, product_format=product_format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+'''
+Manifest of the inputs each diagnostic plot was made from.
+
+For every diagnostic PNG in a satellites directory, the manifest stores a
+hash of everything that went into it: the catalog row(s), the 1D
+profiles, the image, mask and segmentation files (by modification time and
+size) and the rebinning/rendering parameters. update_diagnostics uses it to
+remake exactly the plots whose inputs changed since they were made, rather
+than either skipping every existing plot or remaking them all.
+
+The manifest is a JSON file in the satellites directory. Several processes
+may update it at once, so writes are merged under a lock file.
+'''
+
+import os
+import json
+import fcntl
+import tempfile
+from pathlib import Path
+
+from fingerprints import digest, row_digest
+
+manifest_name = '_diagnostics_manifest.json'
+
+# bump this whenever the look of the diagnostics changes, so that all of
+# them are remade
+render_version = 1
+
+# the same for the trail diagnostics of the other backends (see
+# update_diagnostics.trail_backends)
+backend_versions = {'fast': 2}
+
+
+def file_signature(path):
+    '''(modification time, size) of a file, or None if it does not exist'''
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def exposure_inputs(sat_dir, image_dir, root):
+    '''The files read by every diagnostic of an exposure: the image, and
+    the segmentation map and mask of both chips (the catalogs are
+    catalog_path)'''
+
+    inputs = [image_dir + '/' + root + '.fits']
+    for ext in [4, 1]:
+        for name in ['segment', 'mask']:
+            inputs.append(sat_dir + '/' + root + '_ext{}_mrt_{}.fits'.format(ext, name))
+
+    return inputs
+
+
+def catalog_path(sat_dir, root, ext):
+    return sat_dir + '/' + root + '_ext{}_mrt_catalog.fits'.format(ext)
+
+
+def newer_than_inputs(output_file, inputs):
+    '''True if output_file was written after every (existing) input was
+    last modified'''
+
+    signature = file_signature(output_file)
+    if signature is None:
+        return False
+
+    for path in inputs:
+        input_signature = file_signature(path)
+        if (input_signature is not None) and (input_signature[0] >= signature[0]):
+            return False
+
+    return True
+
+
+def exposure_key(sat_dir, image_dir, root, image_rebin):
+    '''Hash of the inputs shared by all diagnostics of an exposure'''
+
+    parts = [render_version, image_rebin,
+             file_signature(image_dir + '/' + root + '.fits')]
+    for ext in [4, 1]:
+        for name in ['segment', 'mask']:
+            parts.append(file_signature(sat_dir + '/' + root + '_ext{}_mrt_{}.fits'.format(ext, name)))
+
+    return digest(*parts)
+
+
+def trail_key(exposure, profiles, row, backend='matplotlib'):
+    '''Hash of the inputs of one trail diagnostic. profiles = the
+    ProfileStore of the trail's chip; backend = how it was rendered'''
+
+    parts = [exposure, profiles.ext, row_digest(row), profiles.signature(row['id'])]
+    if backend != 'matplotlib':
+        # (so that existing keys stay valid)
+        parts.append(backend)
+        if backend in backend_versions:
+            parts.append(backend_versions[backend])
+
+    return digest(*parts)
+
+
+def image_key(exposure, profiles, catalogs):
+    '''Hash of the inputs of the image diagnostic. profiles and catalogs are
+    {ext: ProfileStore} and {ext: catalog}'''
+
+    parts = [exposure]
+    for ext in [4, 1]:
+        for row in catalogs[ext]:
+            parts.append(row_digest(row))
+            if row['status'] == 2:
+                parts.append(profiles[ext].signature(row['id']))
+
+    return digest(*parts)
+
+
+class DiagnosticManifest:
+    def __init__(self, sat_dir):
+        self.sat_dir = str(sat_dir)
+        self.path = Path.joinpath(Path(self.sat_dir), manifest_name)
+        self.lock_path = Path.joinpath(Path(self.sat_dir), manifest_name + '.lock')
+        self.entries = self._read()
+        self._updates = {}
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def name(self, output_file):
+        '''Manifest entries are keyed by path relative to the satellites
+        directory'''
+
+        return os.path.relpath(output_file, self.sat_dir)
+
+    def is_current(self, output_file, key, exists=None):
+        '''True if output_file exists and was made from inputs with this key.
+        exists = optional function used to check that the file exists'''
+
+        if exists is None:
+            exists = lambda path: Path(path).exists()
+
+        return (self.entries.get(self.name(output_file)) == key) and exists(output_file)
+
+    def known(self, output_file):
+        return self.name(output_file) in self.entries
+
+    def record(self, output_file, key):
+        name = self.name(output_file)
+        self.entries[name] = key
+        self._updates[name] = key
+
+    def save(self):
+        '''Merges the recorded entries into the manifest on disk'''
+
+        if len(self._updates) == 0:
+            return
+
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self._read()
+                entries.update(self._updates)
+
+                fd, tmp = tempfile.mkstemp(dir=self.sat_dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(entries, f, indent=0, sort_keys=True)
+                    os.chmod(tmp, 0o664)
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.entries = entries
+        self._updates = {}
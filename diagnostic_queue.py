@@ -0,0 +1,121 @@
+'''
+Background regeneration of diagnostic plots.
+
+After edits are saved, the inspector used to re-render every diagnostic of
+the exposure before the reviewer could move on. A DiagnosticQueue sends
+that work to a separate process instead. The inspector draws what it shows
+from the data in memory (see diagnostic_windows), so it never has to wait
+for a rebuild; only quitting waits for the queue to finish. Rebuilds can be
+limited to the trails that actually changed.
+'''
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from update_diagnostics import _init_worker, _process_root_safe
+
+
+class DiagnosticQueue:
+    def __init__(self, sat_dir, image_dir, logfile=None, image_rebin=4):
+        '''
+        Input:
+
+        sat_dir = directory containing the findsat_mrt output
+
+        image_dir = directory containing the images
+
+        logfile = log file for the worker (defaults to the
+        update_diagnostics log in sat_dir)
+        '''
+
+        self.sat_dir = str(sat_dir)
+        self.image_dir = str(image_dir)
+        if logfile is None:
+            logfile = self.sat_dir + '/update_diagnostics_log.txt'
+        self.logfile = logfile
+        self.image_rebin = image_rebin
+
+        # a single worker, so rebuilds of an exposure happen in order. The
+        # worker is spawned rather than forked as the inspector process runs
+        # an interactive matplotlib backend (and other threads)
+        self._pool = ProcessPoolExecutor(max_workers=1,
+                                         mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_worker,
+                                         initargs=(self.logfile,))
+
+        # queued/running jobs: dicts with the root, future, the trail ids
+        # ({ext: set of ids}, None for all) and whether the image diagnostic
+        # is remade
+        self._jobs = []
+
+    def submit(self, root, trail_ids=None, remake_image=True, **kwargs):
+        '''
+        Queues a rebuild of diagnostics of root. kwargs are passed to
+        update_diagnostics.process_root.
+
+        trail_ids = {ext: list of trail ids} to remake; None remakes all
+        trail diagnostics
+
+        remake_image = whether the image diagnostic is remade
+        '''
+
+        root = str(root)
+        if trail_ids is not None:
+            trail_ids = {ext: set(int(i) for i in ids) for ext, ids in trail_ids.items()}
+
+        # a rebuild of this root that has not started yet is merged into
+        # this one
+        for job in [j for j in self._jobs if j['root'] == root]:
+            if job['future'].cancel():
+                self._jobs.remove(job)
+                remake_image = remake_image or job['remake_image']
+                if (trail_ids is None) or (job['trail_ids'] is None):
+                    trail_ids = None
+                else:
+                    for ext, ids in job['trail_ids'].items():
+                        trail_ids[ext] = trail_ids.get(ext, set()) | ids
+
+        if (trail_ids is not None) and (sum(len(ids) for ids in trail_ids.values()) == 0) \
+                and not remake_image:
+            return
+
+        kwargs.setdefault('overwrite', True)
+        kwargs.setdefault('image_rebin', self.image_rebin)
+        future = self._pool.submit(_process_root_safe, root,
+                                   self.sat_dir, self.image_dir,
+                                   self.logfile,
+                                   trail_ids=trail_ids,
+                                   remake_image_diagnostics=remake_image,
+                                   **kwargs)
+
+        self._jobs.append({'root': root, 'future': future, 'trail_ids': trail_ids,
+                           'remake_image': remake_image})
+
+    def _finish(self, job):
+        root, status, message = job['future'].result()
+        if job in self._jobs:
+            self._jobs.remove(job)
+        if status != 'success':
+            print('Updating the diagnostics of {} ended with status "{}" {}'.format(
+                root, status, message))
+
+    def collect(self):
+        '''Reports (and forgets) finished jobs'''
+
+        for job in list(self._jobs):
+            if job['future'].done():
+                self._finish(job)
+
+    def pending(self):
+        return sorted(set(job['root'] for job in self._jobs
+                          if not job['future'].done()))
+
+    def shutdown(self):
+        '''Waits for queued rebuilds to finish, then stops the worker'''
+
+        if len(self.pending()) > 0:
+            print('Waiting for diagnostics of {} to finish updating'.format(
+                ', '.join(self.pending())))
+        for job in list(self._jobs):
+            self._finish(job)
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,102 @@
+'''
+Live diagnostic windows for inspect_sat_masks.
+
+The inspector used to show every diagnostic by reading its PNG from disk
+into a new window, and to show an edit by writing a new PNG, reading it
+back and opening another window. DiagnosticWindows keeps one window per
+kind of diagnostic (trail and image) and draws into it directly from the
+data in memory. Within an exposure the trail window is built once; moving
+between trails, changing a width or removing/adding a trail only updates
+its artists. PNGs are only written when the changes are saved (by the
+diagnostic queue).
+'''
+
+import matplotlib.pyplot as plt
+
+from new_diagnostics import TrailDiagnosticRenderer, make_image_diagnostic
+from width_control import WidthControl, interactive
+
+window_titles = {'trail': 'Trail diagnostic',
+                 'image': 'Image diagnostic'}
+
+
+class DiagnosticWindows:
+    def __init__(self, figsize=(15, 12)):
+        self.figsize = figsize
+
+        # renderer of the trail window, and the exposure it was built for
+        self.trail_renderer = None
+        self.trail_root = None
+
+    def figure(self, view):
+        '''The window of a view ('trail' or 'image'), opened again if it was
+        closed'''
+
+        title = window_titles[view]
+        if plt.fignum_exists(title):
+            return plt.figure(num=title)
+
+        if view == 'trail':
+            self.trail_renderer = None
+
+        return plt.figure(num=title, figsize=self.figsize)
+
+    def show_trail(self, image_arr, context, trail_mask_arr, row, profile, profile_hdr,
+                   root='', new_context=False, min_mask_width=10):
+        '''
+        Draws a trail diagnostic in the trail window.
+
+        new_context = the rebinned masked images in context changed (e.g.
+        after an edit) since the last trail of this exposure was shown
+        '''
+
+        fig = self.figure('trail')
+        if (self.trail_renderer is None) or (self.trail_root != root):
+            self.trail_renderer = TrailDiagnosticRenderer(image_arr, context, root=root,
+                                                          min_mask_width=min_mask_width,
+                                                          fig=fig)
+            self.trail_root = root
+        elif new_context:
+            self.trail_renderer.update_context(context)
+
+        self.trail_renderer.update(trail_mask_arr, row, profile, profile_hdr)
+        self.draw(fig)
+
+    def can_adjust_width(self):
+        '''Whether the trail window is open and can take key presses for
+        adjust_trail_width (not with a non-interactive backend)'''
+
+        return ((self.trail_renderer is not None) and plt.fignum_exists(window_titles['trail'])
+                and interactive(self.trail_renderer.fig))
+
+    def adjust_trail_width(self, chip, endpoints, width, center, min_mask_width=0):
+        '''
+        Lets the width of the trail shown in the trail window be changed
+        with the keyboard (see width_control). Returns the new width, or
+        None if it was cancelled.
+
+        chip = index of the chip the trail is on (0: WFC1, 1: WFC2)
+        '''
+
+        control = WidthControl(self.trail_renderer, chip, endpoints, width, center,
+                               min_mask_width=min_mask_width)
+        return control.run()
+
+    def show_image(self, *args, **kwargs):
+        '''Draws the image diagnostic in the image window. Takes the
+        arguments of make_image_diagnostic.'''
+
+        fig = self.figure('image')
+        make_image_diagnostic(*args, fig=fig, **kwargs)
+        self.draw(fig)
+
+    def draw(self, fig):
+        # draw now, before the inspector blocks waiting for input
+        fig.canvas.draw_idle()
+        plt.pause(0.001)
+
+    def close(self):
+        for title in window_titles.values():
+            plt.close(title)
+        self.trail_renderer = None
+        self.trail_root = None
@@ -0,0 +1,223 @@
+'''
+Fast trail diagnostics for bulk regeneration.
+
+The image, trail mask and rebinned masked image panels of a trail
+diagnostic are just scaled arrays with a colormap, so CompositeTrailRenderer
+builds them as RGB arrays with numpy (once per exposure) and writes the
+PNG directly. Per trail, only the trail mask overlay is blended in and the
+1D profile is drawn; the profile is the only panel still drawn by
+matplotlib (a small Agg figure, reused for every trail). matplotlib's
+colormaps are used as colour tables.
+
+The panels have no axes or tick labels; the suptitle, trail id and status
+are shown in the profile panel. The quadrants are laid out as in
+new_diagnostics.make_trail_diagnostic and the PNG has the same size. Each
+chip is letterboxed into its panel with its own aspect ratio, so trail
+angles are not distorted.
+
+Select it with update_diagnostics(..., backend='fast').
+'''
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+from new_diagnostics import ProfilePlot
+
+# size of the PNG (as the 15x12 inch figure at 150 dpi)
+figure_shape = (1800, 2250)
+
+# space around and between the stacked chip panels of a quadrant (pixels)
+margin = 30
+gap = 20
+
+overlay_alpha = 0.75
+
+# zlib level of the PNGs: much faster than the default, files of about the
+# same size as the matplotlib ones
+compress_level = 1
+
+
+def color_table(cmap, n=256):
+    '''(n, 3) uint8 RGB table of a matplotlib colormap'''
+
+    return np.round(colormaps[cmap](np.linspace(0, 1, n))[:, :3] * 255).astype(np.uint8)
+
+
+def resample(data, shape):
+    '''
+    Nearest-neighbour resampling of an image to shape, flipped vertically
+    so that row 0 ends up at the bottom (as imshow with origin='lower').
+    '''
+
+    ny, nx = data.shape
+    rows = ((np.arange(shape[0]) + 0.5) * ny / shape[0]).astype(int)[::-1]
+    cols = ((np.arange(shape[1]) + 0.5) * nx / shape[1]).astype(int)
+
+    return data[np.ix_(rows, cols)]
+
+
+def colorize(data, vmin, vmax, table, bad=(255, 255, 255)):
+    '''RGB image of data scaled from vmin to vmax (clipped) through a color
+    table. NaNs get the bad colour (the figure background, as in imshow).'''
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = (np.asarray(data, dtype=float) - vmin) / (vmax - vmin) * len(table)
+    finite = np.isfinite(scaled)
+    index = np.clip(np.where(finite, scaled, 0), 0, len(table) - 1).astype(int)
+
+    rgb = table[index]
+    rgb[~finite] = bad
+
+    return rgb
+
+
+def quadrant_panels(quadrant, n=2):
+    '''(row slice, column slice) of the n panels stacked in a quadrant
+    (0: top left, 1: top right, 2: bottom left, 3: bottom right)'''
+
+    height = figure_shape[0] // 2
+    width = figure_shape[1] // 2
+    y0 = (quadrant // 2) * height
+    x0 = (quadrant % 2) * width
+
+    panel_height = (height - 2*margin - (n - 1)*gap) // n
+    panels = []
+    for i in range(n):
+        top = y0 + margin + i*(panel_height + gap)
+        panels.append((slice(top, top + panel_height),
+                       slice(x0 + margin, x0 + width - margin)))
+
+    return panels
+
+
+def panel_shape(panel):
+    rows, cols = panel
+    return (rows.stop - rows.start, cols.stop - cols.start)
+
+
+def letterbox(panel, shape):
+    '''The largest region of a panel, centered, with the aspect ratio of an
+    image of the given shape'''
+
+    height, width = panel_shape(panel)
+    scale = min(height / shape[0], width / shape[1])
+    ny = int(round(shape[0] * scale))
+    nx = int(round(shape[1] * scale))
+    top = panel[0].start + (height - ny) // 2
+    left = panel[1].start + (width - nx) // 2
+
+    return (slice(top, top + ny), slice(left, left + nx))
+
+
+def write_png(output_file, rgb):
+    Image.fromarray(rgb).save(output_file, compress_level=compress_level)
+
+
+class CompositeTrailRenderer:
+    '''
+    Drop-in replacement for new_diagnostics.TrailDiagnosticRenderer that
+    composes the panels with numpy (see the module docstring).
+    '''
+
+    def __init__(self, image_arr, context, root='', scale=[-1,3], cmap='Greys',
+                 min_mask_width=10):
+        '''
+        Input:
+
+        image_arr = [wfc1, wfc2] images
+
+        context = shared panels from new_diagnostics.make_exposure_context
+
+        min_mask_width = minimum width shown by the profile width markers
+        '''
+
+        # (the rebinned images have the aspect ratio of the chips)
+        self.image_panels = [letterbox(panel, wfc.shape)
+                             for panel, wfc in zip(quadrant_panels(0), image_arr)]
+        self.mask_panels = [letterbox(panel, wfc.shape)
+                            for panel, wfc in zip(quadrant_panels(2), image_arr)]
+        self.rebinned_panels = [letterbox(panel, wfc.shape)
+                                for panel, wfc in zip(quadrant_panels(3), image_arr)]
+
+        # both image quadrants show the same scaled images
+        vmin = context['image_med'] - scale[0]*context['image_stddev']
+        vmax = context['image_med'] + scale[1]*context['image_stddev']
+        table = color_table(cmap)
+
+        self.background = np.full(figure_shape + (3,), 255, dtype=np.uint8)
+        self.chip_shapes = []
+        for wfc, image_panel, mask_panel in zip(image_arr, self.image_panels,
+                                                self.mask_panels):
+            rgb = colorize(resample(wfc, panel_shape(image_panel)), vmin, vmax, table)
+            self.background[image_panel] = rgb
+            self.background[mask_panel] = rgb
+            self.chip_shapes.append(wfc.shape)
+
+        self.update_context(context)
+
+        # the 1d profile (top right quadrant)
+        height = figure_shape[0] // 2
+        width = figure_shape[1] // 2
+        self.profile_panel = (slice(0, height), slice(width, 2*width))
+        fig = Figure(figsize=(width / 150, height / 150), dpi=150, layout='constrained')
+        FigureCanvasAgg(fig)
+        fig.suptitle('Trail Diagnostic\n'+root)
+        self.profile = ProfilePlot(fig.subplots(1, 1), min_mask_width=min_mask_width)
+        self.profile_fig = fig
+
+        self.frame = None
+
+    def update_context(self, context):
+        '''New rebinned masked images (e.g. after the masks changed)'''
+
+        table = color_table('viridis')
+        for rebinned_masked_image, (vmin, vmax), panel in zip(context['rebinned'],
+                                                             context['rebinned_limits'],
+                                                             self.rebinned_panels):
+            self.background[panel] = colorize(resample(rebinned_masked_image,
+                                                       panel_shape(panel)),
+                                              vmin, vmax, table)
+
+    def _overlay(self, frame, panel, trail_mask, color):
+        '''Blends the trail mask into a panel of frame'''
+
+        mask = resample(np.asarray(trail_mask, dtype=bool), panel_shape(panel))
+        pixels = frame[panel]
+        pixels[mask] = np.round((1 - overlay_alpha) * pixels[mask] +
+                                overlay_alpha * color).astype(np.uint8)
+
+    def update(self, trail_mask_arr, row, profile, profile_hdr):
+        '''Shows a trail'''
+
+        frame = self.background.copy()
+
+        # the trail mask: blue if accepted, red if not (the lowest colour of
+        # bwr / bwr_r, as in the matplotlib version)
+        trail_cmap = 'bwr' if row['status'] == 2 else 'bwr_r'
+        color = color_table(trail_cmap)[0].astype(float)
+        for trail_mask, panel in zip(trail_mask_arr, self.mask_panels):
+            if np.any(trail_mask):
+                self._overlay(frame, panel, trail_mask, color)
+
+        # the 1d profile
+        self.profile.update(row, profile, profile_hdr)
+        canvas = self.profile_fig.canvas
+        canvas.draw()
+        frame[self.profile_panel] = np.asarray(canvas.buffer_rgba())[:, :, :3]
+
+        self.frame = frame
+
+    def save(self, output_file, dpi=None):
+        '''Writes the current trail (dpi is ignored; the size is fixed)'''
+
+        write_png(output_file, self.frame)
+
+    def render(self, trail_mask_arr, row, profile, profile_hdr, output_file=None, dpi=None):
+        '''Shows a trail and saves it to output_file'''
+
+        self.update(trail_mask_arr, row, profile, profile_hdr)
+        if output_file is not None:
+            self.save(output_file)
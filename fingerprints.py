@@ -0,0 +1,55 @@
+'''
+Fingerprints (content hashes) of the inputs to the diagnostic plots.
+
+A diagnostic only needs to be remade if one of its inputs changed. Rather
+than comparing catalogs, profiles and masks directly, their contents are
+reduced to short hashes that can be compared (or stored) cheaply.
+'''
+
+import hashlib
+
+import numpy as np
+
+
+def digest(*parts):
+    '''
+    Hash of any number of parts. Arrays are hashed by dtype, shape and
+    contents; anything else by its string representation.
+    '''
+
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(str((part.dtype.str, part.shape)).encode())
+            h.update(part.tobytes())
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(repr(part).encode())
+        # separator, so that ('ab', 'c') and ('a', 'bc') differ
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def row_digest(row):
+    '''Hash of every column of a catalog row'''
+
+    parts = []
+    for name in row.colnames:
+        parts += [name, np.asarray(row[name])]
+
+    return digest(*parts)
+
+
+def profile_digest(profile, header):
+    '''Hash of a 1D trail profile and its header'''
+
+    return digest(np.asarray(profile), header.tostring())
+
+
+def catalog_digests(catalog):
+    '''{trail id: row digest} for a whole catalog'''
+
+    return {int(row['id']): row_digest(row) for row in catalog}
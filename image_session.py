@@ -0,0 +1,210 @@
+'''
+In-memory model of all the findsat_mrt products for one exposure.
+
+The inspector used to go back to disk for every edit (catalogs, masks and
+segmentation maps of both chips, plus the full image). An ImageSession
+reads each product once, keeps both chips in memory, and tracks which
+products have been modified (dirty) so that only those are written back
+on save.
+'''
+
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table
+
+import products
+from mask_storage import read_segment, read_mask, write_segment, write_mask
+from rebin_cache import load_rebinned_chips
+from segment_runs import SegmentRuns
+
+# products tracked for each chip
+product_names = ['catalog', 'segment', 'mask']
+
+
+def _copy(value):
+    if isinstance(value, Table):
+        return value.copy(copy_data=True)
+    return np.array(value)
+
+
+class ImageSession:
+    def __init__(self, root, sat_dir, image_dir=None, product_format=None):
+        '''
+        Input:
+
+        root = image root name (e.g. 'j8fnegrbq_flc')
+
+        sat_dir = directory containing the findsat_mrt output
+
+        image_dir = directory containing the image (defaults to the parent
+        of sat_dir)
+
+        product_format = storage format for masks and segmentation maps
+        (see mask_storage; defaults to product_format in config.yaml)
+        '''
+
+        self.root = root
+        self.sat_dir = Path(sat_dir)
+        if image_dir is None:
+            image_dir = self.sat_dir.parents[0]
+        self.image_dir = Path(image_dir)
+        self.image_path = Path.joinpath(self.image_dir, root + '.fits')
+        self.product_format = product_format
+
+        # chip products, keyed by extension. Loaded on first use.
+        self._chips = {}
+        self._images = None
+        self.binsize = None
+
+    def product_path(self, ext, name):
+        return Path.joinpath(self.sat_dir,
+                             self.root + '_ext{}_mrt_{}.fits'.format(ext, name))
+
+    def _load_chip(self, ext):
+        chip = {}
+        chip['catalog'] = products.read_table(self.product_path(ext, 'catalog'))
+        # copies, so nothing stays memory-mapped to files we later update
+        chip['segment'], __ = read_segment(self.product_path(ext, 'segment'))
+        chip['mask'], __ = read_mask(self.product_path(ext, 'mask'))
+
+        self._chips[ext] = {'data': chip,
+                            'saved': {n: _copy(chip[n]) for n in product_names},
+                            'dirty': set(),
+                            'runs': None}
+
+        if self.binsize is None:
+            image_hdr = products.read_header(self.image_path, ext=ext)
+            self.binsize = int(image_hdr['NAXIS2'] / chip['segment'].shape[0])
+
+    def _chip(self, ext):
+        if ext not in self._chips:
+            self._load_chip(ext)
+        return self._chips[ext]
+
+    def load_all(self):
+        '''Loads everything for both chips now rather than on first use'''
+
+        for ext in [4, 1]:
+            self._chip(ext)
+        self.images()
+
+    def extensions(self):
+        '''Extensions of the chips loaded so far'''
+
+        return list(self._chips.keys())
+
+    def get(self, ext, name):
+        return self._chip(ext)['data'][name]
+
+    def saved(self, ext, name):
+        '''The product as it was last loaded from or saved to disk'''
+
+        return self._chip(ext)['saved'][name]
+
+    def set(self, ext, name, value):
+        chip = self._chip(ext)
+        chip['data'][name] = value
+        chip['dirty'].add(name)
+        if name == 'segment':
+            chip['runs'] = None
+
+    def mark_dirty(self, ext, name):
+        '''Flags a product as changed. Needed after in-place edits (e.g.
+        changing a catalog column).'''
+
+        chip = self._chip(ext)
+        chip['dirty'].add(name)
+        if name == 'segment':
+            chip['runs'] = None
+
+    def segment_runs(self, ext):
+        '''The segmentation map as SegmentRuns (kept until it changes)'''
+
+        chip = self._chip(ext)
+        if chip['runs'] is None:
+            chip['runs'] = SegmentRuns.from_dense(chip['data']['segment'])
+        return chip['runs']
+
+    def is_dirty(self, ext=None, names=None):
+        '''Whether any product (or any of names) of a chip, or of all loaded
+        chips, has unsaved changes'''
+
+        exts = self._chips.keys() if ext is None else [ext]
+        for e in exts:
+            if e not in self._chips:
+                continue
+            dirty = self._chips[e]['dirty']
+            if len(dirty if names is None else dirty.intersection(names)) > 0:
+                return True
+        return False
+
+    def images(self):
+        '''Rebinned images of both chips, keyed by extension'''
+
+        if self._images is None:
+            if self.binsize is None:
+                self._chip(4)
+            wfc1, wfc2 = load_rebinned_chips(self.image_path, self.binsize,
+                                             sat_dir=self.sat_dir)
+            self._images = {4: wfc1, 1: wfc2}
+
+        return self._images
+
+    def image(self, ext):
+        return self.images()[ext]
+
+    # lists in the WFC1, WFC2 order used by the diagnostics
+    def image_arr(self):
+        return [self.image(4), self.image(1)]
+
+    def mask_arr(self):
+        return [self.get(4, 'mask'), self.get(1, 'mask')]
+
+    def segment_arr(self):
+        return [self.get(4, 'segment'), self.get(1, 'segment')]
+
+    def segment_runs_arr(self):
+        return [self.segment_runs(4), self.segment_runs(1)]
+
+    def catalog_arr(self):
+        return [self.get(4, 'catalog'), self.get(1, 'catalog')]
+
+    def revert(self, ext=None):
+        '''Discards unsaved changes, going back to what is on disk'''
+
+        exts = list(self._chips.keys()) if ext is None else [ext]
+        for e in exts:
+            if e not in self._chips:
+                continue
+            chip = self._chips[e]
+            for name in product_names:
+                chip['data'][name] = _copy(chip['saved'][name])
+            chip['dirty'] = set()
+            chip['runs'] = None
+
+    def save(self, ext=None, force=False):
+        '''Writes modified products to disk. If force=True, products are
+        written even if not flagged as modified.'''
+
+        exts = list(self._chips.keys()) if ext is None else [ext]
+        for e in exts:
+            if e not in self._chips:
+                continue
+            chip = self._chips[e]
+            names = product_names if force else sorted(chip['dirty'])
+            for name in names:
+                self._write(e, name, chip['data'][name])
+                chip['saved'][name] = _copy(chip['data'][name])
+            chip['dirty'] = set()
+
+    def _write(self, ext, name, value):
+        path = self.product_path(ext, name)
+        products.invalidate(path)
+        if name == 'catalog':
+            value.write(path, overwrite=True)
+        elif name == 'segment':
+            write_segment(path, value, product_format=self.product_format)
+        elif name == 'mask':
+            write_mask(path, value, product_format=self.product_format)
+        products.invalidate(path)
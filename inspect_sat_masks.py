@@ -17,21 +17,27 @@ import subprocess
 import numpy as np
 from astropy.table import Table, vstack
 from astropy.stats import sigma_clipped_stats
-from astropy.nddata import block_reduce
 
 # import matplotlib and undo agg if needed
 import matplotlib as mpl
 default_backend = mpl.get_backend()
 import matplotlib.pyplot as plt
 plt.ion()
-import matplotlib.image as mpimage
 from acstools.findsat_mrt import WfcWrapper
 from astropy.io import fits
 
 from acstools import utils_findsat_mrt as u
 
-from new_diagnostics import make_trail_diagnostic, make_image_diagnostic
-from update_diagnostics import update_diagnostics
+from new_diagnostics import make_exposure_context, image_stats
+from diagnostic_windows import DiagnosticWindows
+from diagnostic_queue import DiagnosticQueue
+from image_session import ImageSession
+from trail_masks import IncrementalMask, trail_footprint, trail_profile
+from prefetch import ExposurePrefetcher
+from fingerprints import catalog_digests, profile_digest
+from profile_store import ProfileStore
+from sat_index import SatelliteIndex
+from progress_store import ProgressStore, ClaimHeartbeat, session_id, claim_timeout
 
 # load configuration entries
 with open("config.yaml") as stream:
@@ -44,23 +50,14 @@ with open("config.yaml") as stream:
 ds9_command = config['ds9_exe']
 
 
-def show_trail_diagnostic(trail_diagnostic, xsize=15, ysize=12):
-    fig, ax = plt.subplots(figsize=(xsize, ysize))
-    ax.imshow(trail_diagnostic)
-    ax.axis('off')
-    plt.tight_layout()
-    
-def show_image_diagnostic(image_diagnostic, xsize=15, ysize=12):
-    fig, ax = plt.subplots(figsize=(xsize, ysize))
-    ax.imshow(image_diagnostic)
-    ax.axis('off')
-    plt.tight_layout()
-
 class inspect_sat_masks(WfcWrapper):
     def __init__(self, sat_dir,
                  image_dir=None,
                  inspect_good_only=True,
-                 restart=False):
+                 restart=False,
+                 prefetch_ahead=2,
+                 work_queue=False,
+                 reviewer=None):
 
         # other related programs use the non-interactive "agg" backend. 
         # Make sure htat is not set still
@@ -82,45 +79,44 @@ class inspect_sat_masks(WfcWrapper):
         # set the image directory to default if not specified
         if image_dir is None:
             self.image_dir = self.sat_dir.parents[0]
+        else:
+            self.image_dir = Path(image_dir)
 
-        #print(self.image_dir)
-        #print(list(Path.glob(self.image_dir, "*.fits")))
-        
-        # get the unique image ids
-        image_roots = []
-        for file in list(Path.glob(self.image_dir, "*.fits")):
-            image_roots.append(file.stem)
-        
-        # sort these so they are always in the same order. Then add to class
-        image_roots = np.sort(image_roots)
-        self.image_roots = np.array(image_roots)
+        # index of the image and satellites directories, used instead of
+        # globbing and checking files one at a time
+        self.index = SatelliteIndex(self.sat_dir, image_dir=self.image_dir)
+
+        # get the unique image ids, sorted so they are always in the same order
+        self.image_roots = np.array(self.index.roots('.fits'))
 
         # set the current image and trail index to -1 to start
         self.image_index = -1
         self.trail_index = -1
 
-        # see if status.pkl exists. If not create it and populate with the list 
-        # of images in this directory
-        progress_file = Path.joinpath(self.sat_dir, "inspection_progress.csv")
-        if not progress_file.exists():
-            # create a table with the inspection status info
-            progress = Table()
-            progress['files'] = np.sort(self.image_roots)
-            progress['status'] = 'pending'
-            self.progress = progress
-        else:
-            self.progress = Table.read(progress_file)
-
-        # see if _left_off.txt exists. If so, pick up there, unless restart=True
-        left_off_file = Path.joinpath(self.sat_dir, '_left_off.txt')
-        if left_off_file.exists() and not restart:
-            lo = open(left_off_file,'r')
-            last_image = lo.readline()
-            lo.close()
-
-            sel = np.where(self.image_roots == last_image)[0]
-            print('Starting where you left off, on image ', self.image_roots[sel[0]])
+        # inspection progress (status of each exposure and where we left
+        # off). Any exposures not in it yet are added as pending
+        self.progress = ProgressStore(self.sat_dir, reviewer=reviewer)
+        self.progress.add_roots(self.image_roots)
+
+        # in work queue mode, each session claims the next pending exposure
+        # that nobody else is working on, so several reviewers can go
+        # through the directory at once
+        self.work_queue = work_queue
+        self.session_id = session_id(self.progress.reviewer)
+        self.claim_timeout = config.get('claim_timeout', claim_timeout)
+        self.heartbeat = None
+        if self.work_queue:
+            self.heartbeat = ClaimHeartbeat(self.progress, self.session_id,
+                                            interval=self.claim_timeout / 4)
+
+        # pick up where we left off, unless restart=True
+        left_off = self.progress.left_off(reviewer=self.progress.reviewer)
+        if left_off is None:
+            left_off = self.progress.left_off()
+        if (left_off is not None) and not restart and not self.work_queue:
+            sel = np.where(self.image_roots == left_off['root'])[0]
             if len(sel) > 0:
+                print('Starting where you left off, on image ', self.image_roots[sel[0]])
                 self.image_index = sel[0] - 1
         
         # set the image extenson to 4. We iterate 4 to 1 and back
@@ -129,15 +125,40 @@ class inspect_sat_masks(WfcWrapper):
         # indicate that nothing has been updated yet
         self.updates_made = False
 
+        # in-memory products for the current exposure (see load_images)
+        self.session = None
+
+        # incremental mask/segmentation builders for each chip
+        self.mask_engines = {}
+
+        # 1D profile stores, keyed by (root, ext)
+        self.profile_stores = {}
+
+        # the next prefetch_ahead exposures are loaded in the background
+        # while the current one is reviewed (0 to turn this off)
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetcher = ExposurePrefetcher(self.sat_dir, image_dir=self.image_dir,
+                                             min_allowed_status=self.min_allowed_status)
+        # profiles prefetched for the current exposure
+        self.prefetched = None
+
+        # the diagnostics are drawn live, in one window per kind
+        self.windows = DiagnosticWindows()
+
+        # diagnostics are regenerated in the background after saving
+        self.diagnostic_queue = DiagnosticQueue(self.sat_dir, self.image_dir)
+
 
         print(f'\nNumber of files to inspect: {len(self.image_roots)}')
         for file in self.image_roots:
             print(file)
 
-        # define the temporary file file names (put sat_dir in front of these!)
-        self.profile_fits_backup = Path.joinpath(self.sat_dir, '_current_profile_backup.fits')
-        self.profile_diagnostic_backup = Path.joinpath(self.sat_dir, '_current_profile_backup.png')
-        self.updated_image_diagnostic = Path.joinpath(self.sat_dir, '_current_updated_image_diagnostic.png')
+        # define the temporary file names. These are kept in a directory of
+        # their own for each session, so that sessions do not overwrite
+        # each other's files
+        self.temp_dir = Path.joinpath(self.sat_dir, '_sessions', self.session_id)
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.profile_fits_backup = Path.joinpath(self.temp_dir, '_current_profile_backup.fits')
 
         # flag to indicate is a brand new trail is being displayed. Used later
         self.showing_new_trail = False
@@ -146,6 +167,36 @@ class inspect_sat_masks(WfcWrapper):
 
         #self.cycle_through_files()
 
+    # The products for the current chip are held by the session, so edits
+    # happen in memory and are flagged for the next save
+    @property
+    def image(self):
+        return self.session.image(self.ext)
+
+    @property
+    def catalog(self):
+        return self.session.get(self.ext, 'catalog')
+
+    @catalog.setter
+    def catalog(self, value):
+        self.session.set(self.ext, 'catalog', value)
+
+    @property
+    def segment(self):
+        return self.session.get(self.ext, 'segment')
+
+    @segment.setter
+    def segment(self, value):
+        self.session.set(self.ext, 'segment', value)
+
+    @property
+    def mask(self):
+        return self.session.get(self.ext, 'mask')
+
+    @mask.setter
+    def mask(self, value):
+        self.session.set(self.ext, 'mask', value)
+
     def execute(self):
         self.quit = False
 
@@ -181,22 +232,24 @@ class inspect_sat_masks(WfcWrapper):
         catalog_path = Path.joinpath(self.sat_dir, image_root + '_ext{}_mrt_catalog.fits'.format(ext))
         mask_path = Path.joinpath(self.sat_dir, image_root + '_ext{}_mrt_mask.fits'.format(ext))
 
-        if catalog_path.exists():
+        catalog_exists = self.index.exists(catalog_path)
+        mask_exists = self.index.exists(mask_path)
+
+        if catalog_exists:
             print('Trail catalog: FOUND')
         else:
             print('Trail catalog: NOT FOUND')
         
-        if mask_path.exists():
+        if mask_exists:
             print('Trail Mask: FOUND')
         else:
             print('Trail Mask: NOT FOUND')
 
-        return mask_path.exists() & (catalog_path.exists())
+        return mask_exists & catalog_exists
     
     def load_catalog(self):
 
         self.catalog_path = Path.joinpath(self.sat_dir, self.image_roots[self.image_index] + '_ext{}_mrt_catalog.fits'.format(self.ext))
-        self.catalog = Table.read(self.catalog_path)
 
         # also update the source list 
         self.source_list = self.catalog
@@ -204,43 +257,69 @@ class inspect_sat_masks(WfcWrapper):
         #if len(self.catalog) == 0:
         #    print('\n No trails found in ext {}'.format(self.ext))
 
-    def load_diagnostic(self):
-        #self.image_diagnostic = Path.joinpath(self.sat_dir, self.current_image + '_full_mrt_diagnostic.png'.format(self.ext))
+    def diagnostic_context(self, big_rebin=8):
+        '''
+        Panels shared by the diagnostics of the current exposure (see
+        make_exposure_context), from the products in memory. Returns the
+        context and whether it was (re)computed since the last call, e.g.
+        because the masks were edited.
+        '''
 
-        #image_diagnostic = mpimage.imread(self.updated_image_diagnostic)
-        image_diagnostic = mpimage.imread(self.image_diagnostic_path)
-        
-        show_image_diagnostic(image_diagnostic)
+        # the image stats only depend on the image, so are kept per exposure
+        if self.image_stats is None:
+            self.image_stats = image_stats(self.session.image_arr())
+
+        if big_rebin in self.contexts:
+            return self.contexts[big_rebin], False
+
+        context = make_exposure_context(self.session.image_arr(), self.session.mask_arr(),
+                                        big_rebin=big_rebin, stats=self.image_stats)
+        self.contexts[big_rebin] = context
+
+        return context, True
+
+    def load_diagnostic(self):
+        # draw the image diagnostic of both chips, as they are in memory
+        context, __ = self.diagnostic_context(big_rebin=16)
+        self.windows.show_image(self.session.image_arr(),
+                                self.session.mask_arr(),
+                                self.session.segment_runs_arr(),
+                                self.session.catalog_arr(),
+                                self.current_image,
+                                self.sat_dir,
+                                big_rebin=16,
+                                scale=[-1,3],
+                                cmap='Greys',
+                                min_mask_width=10,
+                                context=context)
 
 
     def load_trail_diagnostic(self):
+        # draw the diagnostic of the current trail. Needs its 1D profile
+        # (load_1d_prof)
         
         print('trail id: {}'.format(self.trail_id))
-        #print(self.sat_dir)
-        #print(self.image_roots[self.image_index] + '_ext{}_mrt'.format(self.ext))
-        #print(self.image_roots[self.image_index] + '_ext{}_mrt_{}_diagnostic.png'.format(self.ext, self.trail_id))
-
-        trail_diagnostic = mpimage.imread(str(self.trail_diagnostic_path))
-        
-        show_trail_diagnostic(trail_diagnostic)
 
-        #scale=1.2
-        #fig, ax = plt.subplots(figsize=(12*scale,10*scale))
-        #ax.imshow(trail_diagnostic)
-        #ax.axis('off')
-        #plt.tight_layout()
-        # try to fix this plotting issue with the routine here: https://stackoverflow.com/questions/30880358/matplotlib-figure-not-updating-on-data-change.
-        # I don't want to window to keep opening and closing constsantly
+        # mask for just this trail, on its chip
+        row = self.catalog[self.trail_index]
+        submask = trail_footprint(self.image.shape, row['endpoints'], row['width'],
+                                  min_mask_width=40/self.binsize)
+        if self.ext == 4:
+            trail_mask_arr = [submask, np.zeros_like(submask)]
+        else:
+            trail_mask_arr = [np.zeros_like(submask), submask]
 
-    def load_revised_trail_diagnostic(self):
-        revised_diagnostic = mpimage.imread(str('_current_updated_trail_diagnostic.png'))
-        show_trail_diagnostic(revised_diagnostic)
+        context, new_context = self.diagnostic_context()
+        self.windows.show_trail(self.session.image_arr(), context, trail_mask_arr,
+                                row, self.prof, self.prof_hdr,
+                                root=self.current_image, new_context=new_context)
 
 
     def set_trail_status(self, trail_id, new_status):
 
         sel = np.where(self.catalog['id'] == trail_id)[0]
         self.catalog['status'][sel] = new_status
+        self.session.mark_dirty(self.ext, 'catalog')
 
 
     def remove_trail(self):
@@ -254,20 +333,25 @@ class inspect_sat_masks(WfcWrapper):
         self.remake_masks()
 
     def remake_masks(self):
-        # regenerates the mask and segmentation image
+        # updates the mask and segmentation image. Only trails that were
+        # added, removed or changed since the last call are re-rasterized.
 
-        include = [s['status'] in [2] for s in self.catalog]
-        trail_id = self.catalog['id'][include]
-        endpoints = self.catalog['endpoints'][include]
-        widths = self.catalog['width'][include]
+        # start from the saved products the first time this chip is edited
+        if self.ext not in self.mask_engines:
+            self.mask_engines[self.ext] = IncrementalMask.from_catalog(
+                self.session.saved(self.ext, 'catalog'),
+                self.segment.shape,
+                min_mask_width=self.min_mask_width,
+                segment=self.session.saved(self.ext, 'segment'))
 
-        if np.sum(include) > 0:
-            self.segment, self.mask = u.create_mask(self.image, trail_id, endpoints,
-                                        widths, 
-                                        min_mask_width=self.min_mask_width)
-        else:
-            self.mask = np.zeros(self.image.shape, dtype=bool)
-            self.segment = np.zeros(self.image.shape, dtype=int)
+        engine = self.mask_engines[self.ext]
+        engine.sync(self.catalog)
+
+        self.segment = engine.segment
+        self.mask = engine.mask
+
+        # the rebinned masked images of the diagnostics are out of date
+        self.contexts = {}
 
 
     def add_new_trail(self):
@@ -335,41 +419,12 @@ class inspect_sat_masks(WfcWrapper):
         # now that the trail ID is specified, redefine the trail paths
         self.specify_trail_paths()
 
-        # need to extract the profile from the image
-        rotated, [[rx1, ry1], [rx2, ry2]], theta = u.rotate_image_to_trail(self.image,
-                                                                         endpoints[0])
-
-        # update ry1/2 to include buffer region
-        ry1_new = np.min([ry1, ry2]) - 100
-        ry2_new = np.max([ry1, ry2]) + 100  # making sure ry1 lower than ry2
-        streak_y_rot = (ry1 + ry2) / 2  # streak position, possible slight
-        # difference in ry1/ry2 due to finite angle sampling
-
-        # buffer region could extend off edge of chip. Truncate ry1/ry2 if so
-        fixed_inds = u.good_indices([(ry1_new, ry2_new), (rx1, rx2)],
-                                  rotated.shape)
-        ry1_trim, ry2_trim = fixed_inds[0]
-        rx1_trim, rx2_trim = fixed_inds[1]
-
-        # find distance of streak from current bottom of the cutout
-        dy_streak = streak_y_rot - ry1_trim
-
-        # extract final cutout
-        subregion = rotated[int(ry1_trim):int(ry2_trim),
-                            int(rx1_trim):int(rx2_trim)]
-
-        # make 1D profile of trail (looking down its axis) by taking a median
-        # of all pixels in each row
-        with warnings.catch_warnings():
-            warnings.filterwarnings(action='ignore',
-                                    message='All-NaN slice encountered')
-            medarr = np.nanmedian(subregion, axis=1)
-        
-        # get number of pixels being considered at each point; remove those
-        # that are too small such that median unreliable
-        narr = np.sum(np.isfinite(subregion), axis=1)
-        medarr[narr < 25] = np.nan
-        self.prof = medarr
+        # need to extract the profile from the image: the median of each
+        # row of the image rotated so the trail is horizontal, within 100
+        # rows of the trail. Rows with too few pixels for a reliable median
+        # are NaN. Only that band is interpolated (see trail_profile)
+        self.prof, dy_streak, __ = trail_profile(self.image, endpoints[0], buffer=100,
+                                                 min_pixels=25)
         
         # write out the profile file  # THIS SHOULD NOW BE HANDLED ABOVE
         #self.trail_profile_path = Path.joinpath(self.sat_dir, 
@@ -385,7 +440,8 @@ class inspect_sat_masks(WfcWrapper):
         self.prof_hdr = hdu.header
 
         # have to write the trail profile file, otherwise the diagnostic plot cannot be updated
-        hdu.writeto(self.trail_profile_path, overwrite=True)
+        self.profile_store().write(self.trail_id, self.prof, self.prof_hdr)
+        self.prof_digest = profile_digest(self.prof, self.prof_hdr)
 
         # regenerate masks
         self.remake_masks()
@@ -402,8 +458,22 @@ class inspect_sat_masks(WfcWrapper):
         sel = np.where(self.catalog['id'] == self.trail_id)[0]
         print(sel)
         #print(f'current width (binned pix) = {self.catalog['width'][sel]}')
-        print('\nWhat width would you like?')
-        new_width = input()
+
+        if self.windows.can_adjust_width():
+            # change it live on the trail window
+            print('\nChange the width with the arrow keys on the trail diagnostic window '
+                  '(hold shift for bigger steps). ENTER to accept, ESC to cancel')
+            row = self.catalog[sel[0]]
+            chip = 0 if self.ext == 4 else 1
+            new_width = self.windows.adjust_trail_width(chip, row['endpoints'], row['width'],
+                                                        self.prof_hdr['center'],
+                                                        min_mask_width=self.min_mask_width)
+            if new_width is None:
+                print('width unchanged')
+                return
+        else:
+            print('\nWhat width would you like?')
+            new_width = input()
 
         # make sure this is a number
         try:
@@ -412,6 +482,7 @@ class inspect_sat_masks(WfcWrapper):
 
             # update catalog
             self.catalog['width'][sel] = new_width
+            self.session.mark_dirty(self.ext, 'catalog')
 
             # update profile
             self.prof_hdr['width'] = new_width
@@ -437,24 +508,52 @@ class inspect_sat_masks(WfcWrapper):
         # image diagnostic plot
         #shutil.copyfile(self.updated_image_diagnostic, self.image_diagnostic_path)
 
-        #1d profile data
-        fits.writeto(self.trail_profile_path, self.prof, header=self.prof_hdr, overwrite=True)
+        # trails whose diagnostics are now out of date. Has to be worked
+        # out before the session is saved
+        self.changed_trail_ids = self.changed_trails()
+
+        #1d profile data (if modified)
+        if profile_digest(self.prof, self.prof_hdr) != self.prof_digest:
+            self.profile_store().write(self.trail_id, self.prof, self.prof_hdr)
+            self.prof_digest = profile_digest(self.prof, self.prof_hdr)
+
+        # catalog, segmentation image and mask (whichever were modified)
+        self.session.save()
+
+        # prefetched profiles of this exposure are now out of date
+        self.prefetched = None
+
 
-        # catalog
-        self.catalog.write(self.catalog_path, overwrite=True)
+    def changed_trails(self):
+        '''
+        Returns {ext: [trail ids]} of the trails whose diagnostic inputs
+        (catalog row or 1D profile) differ from what is saved on disk, or
+        None if every trail diagnostic of the exposure is out of date.
 
-        # segmentation plot
-        with fits.open(self.segmentation_path, mode='update') as h:
-            h[0].data = self.segment
-            h.flush()
-            h.close()
+        That is the case whenever a mask or segmentation map is about to be
+        written: every trail diagnostic shows the rebinned final masked
+        image of both chips, and the mask and segmentation files are part
+        of the key of every diagnostic in the manifest.
+        '''
 
-        # mask
-        with fits.open(self.mask_path, mode='update') as h:
-            h[1].data = self.mask.astype(int)
-            h.flush()
-            h.close()
+        if self.session.is_dirty(names=['mask', 'segment']):
+            return None
 
+        changed = {}
+        for ext in self.session.extensions():
+            saved = catalog_digests(self.session.saved(ext, 'catalog'))
+            current = catalog_digests(self.session.get(ext, 'catalog'))
+            ids = [trail_id for trail_id, d in current.items() if saved.get(trail_id) != d]
+            if len(ids) > 0:
+                changed[ext] = ids
+
+        # the current trail's profile
+        if profile_digest(self.prof, self.prof_hdr) != self.prof_digest:
+            ids = changed.setdefault(self.ext, [])
+            if int(self.trail_id) not in ids:
+                ids.append(int(self.trail_id))
+
+        return changed
 
     def specify_image_paths(self, check_exists=False):
 
@@ -484,7 +583,7 @@ class inspect_sat_masks(WfcWrapper):
         if check_exists:
             paths = np.array([self.image_path, self.segmentation_path, self.mask_path,
                      self.catalog_path, self.trail_dir])
-            exists = np.array([path.exists() for path in paths])
+            exists = self.index.exists_all(paths)
             if np.sum(exists) < len(exists):
                 print('ERROR: The following files are missing:')
                 print(paths[~exists])
@@ -510,11 +609,10 @@ class inspect_sat_masks(WfcWrapper):
                                                    self.image_roots[self.image_index] + '_full_ext{}_mrt_{}_diagnostic.png'.format(self.ext, self.trail_id))
         
         if check_exists:
-            paths = [self.trail_profile_path, self.trail_diagnostic_path]
-            exists = [path.exists() for path in paths]
-            if np.any(not exists):
+            # only the profile is needed; the diagnostic is drawn from it
+            if not self.profile_store().has(self.trail_id):
                 print('ERROR: The following files are missing:')
-                print(paths[not exists])
+                print(self.trail_profile_path)
                 return 2
             else:
                 return 0
@@ -527,16 +625,19 @@ class inspect_sat_masks(WfcWrapper):
             
             self.save() # this saves the output files but not the diagnostic plots
 
-            # if moving on from a newly defined trail, need to
-            # regenerate plots for all trails to reflect hte new trail
-            print('updating all diagnostic plots for this image...this may take a moment')
-            plt.ioff()
-            update_diagnostics(str(self.sat_dir), overwrite=True,
-                                   image_list = [str(self.image_path)])
-                                   #remake_image_diagnostics=False)
-            plt.ion()
+            # regenerate the plots of the trails that changed (all of them
+            # if the masks changed), and the image diagnostic (once). This
+            # happens in the background; showing one of these plots waits
+            # until it has been remade
+            if (self.changed_trail_ids is None) or (len(self.changed_trail_ids) > 0):
+                print('updating diagnostic plots for this image in the background')
+                self.diagnostic_queue.submit(self.current_image,
+                                             trail_ids=self.changed_trail_ids,
+                                             remake_image=True)
 
             self.updates_made = False
+        else:
+            self.diagnostic_queue.collect()
 
         # if we're moving on from a new trail, ensure we move to the
         # final inspection image
@@ -548,8 +649,6 @@ class inspect_sat_masks(WfcWrapper):
         else:
 
             #print('\nMoving to the next trail')
-            plt.close('all')
-
             self.trail_index += 1
 
             #print('extension: ',self.ext)
@@ -570,6 +669,8 @@ class inspect_sat_masks(WfcWrapper):
                 self.next_trail()  
             else:
                 self.trail_id = self.catalog['id'][self.trail_index]
+                self.progress.set_position(self.current_image, self.ext,
+                                           self.trail_index, self.trail_id)
 
                 check = self.specify_trail_paths(check_exists=True)
                 if check == 2:
@@ -578,16 +679,14 @@ class inspect_sat_masks(WfcWrapper):
                     self.next_image(save_status='Missing Files')
 
 
-                self.load_trail_diagnostic()
-
-                # backup the trail diagnostic file in case we start editing
-                shutil.copyfile(self.trail_diagnostic_path, self.profile_diagnostic_backup)
-
                 self.load_1d_prof()
 
+                self.load_trail_diagnostic()
+
 
                 # backup the trail profile itself in case any header info is changed
-                shutil.copyfile(self.trail_profile_path, self.profile_fits_backup)
+                fits.writeto(self.profile_fits_backup, self.prof,
+                             header=self.prof_hdr, overwrite=True)
 
     def previous_trail(self):
         '''Routine to go back to the previous trail'''
@@ -599,8 +698,48 @@ class inspect_sat_masks(WfcWrapper):
         else:
             print('\n!!! No prior trails for this image!!!\n')
 
+    def claim_next_image(self):
+        '''Work queue mode: moves image_index to the next exposure this
+        session may work on'''
+
+        # an exposure claimed on purpose (previous_image/choose_image)
+        upcoming = self.image_index + 1
+        if (upcoming < len(self.image_roots)) and self.progress.holds(
+                self.image_roots[upcoming], self.session_id, timeout=self.claim_timeout):
+            self.image_index = upcoming
+        else:
+            root = self.progress.claim_next(self.session_id, roots=self.image_roots,
+                                            timeout=self.claim_timeout)
+            if root is None:
+                self.image_index = len(self.image_roots)
+            else:
+                self.image_index = int(np.where(self.image_roots == root)[0][0])
+
+        # let go of everything else this session was holding
+        keep = None
+        if self.image_index < len(self.image_roots):
+            keep = str(self.image_roots[self.image_index])
+        self.progress.release_all(self.session_id, keep=keep)
+
+    def claim_image(self, index):
+        '''Work queue mode: claims image_roots[index]. Returns False (and
+        says who has it) if another session is working on it.'''
+
+        if not self.work_queue:
+            return True
+
+        root = self.image_roots[index]
+        if self.progress.claim(root, self.session_id, timeout=self.claim_timeout):
+            return True
+
+        print('{} is being inspected by {}'.format(
+            root, self.progress.claimed_by(root, timeout=self.claim_timeout)))
+        return False
+
     def previous_image(self):
         if self.image_index > 0:
+            if not self.claim_image(self.image_index - 1):
+                return
             self.image_index = self.image_index - 2
             self.next_image()
         else:
@@ -616,26 +755,37 @@ class inspect_sat_masks(WfcWrapper):
         self.menu_type = 'trail'
         self.next_image()
 
+    def profile_store(self):
+        '''The 1D profiles of the current chip (packed file or legacy
+        per-trail files)'''
+
+        key = (self.current_image, self.ext)
+        if key not in self.profile_stores:
+            self.profile_stores[key] = ProfileStore(self.sat_dir, *key, index=self.index)
+
+        return self.profile_stores[key]
+
     def load_1d_prof(self):
-        # open the trail profile itself and header
-        prof = fits.getdata(self.trail_profile_path)
-        self.prof = np.copy(prof)
-        self.prof_hdr = fits.getheader(self.trail_profile_path)
+        # open the trail profile itself and header. Returns True if they
+        # were already prefetched
+        if self.prefetched is not None:
+            entry = self.prefetched.profile(self.ext, self.trail_id)
+            if entry is not None:
+                self.prof = np.copy(entry[0])
+                self.prof_hdr = entry[1].copy()
+                self.prof_digest = profile_digest(self.prof, self.prof_hdr)
+                return True
 
-    def update_image_status(self, status):
+        self.prof, self.prof_hdr = self.profile_store().read(self.trail_id)
 
-        # find entry in status table
-        sel=np.where(self.progress['files'] == self.current_image)[0]
+        # remember the profile as loaded, to tell later if it was modified
+        self.prof_digest = profile_digest(self.prof, self.prof_hdr)
 
-        # if empty, make an entry
-        if len(sel) == 0:
-            self.progress.add_row([self.current_image, status])
-        else:
-            # if not empty update the status
-            self.progress['status'][sel] = status
+        return False
+
+    def update_image_status(self, status):
 
-        # save the status file
-        self.progress.write(Path.joinpath(self.sat_dir, 'inspection_progress.csv') , overwrite=True)
+        self.progress.set_status(self.current_image, status)
 
     def next_image(self, save_status=None):
         
@@ -649,9 +799,6 @@ class inspect_sat_masks(WfcWrapper):
         # set the menu back to "trail"
         self.menu_type = 'trail'
 
-        # kill any open windows
-        plt.close('all')
-
         # update the extension
         if self.ext == 1:
             self.ext = 4
@@ -660,7 +807,10 @@ class inspect_sat_masks(WfcWrapper):
 
         # if we've gone back to ext 4, update the image index    
         if self.ext == 4:
-            self.image_index += 1
+            if self.work_queue:
+                self.claim_next_image()
+            else:
+                self.image_index += 1
 
         # exit if we've reached the end
         if self.image_index >= len(self.image_roots):
@@ -671,10 +821,8 @@ class inspect_sat_masks(WfcWrapper):
             # proceed to load everything
             self.current_image = self.image_roots[self.image_index]
 
-            # write this image name to a file
-            left_off_file = open(Path.joinpath(self.sat_dir, '_left_off.txt'),'w')
-            left_off_file.write(self.current_image)
-            left_off_file.close()
+            # note where we are, so we can pick up here next time
+            self.progress.set_position(self.current_image, self.ext)
 
             # tell user what we're looking at
             print(f'Image : {self.current_image}')
@@ -687,16 +835,12 @@ class inspect_sat_masks(WfcWrapper):
                 self.ext = 1
                 self.next_image(save_status='Err/MF')
 
-            # copy the image diagnostic over to a temp file
-            #self.image_diagnostic_path = Path.joinpath(self.sat_dir, self.current_image + '_full_mrt_diagnostic.png'.format(self.ext))
-            shutil.copyfile(self.image_diagnostic_path, self.updated_image_diagnostic)
+            # load the images (original, mask, segment)
+            self.load_images()
 
             # set the trails directory for ths image
             #self.trail_dir = self.image_roots[self.image_index] + f'_ext{self.ext}_mrt'
 
-            # load the images (original, mask, segment)
-            self.load_images()
-
             # oad the trail catalog 
             self.load_catalog()
 
@@ -712,137 +856,66 @@ class inspect_sat_masks(WfcWrapper):
 
 
     def load_images(self):
-        
-        # load the original image
-        #self.image_path = Path.joinpath(self.image_dir, self.current_image + '.fits')
-        self.image = fits.getdata(self.image_path, ext=self.ext)
 
-        # load the previously created segmentation file
-        #self.segmentation_path = Path.joinpath(self.sat_dir, self.current_image + '_ext{}_mrt_segment.fits'.format(self.ext))
-        self.segment = fits.getdata(self.segmentation_path)
+        # the images, segmentation maps, masks and catalogs of both chips are
+        # read once per exposure and kept in memory. Only start a new session
+        # when moving to a different exposure.
+        if (self.session is None) or (self.session.root != self.current_image):
+            # use the prefetched exposure if there is one
+            self.prefetched = self.prefetcher.take(self.current_image)
+            if self.prefetched is not None:
+                self.session = self.prefetched.session
+            else:
+                self.session = ImageSession(self.current_image, self.sat_dir,
+                                            image_dir=self.image_dir)
+            self.mask_engines = {}
+            self.profile_stores = {}
+
+            # start loading the next exposure(s) while this one is reviewed
+            if self.work_queue:
+                ahead = self.progress.upcoming(self.session_id, roots=self.image_roots,
+                                               exclude=self.current_image,
+                                               n=self.prefetch_ahead,
+                                               timeout=self.claim_timeout)
+            else:
+                ahead = self.image_roots[self.image_index + 1:
+                                         self.image_index + 1 + self.prefetch_ahead]
+            self.prefetcher.prefetch(ahead)
 
-        # mask
-        #self.mask_path = Path.joinpath(self.sat_dir, self.current_image + '_ext{}_mrt_mask.fits'.format(self.ext))
-        self.mask = fits.getdata(self.mask_path, ext=1)
+            # image statistics and shared panels of the diagnostics (see
+            # diagnostic_context)
+            self.image_stats = None
+            self.contexts = {}
 
-        # get the binning amount
-        self.binsize = int(self.image.shape[0] / self.segment.shape[0])
-        self.rebin()
+        # make sure this chip is loaded; this also sets the binning amount
+        self.session.get(self.ext, 'segment')
+        self.binsize = self.session.binsize
 
         # use this bin size to set the min mask width
         self.min_mask_width = 40./self.binsize
 
     def exit(self):        
         print('\nSayonara!')
-        plt.close('all')
+        self.prefetcher.shutdown()
+        self.diagnostic_queue.shutdown()
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        self.progress.release_all(self.session_id)
+        self.progress.export_csv()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        self.windows.close()
         self.quit = True
 
     def regenerate_diagnostics(self, remake_trail_diagnostic=True, remake_image_diagnostic=False):
-
-        plt.close('all')
-
-        # create custom mask here to overlay only this trail on image
-        id = self.catalog['id'][self.trail_index]
-        endpoints = self.catalog['endpoints'][self.trail_index]
-        widths = self.catalog['width'][self.trail_index]
-
-
-        # mask for just this trail
-        subseg, submask = u.create_mask(self.image, [id], [endpoints],
-                                        [widths], 
-                                        min_mask_width=40/self.binsize)
-
-        # # mask for all good trails
-        # include = [s['status'] in [2] for s in self.catalog]
-        # trail_id = self.catalog['id'][include]
-        # endpoints = self.catalog['endpoints'][include]
-        # widths = self.catalog['width'][include]
-
-        # if np.sum(include) > 0:
-        #     self.segment, self.mask = u.create_mask(self.image, trail_id, endpoints,
-        #                                 widths, 
-        #                                 min_mask_width=self.min_mask_width)
-        # else:
-        #     self.mask = np.zeros(self.image.shape, dtype=bool)
-        #     self.segment = np.zeros(self.image.shape, dtype=int)
-
-        # the new trail diagnostics show both chips. Need to load data accordingly
-
-        # image
-        hdu = fits.open(self.image_path)
-        wfc1 = block_reduce(hdu[4].data, self.binsize, func=np.nansum)
-        wfc2 = block_reduce(hdu[1].data, self.binsize, func=np.nansum)
-        hdu.close()
-        image_arr = [wfc1, wfc2]
-
-        # trail mask
-        if self.ext == 4:
-            trail_mask_wfc1 = submask
-            trail_mask_wfc2 = np.zeros_like(trail_mask_wfc1)
-        elif self.ext == 1:
-            trail_mask_wfc2 = submask
-            trail_mask_wfc1 = np.zeros_like(trail_mask_wfc2)
-
-        trail_mask_arr = [trail_mask_wfc1, trail_mask_wfc2]
-
-        # full mask
-        mask_4 = fits.getdata(Path.joinpath(self.sat_dir, self.current_image + '_ext{}_mrt_mask.fits'.format(4)))
-        mask_1 = fits.getdata(Path.joinpath(self.sat_dir, self.current_image + '_ext{}_mrt_mask.fits'.format(1)))
-
-        # replace the relevant mask with the one we just updated
-        if self.ext == 4:
-            full_mask_wfc1 = self.mask
-            full_mask_wfc2 = mask_1
-        elif self.ext == 1:
-            full_mask_wfc1 = mask_4
-            full_mask_wfc2 = self.mask
-        full_mask_arr = [full_mask_wfc1, full_mask_wfc2]
-
-        # segmentation masks
-        segment_4 = fits.getdata(Path.joinpath(self.sat_dir, self.current_image + '_ext4_mrt_segment.fits'))
-        segment_1 = fits.getdata(Path.joinpath(self.sat_dir, self.current_image + '_ext1_mrt_segment.fits'))   
-
-        if self.ext == 4:
-            segment_arr = [self.segment, segment_1]
-        else:
-            segment_arr = [segment_4, self.segment]
-
-        #catalogs
-        catalog_4 = Table.read(Path.joinpath(self.sat_dir, self.image_roots[self.image_index] + '_ext4_mrt_catalog.fits'))
-        catalog_1 = Table.read(Path.joinpath(self.sat_dir, self.image_roots[self.image_index] + '_ext1_mrt_catalog.fits'))
-
-        if self.ext == 4:
-            catalog_arr = [self.catalog, catalog_1]
-        else:
-            catalog_arr = [catalog_4, self.catalog]
+        # redraw the diagnostics after an edit. The windows are updated in
+        # place; the PNGs are remade when the changes are saved
 
         if remake_trail_diagnostic:
-            make_trail_diagnostic(image_arr,full_mask_arr,trail_mask_arr,
-                                  self.catalog[self.trail_index],self.prof,
-                                  self.prof_hdr, root=self.current_image,
-                                  overwrite=True,
-                                  output_file='_current_updated_trail_diagnostic.png')
-        
+            self.load_trail_diagnostic()
+
         if remake_image_diagnostic:
-            make_image_diagnostic(image_arr,
-                                  full_mask_arr,
-                                  segment_arr,
-                                  catalog_arr,
-                                  self.current_image,
-                                  self.sat_dir,
-                                  big_rebin=16,
-                                  scale=[-1,3],
-                                  cmap='Greys',
-                                  output_file = self.updated_image_diagnostic, 
-                                  min_mask_width=10,
-                                  overwrite=True)
-        # make_trail_diagnostic(self.image, submask, self.mask, self.catalog[self.trail_index],
-        #                       self.prof, self.prof_hdr, scale=[-1,3], cmap='Greys',
-        #                       root=self.current_image, big_rebin=16, 
-        #                       output_file='_current_updated_diagnostic.png')
-        plt.close('all')
-        self.load_revised_trail_diagnostic()
-        
+            self.load_diagnostic()
+
 
     def toggle_show_all_trails(self):
         if self.inspect_good_only == True:
@@ -852,6 +925,10 @@ class inspect_sat_masks(WfcWrapper):
             self.inspect_good_only = True
             self.min_allowed_status = 2
 
+        # exposures prefetched from now on include the trails shown. Missing
+        # ones in those already prefetched are simply read from disk
+        self.prefetcher.min_allowed_status = self.min_allowed_status
+
         # restart inspection
         self.trail_index = -1
         self.ext = 1
@@ -865,24 +942,18 @@ class inspect_sat_masks(WfcWrapper):
         else:
 
             print('\n Undoing all changes')
-            plt.close('all')
 
             if self.showing_new_trail:
 
-                # delete new image and trail diagnostics
-                
-                if Path('_current_updated_trail_diagnostic.png').is_file():
-                    os.remove('_current_updated_trail_diagnostic.png')
-                #shutil.copyfile(self.image_diagnostic_path, 
-                #                self.updated_image_diagnostic)
-
-                # also remove the trail profile file
-                if Path(self.trail_profile_path).is_file():
-                    os.remove(self.trail_profile_path)
+                # remove the trail profile
+                self.profile_store().remove(self.trail_id)
 
                 # want to jump back to the final inspection plot
             
                 # reload the catalog and images
+                self.session.revert()
+                self.mask_engines = {}
+                self.contexts = {}
                 self.load_catalog()
                 self.load_images()
 
@@ -895,27 +966,22 @@ class inspect_sat_masks(WfcWrapper):
 
             else:
 
-                # move the backup of the diagnostic plot over
-                if Path('_current_updated_trail_diagnostic.png').is_file():
-                    os.remove('_current_updated_trail_diagnostic.png')
-
-                # replace the working image diagnostic plot
-                #shutil.copyfile(self.image_diagnostic_path, 
-                #                self.updated_image_diagnostic)
-
                 # reload the catalog
+                self.session.revert()
+                self.mask_engines = {}
+                self.contexts = {}
                 self.load_catalog()
 
                 # reload the images
                 self.load_images()
 
                 if self.menu_type == 'trail':
-                    # show the original diagnostic
-                    self.load_trail_diagnostic()
-
                     # reload the original 1d profile
                     self.load_1d_prof()
 
+                    # show the original diagnostic
+                    self.load_trail_diagnostic()
+
                 else:
                     ### to do: check if this is necessary
                     self.ext = 1  # reset to index present when we inspect image
@@ -953,11 +1019,16 @@ class inspect_sat_masks(WfcWrapper):
         #make sure it's a number
         try:
             new_index = int(new_index)
+            if not self.claim_image(new_index):
+                return
             # set the image index to 1 minus this, and ext to 4, so "next_image" iterates to what we want
             self.image_index = new_index - 1
             self.ext = 1
             print('new image = {}'.format(self.image_roots[new_index]))
 
+            # whatever was being prefetched is no longer next
+            self.prefetcher.cancel()
+
             self.next_image()
 
         except:
@@ -0,0 +1,239 @@
+'''
+Storage formats for the mask and segmentation map files.
+
+findsat_mrt (and the tools here, so far) write the boolean trail mask as
+64-bit integers and the segmentation map as default integers, both
+uncompressed, although the mask is a single bit per pixel and the
+segmentation map holds a handful of small trail ids. The formats here
+store them compactly:
+
+    legacy      int64 mask and segmentation map as given, uncompressed
+                (as before)
+    compact     uint8 mask, int16 segmentation map, uncompressed
+    rice        as compact, with RICE tile compression
+    gzip        as compact, with GZIP tile compression
+    bits        bit-packed mask (8 pixels per byte) and int16
+                segmentation map, with GZIP tile compression
+
+Segmentation maps are stored as signed 16-bit integers (falling back to
+64-bit if a trail id does not fit): unsigned 16-bit data needs BZERO
+scaling in FITS, which cannot be memory-mapped.
+
+read_segment / read_mask read any of these (and the original files)
+transparently, so old and new files can be mixed in one directory. The
+format used for writing is product_format in config.yaml (legacy if not
+set). Files in every format are written next to the old one and then moved
+into place, so a reader (e.g. the background diagnostic worker) never sees
+a half-written file. Run this module to convert the files of a satellites
+directory:
+
+    python mask_storage.py path_to_satellite_files rice
+'''
+
+import os
+import sys
+import glob
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import yaml
+from astropy.io import fits
+
+import products
+
+formats = {'legacy': {'mask': 'int', 'segment': None, 'compression': None},
+           'compact': {'mask': 'uint8', 'segment': 'int16', 'compression': None},
+           'rice': {'mask': 'uint8', 'segment': 'int16', 'compression': 'RICE_1'},
+           'gzip': {'mask': 'uint8', 'segment': 'int16', 'compression': 'GZIP_1'},
+           'bits': {'mask': 'bits', 'segment': 'int16', 'compression': 'GZIP_1'}}
+
+default_format = 'legacy'
+
+# header keywords of a bit-packed mask (with the unpacked width)
+packed_keyword = 'MASKBITS'
+width_keyword = 'MASKNX'
+
+# keywords describing the data layout, not copied from old headers
+structural_keywords = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                       'EXTEND', 'PCOUNT', 'GCOUNT', 'BZERO', 'BSCALE',
+                       packed_keyword, width_keyword]
+
+
+def configured_format(config_file='config.yaml'):
+    '''The product_format set in the config file (or the default)'''
+
+    try:
+        with open(config_file) as stream:
+            config = yaml.safe_load(stream) or {}
+    except FileNotFoundError:
+        config = {}
+
+    return config.get('product_format', default_format)
+
+
+def _data_ext(path, ext):
+    '''
+    The extension holding the data. Compressed files keep it in the first
+    extension (a compressed image cannot be the primary HDU), whichever
+    extension it was in the original layout.
+    '''
+
+    if (ext == 0) and (products.read_header(path, ext=0)['NAXIS'] == 0) and \
+            (products.extension_count(path) > 1):
+        return 1
+
+    return ext
+
+
+def read_segment(path, copy=True):
+    '''(segmentation map, header) from a segment file in any format'''
+
+    return products.read(path, ext=_data_ext(path, 0), copy=copy)
+
+
+def read_mask(path):
+    '''(mask, header) from a mask file in any format. Bit-packed masks are
+    unpacked.'''
+
+    data, header = products.read(path, ext=_data_ext(path, 1))
+    if header.get(packed_keyword, False):
+        data = np.unpackbits(data, axis=1, count=header[width_keyword])
+
+    return data, header
+
+
+def mask_shape(path):
+    '''Shape of the (unpacked) mask in a mask file, without reading it'''
+
+    header = products.read_header(path, ext=_data_ext(path, 1))
+    if header.get(packed_keyword, False):
+        return (header['NAXIS2'], header[width_keyword])
+
+    return (header['NAXIS2'], header['NAXIS1'])
+
+
+def _old_headers(path, data_ext):
+    '''Headers of an existing file, minus the layout keywords, in the
+    uncompressed layout (data in extension data_ext)'''
+
+    headers = []
+    if not Path(path).exists():
+        return headers
+
+    with fits.open(path) as hdul:
+        compressed = any(isinstance(hdu, fits.CompImageHDU) for hdu in hdul)
+        for hdu in hdul:
+            header = hdu.header.copy()
+            if isinstance(hdu, fits.CompImageHDU):
+                # the header of the image inside (not the binary table
+                # holding the compressed tiles)
+                header = fits.Header([card for card in header.cards
+                                      if not card.keyword.startswith('Z')])
+            for keyword in structural_keywords:
+                header.remove(keyword, ignore_missing=True, remove_all=True)
+            headers.append(header)
+
+    if compressed and (data_ext == 0):
+        # the data was moved out of the primary HDU
+        headers = headers[1:]
+
+    return headers
+
+
+def _segment_dtype(segment, spec):
+    if spec is None:
+        # floats as given (findsat_mrt writes them), otherwise default ints
+        dtype = np.asarray(segment).dtype
+        return dtype if np.issubdtype(dtype, np.floating) else int
+    if spec == 'int16' and segment.max(initial=0) <= np.iinfo(np.int16).max:
+        return np.int16
+    return int
+
+
+def _build(data, headers, data_ext, compression):
+    '''HDUList with data in extension data_ext (or in extension 1 if
+    compressed)'''
+
+    primary_header = headers[0] if len(headers) > 0 else None
+    data_header = headers[data_ext] if len(headers) > data_ext else None
+
+    if compression is not None:
+        primary = fits.PrimaryHDU(header=primary_header if data_ext == 1 else None)
+        hdu = fits.CompImageHDU(data, header=data_header, compression_type=compression)
+        return fits.HDUList([primary, hdu])
+
+    if data_ext == 0:
+        return fits.HDUList([fits.PrimaryHDU(data, header=data_header)])
+
+    return fits.HDUList([fits.PrimaryHDU(header=primary_header),
+                         fits.ImageHDU(data, header=data_header)])
+
+
+def _replace(path, hdul):
+    '''Writes a file next to path and moves it into place'''
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    try:
+        hdul.writeto(tmp, overwrite=True)
+        os.chmod(tmp, 0o664)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_segment(path, segment, product_format=None):
+    '''Writes a segmentation map, keeping the headers of the existing file'''
+
+    if product_format is None:
+        product_format = configured_format()
+    spec = formats[product_format]
+
+    products.invalidate(path)
+    segment = np.asarray(segment).astype(_segment_dtype(segment, spec['segment']))
+    _replace(path, _build(segment, _old_headers(path, 0), 0, spec['compression']))
+    products.invalidate(path)
+
+
+def write_mask(path, mask, product_format=None):
+    '''Writes a mask, keeping the headers of the existing file'''
+
+    if product_format is None:
+        product_format = configured_format()
+    spec = formats[product_format]
+
+    products.invalidate(path)
+    headers = _old_headers(path, 1)
+    while len(headers) < 2:
+        headers.append(fits.Header())
+    mask = np.asarray(mask) > 0
+    if spec['mask'] == 'bits':
+        headers[1][packed_keyword] = (True, 'mask is bit-packed along rows')
+        headers[1][width_keyword] = (mask.shape[1], 'width of the unpacked mask')
+        data = np.packbits(mask, axis=1)
+    elif spec['mask'] == 'uint8':
+        data = mask.astype(np.uint8)
+    else:
+        data = mask.astype(int)
+    _replace(path, _build(data, headers, 1, spec['compression']))
+    products.invalidate(path)
+
+
+def convert_directory(sat_dir, product_format):
+    '''Rewrites every mask and segmentation map in sat_dir in a format'''
+
+    for path in sorted(glob.glob(os.path.join(sat_dir, '*_mrt_segment.fits'))):
+        segment, __ = read_segment(path)
+        write_segment(path, segment, product_format=product_format)
+        print('{}: {}'.format(path, product_format))
+    for path in sorted(glob.glob(os.path.join(sat_dir, '*_mrt_mask.fits'))):
+        mask, __ = read_mask(path)
+        write_mask(path, mask, product_format=product_format)
+        print('{}: {}'.format(path, product_format))
+
+
+if __name__ == '__main__':
+    convert_directory(sys.argv[1], sys.argv[2])
@@ -1,123 +1,356 @@
 
-import matplotlib.pyplot as plt
-from astropy.io import fits
+from matplotlib import colormaps
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import ListedColormap, Normalize
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from astropy.stats import sigma_clipped_stats
 from astropy.table import Table
 import numpy as np
-from astropy.nddata import bitmask, block_reduce
+from astropy.nddata import bitmask
 import acstools.utils_findsat_mrt as u
 from pathlib import Path
 import warnings
+from rebin import block_median
+from rebin_cache import load_rebinned_chips
+from mask_storage import read_segment
+from trail_masks import trail_footprint
+from segment_runs import as_runs
+from profile_store import ProfileStore
 
 image_rebin=4
 
-def make_trail_diagnostic(image_arr,
-                          final_mask_arr,
-                          trail_mask_arr,
-                          row,
-                          profile,
-                          profile_hdr,
-                          big_rebin=8,
-                          scale=[-1,3],
-                          cmap='Greys', root='',
-                          output_file = None, 
-                          min_mask_width=10,
-                          overwrite=False):
+clip_warning = 'Input data contains invalid values (NaNs or infs), which were automatically clipped.'
 
-    if output_file is not None:
-        if Path(output_file).exists() & (overwrite == False):
-            print('Output file {} already exists.'.format(output_file))
-            print('Set overwrite = True to replace it.')
-            plt.close('all')
-            return
 
-    # set up figure grid
-    fig = plt.figure(figsize=(15,12), layout='constrained')
-    fig.suptitle('Trail Diagnostic\n'+root)
-    [[p1, p2],[p3, p4]] = fig.subfigures(2,2)
-
-    p1a1, p1a2 = p1.subplots(2,1)
-    p2a1 = p2.subplots(1,1)
-    p3a1, p3a2 = p3.subplots(2,1)
-    p4a1, p4a2 = p4.subplots(2,1)
-
-    # set up images
+def image_stats(image_arr):
+    '''Sigma-clipped median and standard deviation of both chips. These set
+    the display limits for the image panels.'''
 
     with warnings.catch_warnings():
-        warnings.filterwarnings(action='ignore',
-                                message='Input data contains invalid values (NaNs or infs), which were automatically clipped.')
+        warnings.filterwarnings(action='ignore', message=clip_warning)
         __, image_med, image_stddev = sigma_clipped_stats(image_arr)
-    for ax, wfc in zip([p1a1, p1a2], image_arr):
-        ax.imshow(wfc, cmap=cmap, origin='lower', aspect='auto',
-                    vmin=image_med - scale[0]*image_stddev,
-                    vmax=image_med + scale[1]*image_stddev)
-    p1a1.set_title('Image')
-   
 
-    # do this for the bottom left too
-    for ax, wfc, trail_mask in zip([p3a1, p3a2], image_arr, trail_mask_arr):
-        ax.imshow(wfc, cmap=cmap, origin='lower', aspect='auto',
-                    vmin=image_med - scale[0]*image_stddev,
-                    vmax=image_med + scale[1]*image_stddev)
+    return image_med, image_stddev
 
-        if row['status'] == 2:
-            trail_cmap = 'bwr'
-        else:
-            trail_cmap = 'bwr_r'
-        ax.imshow(np.ma.masked_where(trail_mask == 0, trail_mask)*255, alpha=0.75, origin='lower', aspect='auto', cmap=trail_cmap)
-    p3a1.set_title('Image with trail mask')
-    p3a1.text(0.01, 1.01, 'Accepted', color='blue', transform = p3a1.transAxes, fontsize='x-large', va='bottom',bbox=dict(facecolor='white', alpha=0.5))
-    p3a1.text(0.99, 1.01, 'Rejected', color='red', transform = p3a1.transAxes, fontsize='x-large', va='bottom',ha='right', bbox=dict(facecolor='white', alpha=0.5))
 
+def rebin_masked_images(image_arr, final_mask_arr, big_rebin=8):
+    '''Heavily rebinned images with all trails masked, along with their
+    display limits.'''
 
-    # make the big masked image
-    for ax, image, final_mask in zip([p4a1, p4a2], image_arr, final_mask_arr):
-        masked_image = np.ma.masked_where(final_mask, image)
+    rebinned_arr = []
+    limits_arr = []
+    for image, final_mask in zip(image_arr, final_mask_arr):
+        rebinned_masked_image = block_median(image, big_rebin,
+                                             mask=np.asarray(final_mask, dtype=bool))
         with warnings.catch_warnings():
-            warnings.filterwarnings(action='ignore',
-                                    message='Input data contains invalid values (NaNs or infs), which were automatically clipped.')
-            rebinned_masked_image = block_reduce(masked_image, big_rebin, func=np.nanmedian)
- 
+            warnings.filterwarnings(action='ignore', message=clip_warning)
             __, image_med, image_stddev = sigma_clipped_stats(rebinned_masked_image)
 
-        ax.imshow(rebinned_masked_image, origin='lower', aspect='auto',
-                  vmin=image_med - image_stddev, vmax = image_med + 5*image_stddev)
-    p4a1.set_title('Rebinned final masked image')
+        rebinned_arr.append(rebinned_masked_image)
+        limits_arr.append((image_med - image_stddev, image_med + 5*image_stddev))
 
-    # show the 1d profile
-    log_med = np.log10(profile+100)
-    p2a1.plot(log_med)
-    p2a1.axvline(profile_hdr['center'],color='red',alpha=0.5)
-    p2a1.set_title('trail id={}'.format(row['id']))
+    return rebinned_arr, limits_arr
 
-    final_width = np.maximum(min_mask_width, profile_hdr['width'])
 
-    p2a1.axvline(profile_hdr['center'] + final_width / 2, color='magenta', alpha=0.75)
-    p2a1.axvline(profile_hdr['center'] - final_width / 2, color='magenta',alpha=0.75)
+def segment_overlay_labels(segment_arr):
+    '''
+    Numbers the trails of both chips 1..n (WFC1 first), so that they can
+    share one colormap. Returns the relabelled maps and the colorbar label
+    of each number.
+    '''
 
-    xmin = np.maximum(profile_hdr['center'] - 3*final_width, 0)
-    xmax = np.minimum(profile_hdr['center'] + 3*final_width, len(profile))
+    label_arr = []
+    trail_labels = []
+    for segment, chip in zip(segment_arr, ['wfc1', 'wfc2']):
+        # one np.unique(return_inverse=True) over the runs of trail pixels
+        runs, trail_ids = as_runs(segment).consecutive()
+        labels = runs.to_dense(dtype=np.int32)
+        labels[labels > 0] += len(trail_labels)
+        label_arr.append(labels)
+        trail_labels += ['{} - {}'.format(int(trail_id), chip) for trail_id in trail_ids]
 
-    p2a1.set_xlim(xmin, xmax)
+    return label_arr, trail_labels
 
-    # add a little status string
-    if row['status'] <= 1:
-        status_string = 'status = rejected ({})'.format(row['status'])
-    else:
-        status_string = 'status = accepted ({})'.format(row['status'])
 
-    p2a1.text(0.99,0.99,status_string,transform=p2a1.transAxes, ha='right', va='top')
-    p2a1.text(0.99,0.94, 'width = {:.1f}'.format(profile_hdr['width']), transform=p2a1.transAxes, ha='right', va='top')
+def overlay_lut(n, cmap='tab20', alpha=0.75):
+    '''RGBA colors of labels 0..n; label 0 is transparent'''
 
-    #for ax in [p1a1, p1a2, p3a1, p3a2, p4a1, p4a2]:
-    #    ax.axis('off')
+    lut = np.zeros((n + 1, 4))
+    if n > 0:
+        lut[1:] = colormaps[cmap].resampled(n)(np.arange(n))
+        lut[1:, 3] = alpha
 
+    return lut
+
+
+def overlay_rgba(labels, lut, max_shape=None):
+    '''
+    RGBA image of a label map. If max_shape is given, the labels are first
+    subsampled by whole factors to be no larger than that (e.g. the size of
+    the panel in the saved figure).
+    '''
+
+    if max_shape is not None:
+        fy = max(labels.shape[0] // max_shape[0], 1)
+        fx = max(labels.shape[1] // max_shape[1], 1)
+        labels = labels[::fy, ::fx]
+
+    return lut[labels]
+
+
+def make_exposure_context(image_arr, final_mask_arr, big_rebin=8, stats=None):
+    '''Computes the panels that are identical for every trail diagnostic of
+    an exposure: the image statistics and the rebinned masked image with its
+    display limits. Pass the result to make_trail_diagnostic or
+    make_image_diagnostic via the context keyword so they are only computed
+    once per exposure.
+
+    stats = (median, stddev) from a previous call to image_stats. Useful when
+    only the masks have changed.
+    '''
+
+    if stats is None:
+        stats = image_stats(image_arr)
+
+    rebinned_arr, limits_arr = rebin_masked_images(image_arr, final_mask_arr,
+                                                   big_rebin=big_rebin)
+
+    context = {'image_med': stats[0],
+               'image_stddev': stats[1],
+               'big_rebin': big_rebin,
+               'rebinned': rebinned_arr,
+               'rebinned_limits': limits_arr}
+
+    return context
+
+
+def diagnostic_figure(fig=None):
+    '''A new 15x12 figure on an Agg canvas, or fig cleared for reuse'''
+
+    if fig is None:
+        fig = Figure(figsize=(15,12), dpi=150, layout='constrained')
+        FigureCanvasAgg(fig)
+    else:
+        fig.clear()
+        fig.set_layout_engine('constrained')
+
+    return fig
+
+
+class ProfilePlot:
+    '''The 1D profile panel of a trail diagnostic: the profile with its
+    center and (minimum) width marked, updated in place for each trail'''
+
+    def __init__(self, ax, min_mask_width=10):
+        self.ax = ax
+        self.min_mask_width = min_mask_width
+        self.line, = ax.plot([0, 1], [0, 1])
+        self.center_line = ax.axvline(0, color='red', alpha=0.5)
+        self.width_lines = [ax.axvline(0, color='magenta', alpha=0.75),
+                            ax.axvline(0, color='magenta', alpha=0.75)]
+        self.title = ax.set_title('')
+        self.status_text = ax.text(0.99, 0.99, '', transform=ax.transAxes, ha='right', va='top')
+        self.width_text = ax.text(0.99, 0.94, '', transform=ax.transAxes, ha='right', va='top')
+
+    def update(self, row, profile, profile_hdr):
+        log_med = np.log10(profile+100)
+        self.line.set_data(np.arange(len(log_med)), log_med)
+        self.title.set_text('trail id={}'.format(row['id']))
+
+        final_width = np.maximum(self.min_mask_width, profile_hdr['width'])
+        center = profile_hdr['center']
+        self.center_line.set_xdata([center, center])
+        self.set_width(center, profile_hdr['width'])
+
+        self.ax.relim()
+        self.ax.autoscale_view()
+        xmin = np.maximum(center - 3*final_width, 0)
+        xmax = np.minimum(center + 3*final_width, len(profile))
+        self.ax.set_xlim(xmin, xmax)
+
+        # add a little status string
+        if row['status'] <= 1:
+            status_string = 'status = rejected ({})'.format(row['status'])
+        else:
+            status_string = 'status = accepted ({})'.format(row['status'])
+        self.status_text.set_text(status_string)
+
+    def set_width(self, center, width):
+        '''Moves the width markers and updates the width text (the axis
+        limits are left alone)'''
+
+        final_width = np.maximum(self.min_mask_width, width)
+        for line, x in zip(self.width_lines, [center + final_width / 2,
+                                              center - final_width / 2]):
+            line.set_xdata([x, x])
+        self.width_text.set_text('width = {:.1f}'.format(width))
+
+
+class TrailDiagnosticRenderer:
+    '''
+    Draws the trail diagnostics of one exposure. The figure (layout, axes
+    and images) is built once; each trail then only updates the trail
+    mask overlay, the 1D profile and the text, and is rendered on an Agg
+    canvas (no pyplot state involved).
+    '''
+
+    def __init__(self, image_arr, context, root='', scale=[-1,3], cmap='Greys',
+                 min_mask_width=10, fig=None):
+        '''
+        Input:
+
+        image_arr = [wfc1, wfc2] images
+
+        context = shared panels from make_exposure_context
+
+        min_mask_width = minimum width shown by the profile width markers
+
+        fig = existing figure to draw in (e.g. a window), which is cleared
+        first. By default a new figure on an Agg canvas.
+        '''
+
+        # set up figure grid
+        fig = diagnostic_figure(fig)
+        fig.suptitle('Trail Diagnostic\n'+root)
+        [[p1, p2],[p3, p4]] = fig.subfigures(2,2)
+
+        p1a1, p1a2 = p1.subplots(2,1)
+        p2a1 = p2.subplots(1,1)
+        p3a1, p3a2 = p3.subplots(2,1)
+        p4a1, p4a2 = p4.subplots(2,1)
+
+        # set up images
+        image_med = context['image_med']
+        image_stddev = context['image_stddev']
+        for ax, wfc in zip([p1a1, p1a2, p3a1, p3a2], list(image_arr) * 2):
+            ax.imshow(wfc, cmap=cmap, origin='lower', aspect='auto',
+                      vmin=image_med - scale[0]*image_stddev,
+                      vmax=image_med + scale[1]*image_stddev)
+        p1a1.set_title('Image')
+
+        # trail mask overlays (bottom left). Every unmasked pixel takes the
+        # lowest colour of the map: blue for bwr, red for bwr_r
+        self.overlays = []
+        for ax, wfc in zip([p3a1, p3a2], image_arr):
+            overlay = ax.imshow(np.ma.masked_all(wfc.shape), alpha=0.75, origin='lower',
+                                aspect='auto', cmap='bwr', vmin=0, vmax=1)
+            overlay.set_visible(False)
+            self.overlays.append(overlay)
+        p3a1.set_title('Image with trail mask')
+        p3a1.text(0.01, 1.01, 'Accepted', color='blue', transform = p3a1.transAxes, fontsize='x-large', va='bottom',bbox=dict(facecolor='white', alpha=0.5))
+        p3a1.text(0.99, 1.01, 'Rejected', color='red', transform = p3a1.transAxes, fontsize='x-large', va='bottom',ha='right', bbox=dict(facecolor='white', alpha=0.5))
+
+        # the big masked image
+        self.rebinned = [ax.imshow(rebinned_masked_image, origin='lower', aspect='auto',
+                                   vmin=vmin, vmax=vmax)
+                         for ax, rebinned_masked_image, (vmin, vmax) in
+                         zip([p4a1, p4a2], context['rebinned'], context['rebinned_limits'])]
+        p4a1.set_title('Rebinned final masked image')
+
+        # the 1d profile, with its center and width
+        self.profile = ProfilePlot(p2a1, min_mask_width=min_mask_width)
+
+        self.fig = fig
+
+        # the layout is solved again for every trail, starting from the
+        # initial axes positions (as for a new figure)
+        self.positions = [(ax, ax.get_position().frozen()) for ax in fig.axes]
+
+    def update_context(self, context):
+        '''New rebinned masked images (e.g. after the masks changed)'''
+
+        for image, rebinned_masked_image, (vmin, vmax) in zip(self.rebinned,
+                                                              context['rebinned'],
+                                                              context['rebinned_limits']):
+            image.set_data(rebinned_masked_image)
+            image.set_clim(vmin, vmax)
+
+    def update(self, trail_mask_arr, row, profile, profile_hdr):
+        '''Shows a trail'''
+
+        # the trail mask
+        trail_cmap = 'bwr' if row['status'] == 2 else 'bwr_r'
+        for overlay, trail_mask in zip(self.overlays, trail_mask_arr):
+            if not np.any(trail_mask):
+                overlay.set_visible(False)
+                continue
+            overlay.set_data(np.ma.masked_where(trail_mask == 0, np.zeros(trail_mask.shape)))
+            overlay.set_cmap(trail_cmap)
+            overlay.set_visible(True)
+
+        self.profile.update(row, profile, profile_hdr)
+
+    def save(self, output_file, dpi=150):
+        for ax, position in self.positions:
+            ax.set_position(position)
+            ax.set_in_layout(True)
+        self.fig.savefig(output_file, dpi=dpi)
+
+    def render(self, trail_mask_arr, row, profile, profile_hdr, output_file=None, dpi=150):
+        '''Shows a trail and saves the figure to output_file'''
+
+        self.update(trail_mask_arr, row, profile, profile_hdr)
+        if output_file is not None:
+            self.save(output_file, dpi=dpi)
+
+
+def make_trail_diagnostic(image_arr,
+                          final_mask_arr,
+                          trail_mask_arr,
+                          row,
+                          profile,
+                          profile_hdr,
+                          big_rebin=8,
+                          scale=[-1,3],
+                          cmap='Greys', root='',
+                          output_file = None, 
+                          min_mask_width=10,
+                          overwrite=False,
+                          context=None,
+                          renderer=None):
+    '''
+    Trail diagnostic of a single trail. To make the diagnostics of many
+    trails of one exposure, pass a TrailDiagnosticRenderer (see
+    trail_renderer) as renderer so the figure is only built once.
+    '''
 
-    #plt.tight_layout()
     if output_file is not None:
-        plt.savefig(output_file, dpi=150)
+        if Path(output_file).exists() & (overwrite == False):
+            print('Output file {} already exists.'.format(output_file))
+            print('Set overwrite = True to replace it.')
+            return
+
+    if renderer is None:
+        renderer = trail_renderer(image_arr, final_mask_arr, big_rebin=big_rebin,
+                                  scale=scale, cmap=cmap, root=root,
+                                  min_mask_width=min_mask_width, context=context)
+
+    renderer.render(trail_mask_arr, row, profile, profile_hdr, output_file=output_file)
 
-    plt.close('all')
+    return renderer
+
+
+def trail_renderer(image_arr, final_mask_arr, big_rebin=8, scale=[-1,3], cmap='Greys',
+                   root='', min_mask_width=10, context=None,
+                   renderer_class=TrailDiagnosticRenderer):
+    '''TrailDiagnosticRenderer (or renderer_class, e.g.
+    fast_diagnostics.CompositeTrailRenderer) of an exposure, computing the
+    shared panels if context is not given or was made with a different
+    big_rebin'''
+
+    # shared per-exposure panels; only compute them if not supplied
+    if context is None:
+        context = make_exposure_context(image_arr, final_mask_arr,
+                                        big_rebin=big_rebin)
+    elif context['big_rebin'] != big_rebin:
+        context = make_exposure_context(image_arr, final_mask_arr,
+                                        big_rebin=big_rebin,
+                                        stats=(context['image_med'],
+                                               context['image_stddev']))
+
+    return renderer_class(image_arr, context, root=root, scale=scale, cmap=cmap,
+                          min_mask_width=min_mask_width)
 
 
 def make_image_diagnostic(image_arr,
@@ -131,17 +364,22 @@ def make_image_diagnostic(image_arr,
                           cmap='Greys',
                           output_file = None, 
                           min_mask_width=10,
-                          overwrite=False):
+                          overwrite=False,
+                          context=None,
+                          fig=None):
+    '''
+    Image diagnostic of an exposure. fig = existing figure to draw in (e.g.
+    a window); by default a new figure on an Agg canvas. Returns the figure.
+    '''
     
     if output_file is not None:
         if Path(output_file).exists() & (not overwrite):
             print('Output file {} already exists.'.format(output_file))
             print('Set overwrite = True to replace it.')
-            plt.close('all')
             return
 
     # set up figure grid
-    fig = plt.figure(figsize=(15,12), layout='constrained')
+    fig = diagnostic_figure(fig)
     fig.suptitle('Final Image Diagnostic\n' + root)
 
     [[p1, p2],[p3, p4]] = fig.subfigures(2,2)
@@ -152,49 +390,48 @@ def make_image_diagnostic(image_arr,
     p4a1, p4a2 = p4.subplots(2,1)
 
     # set up images
-    with warnings.catch_warnings():
-        warnings.filterwarnings(action='ignore',
-                                message='Input data contains invalid values (NaNs or infs), which were automatically clipped.')
-        __, image_med, image_stddev = sigma_clipped_stats(image_arr)
+    # shared per-exposure panels; only compute them if not supplied
+    if context is None:
+        context = make_exposure_context(image_arr, final_mask_arr,
+                                        big_rebin=big_rebin)
+    elif context['big_rebin'] != big_rebin:
+        context = make_exposure_context(image_arr, final_mask_arr,
+                                        big_rebin=big_rebin,
+                                        stats=(context['image_med'],
+                                               context['image_stddev']))
+    image_med = context['image_med']
+    image_stddev = context['image_stddev']
     for ax, wfc in zip([p1a1, p1a2], image_arr):
         ax.imshow(wfc, cmap=cmap, origin='lower', aspect='auto',
                     vmin=image_med - scale[0]*image_stddev,
                     vmax=image_med + scale[1]*image_stddev)
     p1a1.set_title('Image')
 
-    for ax, segment, wfc in zip([p2a1, p2a2],segment_arr, image_arr):
+    # the trails of both chips share one colormap and one colorbar. The
+    # overlays are composed as RGBA images no larger than the panels
+    label_arr, trail_labels = segment_overlay_labels(segment_arr)
+    lut = overlay_lut(len(trail_labels))
+    fig_width, fig_height = fig.get_size_inches()
+    max_shape = (int(fig_height * 150 / 4), int(fig_width * 150 / 2))
+
+    for ax, labels, wfc in zip([p2a1, p2a2], label_arr, image_arr):
 
         ax.imshow(wfc, cmap=cmap, origin='lower', aspect='auto',
             vmin=image_med - scale[0]*image_stddev,
             vmax=image_med + scale[1]*image_stddev,
             alpha=0.5)
-       # get unique values in segment
-        unique_vals = np.unique(segment)
-        data = np.zeros_like(segment)
-        counter = 1
-        for uv in unique_vals[1:]:
-            data[segment == uv] = counter
-            counter += 1
-
-        data_min = np.min(data).astype(int)
-        data_max = np.max(data).astype(int)
-
-        data_masked = np.ma.masked_where(data == 0, data)
-
-        # update the colormap to match the segmentation IDs
-        seg_cmap = plt.get_cmap('tab20', data_max - data_min + 1)
-        mat = ax.imshow(data_masked, cmap=seg_cmap, vmin=data_min - 0.5,
-                        vmax=data_max + 0.5, origin='lower', aspect='auto',
-                        alpha=0.75)
-
-        # tell the colorbar to tick at integers
-        ticks = np.arange(len(unique_vals) + 1)
-        cax = plt.colorbar(mat, ticks=ticks)
-        cax.ax.set_yticklabels(np.concatenate([unique_vals,
-                                               [unique_vals[-1] + 1]]))
-        cax.ax.set_ylabel('trail ID')
+        ax.imshow(overlay_rgba(labels, lut, max_shape=max_shape), origin='lower',
+                  aspect='auto', extent=(-0.5, wfc.shape[1] - 0.5, -0.5, wfc.shape[0] - 0.5))
         #x.set_title('Segmentation Mask')
 
+    if len(trail_labels) > 0:
+        seg_cmap = ListedColormap(lut[1:, :3])
+        mappable = ScalarMappable(norm=Normalize(vmin=0.5, vmax=len(trail_labels) + 0.5),
+                                  cmap=seg_cmap)
+        cax = p2.colorbar(mappable, ax=[p2a1, p2a2], ticks=np.arange(1, len(trail_labels) + 1))
+        cax.ax.set_yticklabels(trail_labels)
+        cax.ax.set_ylabel('trail ID')
+
     p2a1.set_title('Image with segmented mask')
 
     # # do this for the bottom left too
@@ -207,16 +444,11 @@ def make_image_diagnostic(image_arr,
     # p3a1.set_title('Image with all trails masked')
 
     # make the big masked image
-    for ax, image, final_mask in zip([p4a1, p4a2], image_arr, final_mask_arr):
-        masked_image = np.ma.masked_where(final_mask, image)
-        with warnings.catch_warnings():
-            warnings.filterwarnings(action='ignore',
-                                    message='Input data contains invalid values (NaNs or infs), which were automatically clipped.')
-            rebinned_masked_image = block_reduce(masked_image, big_rebin, func=np.nanmedian)
-            __, image_med, image_stddev = sigma_clipped_stats(rebinned_masked_image)
-
+    for ax, rebinned_masked_image, (vmin, vmax) in zip([p4a1, p4a2],
+                                                      context['rebinned'],
+                                                      context['rebinned_limits']):
         ax.imshow(rebinned_masked_image, origin='lower', aspect='auto',
-                  vmin=image_med - image_stddev, vmax = image_med + 5*image_stddev)
+                  vmin=vmin, vmax=vmax)
     p4a1.set_title('Rebinned final masked image')
 
     # load all available profiles and plot; including their widths
@@ -224,23 +456,18 @@ def make_image_diagnostic(image_arr,
         print(len(catalog))
         if len(catalog) > 0:
 
+            profiles = ProfileStore(satdir, root, ext)
+
             xlow = 0
             xhigh = 0
             for row in catalog:
                 if row['status'] == 2:
                     # load the 1d profile and header, then plot
-                    prof_dir = Path.joinpath(Path(satdir), '{}_ext{}_mrt/'.format(root, ext))
-
-                    #profile_file = '{}{}_ext{}_mrt_1dprof_{}.fits'.format(prof_dir, root, ext, row['id'])
-                    profile_file = Path.joinpath(prof_dir,
-                                                 '{}_ext{}_mrt_1dprof_{}.fits'.format(root, ext, row['id']))
-                    
-                    if not profile_file.exists():
-                        print('Profile file {} missing. Skipping'.format(str(profile_file)))
+                    if not profiles.has(row['id']):
+                        print('Profile of trail {} (ext {}) missing. Skipping'.format(row['id'], ext))
                         continue
 
-                    prof = fits.getdata(profile_file)
-                    prof_hdr = fits.getheader(profile_file)
+                    prof, prof_hdr = profiles.read(row['id'])
 
                     # show the 1d profile
                     xarr = np.arange(len(prof)) - prof_hdr['center']
@@ -273,9 +500,9 @@ def make_image_diagnostic(image_arr,
 
     #plt.tight_layout()
     if output_file is not None:
-            plt.savefig(output_file, dpi=150)
+            fig.savefig(output_file, dpi=150)
 
-    plt.close('all')
+    return fig
 
 if __name__ == '__main__':
 
@@ -287,15 +514,9 @@ if __name__ == '__main__':
 
     image_file = '/Users/dstark/supercal/09575/{}.fits'.format(root)
 
-    # load image file
-    hdu = fits.open(image_file)
-    with warnings.catch_warnings():
-        warnings.filterwarnings(action='ignore',
-                                message='Input data contains invalid values (NaNs or infs), which were automatically clipped.')
-        wfc1 = block_reduce(hdu[4].data, 4, func=np.nansum)
-        wfc2 = block_reduce(hdu[1].data, 4, func=np.nansum)
-
-    hdu.close()
+    # load image file (rebinned, from the shared cache if possible)
+    wfc1, wfc2 = load_rebinned_chips(image_file, 4,
+                                     sat_dir='/Users/dstark/supercal/09575/satellites')
     image_arr = [wfc1, wfc2]
 
     catalog_file = '/Users/dstark/supercal/09575/satellites/{}_ext4_mrt_catalog.fits'.format(root)
@@ -304,8 +525,8 @@ if __name__ == '__main__':
     ext=4
     segmentation_file_4 = '/Users/dstark/supercal/09575/satellites/{}_ext4_mrt_segment.fits'.format(root)
     segmentation_file_1 = '/Users/dstark/supercal/09575/satellites/{}_ext1_mrt_segment.fits'.format(root)
-    segment_wfc1 = fits.getdata(segmentation_file_4)
-    segment_wfc2 = fits.getdata(segmentation_file_1)
+    segment_wfc1, __ = read_segment(segmentation_file_4)
+    segment_wfc2, __ = read_segment(segmentation_file_1)
     segment_arr = [segment_wfc1, segment_wfc2]
 
     # load the catalogs for each chip too
@@ -321,10 +542,8 @@ if __name__ == '__main__':
     else:
         image = wfc2
 
-    trail_seg, trail_mask = u.create_mask(image, [row['id']],
-                                        [row['endpoints']], 
-                                        [row['width']], 
-                                        min_mask_width=40/image_rebin)
+    trail_mask = trail_footprint(image.shape, row['endpoints'], row['width'],
+                                 min_mask_width=40/image_rebin)
 
     if ext == 4:
         trail_mask_wfc1 = trail_mask
@@ -339,8 +558,8 @@ if __name__ == '__main__':
     mask_arr = [segment_wfc1 > 0, segment_wfc2 > 0]
 
     # load the 1d trail profile and its header
-    profile = fits.getdata('/Users/dstark/supercal/09575/satellites/{}_ext{}_mrt/{}_ext{}_mrt_1dprof_{}.fits'.format(root, ext, root, ext, row['id']))
-    profile_hdr = fits.getheader('/Users/dstark/supercal/09575/satellites/{}_ext{}_mrt/{}_ext{}_mrt_1dprof_{}.fits'.format(root, ext, root, ext, row['id']))
+    profile, profile_hdr = ProfileStore('/Users/dstark/supercal/09575/satellites/',
+                                        root, ext).read(row['id'])
 
     root = image_file.split('/')[-1].split('.fits')[0]
     sat_dir = '/Users/dstark/supercal/09575/satellites/'
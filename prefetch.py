@@ -0,0 +1,201 @@
+'''
+Background prefetching of the next exposures during interactive review.
+
+While the reviewer looks at a diagnostic, a worker thread loads the next
+exposure(s): the ImageSession products of both chips (images, catalogs,
+masks, segmentation maps) and the 1D trail profiles. Moving on to a
+prefetched exposure then needs no disk access (the diagnostics are drawn
+from these, see diagnostic_windows). Prefetched data is capped at
+max_bytes, and pending prefetches can be cancelled (e.g. when the reviewer
+jumps to a different image).
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from pathlib import Path
+
+from profile_store import ProfileStore
+from image_session import ImageSession, product_names
+
+
+class PrefetchCancelled(Exception):
+    pass
+
+
+def _nbytes(value):
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if hasattr(value, 'as_array'):
+        return int(value.as_array().nbytes)
+    return 0
+
+
+class PrefetchedExposure:
+    '''Everything loaded ahead of time for one exposure'''
+
+    def __init__(self, root, session):
+        self.root = root
+        self.session = session
+        # {(ext, trail id): (profile, header)}
+        self.profiles = {}
+        self.nbytes = 0
+
+    def add(self, store, key, value):
+        store[key] = value
+        if isinstance(value, tuple):
+            self.nbytes += sum(_nbytes(v) for v in value)
+        else:
+            self.nbytes += _nbytes(value)
+
+    def profile(self, ext, trail_id):
+        return self.profiles.get((ext, int(trail_id)))
+
+
+class ExposurePrefetcher:
+    def __init__(self, sat_dir, image_dir=None, max_bytes=1.5 * 1024**3,
+                 min_allowed_status=-1):
+        '''
+        Input:
+
+        sat_dir = directory containing the findsat_mrt output
+
+        image_dir = directory containing the images (defaults to parent
+        of sat_dir)
+
+        max_bytes = maximum memory used by prefetched exposures
+
+        min_allowed_status = trails with status below this (and >= 0) are
+        not shown by the inspector, so their files are not prefetched
+        '''
+
+        self.sat_dir = Path(sat_dir)
+        self.image_dir = self.sat_dir.parents[0] if image_dir is None else Path(image_dir)
+        self.max_bytes = max_bytes
+        self.min_allowed_status = min_allowed_status
+
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._cancel_events = {}
+        # sizes of the products of the last exposure loaded ({ext: chip
+        # products, 'images': both rebinned images}), as estimates for the
+        # next one
+        self._step_bytes = {}
+
+    def _used_bytes(self, exclude=None):
+        used = 0
+        with self._lock:
+            futures = list(self._futures.items())
+        for root, future in futures:
+            if root == exclude or not future.done() or future.cancelled():
+                continue
+            if (future.exception() is None) and (future.result() is not None):
+                used += future.result().nbytes
+        return used
+
+    def _load(self, root, cancel):
+        '''Runs in the worker thread'''
+
+        def check():
+            if cancel.is_set():
+                raise PrefetchCancelled(root)
+
+        # the products are loaded in steps (each chip, then the images),
+        # stopping before a step that would not fit in the budget (judging
+        # by the last exposure). Nothing is returned if not even the first
+        # step fits; a partly loaded session is still usable, it loads the
+        # rest on first use
+        budget = self.max_bytes - self._used_bytes(exclude=root)
+        if budget <= self._step_bytes.get(4, 0):
+            return None
+
+        session = ImageSession(root, self.sat_dir, image_dir=self.image_dir)
+        exposure = PrefetchedExposure(root, session)
+
+        def load_step(step, load):
+            check()
+            if exposure.nbytes + self._step_bytes.get(step, 0) > budget:
+                return False
+            nbytes = load()
+            exposure.nbytes += nbytes
+            self._step_bytes[step] = nbytes
+            return exposure.nbytes < budget
+
+        for ext in [4, 1]:
+            if not load_step(ext, lambda: sum(_nbytes(session.get(ext, name))
+                                              for name in product_names)):
+                return exposure
+        if not load_step('images', lambda: sum(_nbytes(session.image(ext))
+                                               for ext in [4, 1])):
+            return exposure
+
+        # the trail profiles, in the order they will be viewed (ext 4, then
+        # ext 1)
+        for ext in [4, 1]:
+            profiles = ProfileStore(self.sat_dir, root, ext)
+            for row in session.get(ext, 'catalog'):
+                if (row['status'] < self.min_allowed_status) & (row['status'] >= 0):
+                    continue
+                if exposure.nbytes >= budget:
+                    return exposure
+                check()
+
+                if profiles.has(row['id']):
+                    exposure.add(exposure.profiles, (ext, int(row['id'])),
+                                 profiles.read(row['id']))
+
+        return exposure
+
+    def prefetch(self, roots):
+        '''Starts loading the given roots (in order) in the background.
+        Anything previously prefetched for other roots is dropped.'''
+
+        roots = [str(r) for r in roots]
+        with self._lock:
+            for root in list(self._futures):
+                if root not in roots:
+                    self._drop(root)
+            for root in roots:
+                if root in self._futures:
+                    continue
+                cancel = threading.Event()
+                self._cancel_events[root] = cancel
+                self._futures[root] = self._pool.submit(self._load, root, cancel)
+
+    def _drop(self, root):
+        self._cancel_events.pop(root).set()
+        self._futures.pop(root).cancel()
+
+    def cancel(self):
+        '''Cancels all pending prefetches and drops prefetched data'''
+
+        with self._lock:
+            for root in list(self._futures):
+                self._drop(root)
+
+    def take(self, root):
+        '''
+        Returns the PrefetchedExposure for root, or None if it was not
+        prefetched (did not fit in max_bytes, or failed). Waits if it is
+        still loading, since that is quicker than starting over.
+        '''
+
+        root = str(root)
+        with self._lock:
+            future = self._futures.pop(root, None)
+            self._cancel_events.pop(root, None)
+
+        if future is None:
+            return None
+
+        try:
+            return future.result()
+        except (CancelledError, PrefetchCancelled):
+            return None
+        except Exception as e:
+            print('Prefetch of {} failed ({}); loading it directly'.format(root, e))
+            return None
+
+    def shutdown(self):
+        self.cancel()
+        self._pool.shutdown(wait=False)
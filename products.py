@@ -0,0 +1,147 @@
+'''
+Shared, single-open access to the FITS products.
+
+Reading a profile used to take two opens (fits.getdata, then fits.getheader)
+and the same catalogs, masks and images were reopened on every edit. On a
+networked filesystem each open costs tens of milliseconds. A ProductReader
+keeps files open (memory-mapped, with HDUs loaded lazily) and hands back
+data and header together. A file that changed on disk since it was opened
+is reopened automatically; code that writes a product should also call
+invalidate() for it.
+
+All modules use the shared reader through the module-level functions
+(read, read_header, read_table, reduce, extension_count, invalidate). The
+open files themselves are never handed out: another thread can close one
+at any time (to make room for others, or because it changed on disk), so
+everything that touches an HDUList is done while holding the lock.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+# number of files kept open at once
+max_open_files = 64
+
+
+class ProductReader:
+    def __init__(self, memmap=True, max_open=max_open_files):
+        self.memmap = memmap
+        self.max_open = max_open
+
+        # {path: (signature, HDUList)}, least recently used first
+        self._open = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _hdul(self, path):
+        '''The open HDUList for path. Only valid while the lock is held.'''
+
+        path = os.fspath(path)
+        signature = self._signature(path)
+
+        with self._lock:
+            if path in self._open:
+                cached_signature, hdul = self._open[path]
+                if cached_signature == signature:
+                    self._open.move_to_end(path)
+                    return hdul
+                self._close(path)
+
+            hdul = fits.open(path, memmap=self.memmap, lazy_load_hdus=True)
+            self._open[path] = (signature, hdul)
+            while len(self._open) > self.max_open:
+                self._close(next(iter(self._open)))
+
+        return hdul
+
+    def _close(self, path):
+        signature, hdul = self._open.pop(path)
+        hdul.close()
+
+    def read(self, path, ext=0, copy=True):
+        '''
+        Returns (data, header) of one extension from a single open.
+
+        copy = if False, the data may be memory-mapped to the file; only use
+        that for data that is not kept past the next write to the file.
+        '''
+
+        with self._lock:
+            hdu = self._hdul(path)[ext]
+            data = hdu.data
+            header = hdu.header.copy()
+            if copy and data is not None:
+                data = np.array(data)
+
+        return data, header
+
+    def read_header(self, path, ext=0):
+        with self._lock:
+            return self._hdul(path)[ext].header.copy()
+
+    def reduce(self, path, func, ext=0):
+        '''
+        Returns func(data) for the data of one extension, without copying
+        the data first (e.g. to rebin a large image). func is called with
+        the file held open, so it must not keep a reference to the data.
+        '''
+
+        with self._lock:
+            return func(self._hdul(path)[ext].data)
+
+    def extension_count(self, path):
+        with self._lock:
+            return len(self._hdul(path))
+
+    def read_table(self, path, ext=1):
+        '''A (copied) Table from a table extension'''
+
+        with self._lock:
+            return Table(Table.read(self._hdul(path)[ext]), copy=True)
+
+    def invalidate(self, path=None):
+        '''Closes path (or every file), so the next read reopens it'''
+
+        with self._lock:
+            if path is None:
+                for p in list(self._open):
+                    self._close(p)
+            elif os.fspath(path) in self._open:
+                self._close(os.fspath(path))
+
+
+# reader shared by everything in this process
+reader = ProductReader()
+
+
+def read(path, ext=0, copy=True):
+    return reader.read(path, ext=ext, copy=copy)
+
+
+def read_header(path, ext=0):
+    return reader.read_header(path, ext=ext)
+
+
+def read_table(path, ext=1):
+    return reader.read_table(path, ext=ext)
+
+
+def reduce(path, func, ext=0):
+    return reader.reduce(path, func, ext=ext)
+
+
+def extension_count(path):
+    return reader.extension_count(path)
+
+
+def invalidate(path=None):
+    reader.invalidate(path)
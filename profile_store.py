@@ -0,0 +1,239 @@
+'''
+Storage of the 1D trail profiles.
+
+findsat_mrt writes each trail's profile to its own file,
+<root>_ext{N}_mrt/<root>_ext{N}_mrt_1dprof_{id}.fits. For exposures with
+thousands of candidate trails that means tens of thousands of tiny files.
+The packed format instead keeps all profiles of one chip in a single file,
+<root>_ext{N}_mrt_profiles.fits, with one table row per trail: the trail id,
+the profile (variable length), the center/width/snr/avgflux values and the
+full original header.
+
+A ProfileStore reads and writes the profiles of one chip in whichever
+format is present: the packed file if it exists, otherwise the legacy
+per-trail files. Run this module on a satellites directory to convert it
+to the packed format.
+'''
+
+import os
+import sys
+import glob
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+import products
+from fingerprints import digest
+
+# header values also stored as table columns
+header_columns = ['center', 'width', 'snr', 'avgflux']
+
+
+def legacy_profile_path(sat_dir, root, ext, trail_id):
+    return Path.joinpath(Path(sat_dir), '{}_ext{}_mrt'.format(root, ext),
+                         '{}_ext{}_mrt_1dprof_{}.fits'.format(root, ext, trail_id))
+
+
+def packed_profile_path(sat_dir, root, ext):
+    return Path.joinpath(Path(sat_dir), '{}_ext{}_mrt_profiles.fits'.format(root, ext))
+
+
+class ProfileStore:
+    def __init__(self, sat_dir, root, ext, index=None):
+        '''
+        Input:
+
+        sat_dir = directory containing the findsat_mrt output
+
+        root = image root name
+
+        ext = chip extension (4 or 1)
+
+        index = optional SatelliteIndex of sat_dir, used to look up which
+        files exist
+        '''
+
+        self.sat_dir = Path(sat_dir)
+        self.root = root
+        self.ext = ext
+        self.path = packed_profile_path(sat_dir, root, ext)
+        self.index = index
+
+        # {trail id: (profile, header)} from the packed file (None if the
+        # chip uses the legacy files)
+        self._packed = None
+        if self._exists(self.path):
+            self._packed = self._read_packed()
+
+    @property
+    def packed(self):
+        return self._packed is not None
+
+    def _exists(self, path):
+        if self.index is not None:
+            return self.index.exists(path)
+        return path.exists()
+
+    def _remove(self, path):
+        os.remove(path)
+        products.invalidate(path)
+        if self.index is not None:
+            self.index.forget(path)
+
+    def legacy_path(self, trail_id):
+        return legacy_profile_path(self.sat_dir, self.root, self.ext, trail_id)
+
+    def _read_packed(self):
+        tbl = products.read_table(self.path)
+        profiles = {}
+        for row in tbl:
+            header = fits.Header.fromstring(row['header'])
+            profiles[int(row['id'])] = (np.array(row['profile'], dtype=float), header)
+
+        return profiles
+
+    def _write_packed(self):
+        ids = sorted(self._packed)
+        headers = [self._packed[i][1].tostring(padding=False) for i in ids]
+        columns = [fits.Column(name='id', format='K', array=np.array(ids, dtype=int)),
+                   fits.Column(name='profile', format='PD()',
+                               array=[np.asarray(self._packed[i][0], dtype=float) for i in ids])]
+        for name in header_columns:
+            columns.append(fits.Column(name=name, format='D',
+                                       array=[float(self._packed[i][1].get(name, np.nan))
+                                              for i in ids]))
+        width = max([len(h) for h in headers] + [1])
+        columns.append(fits.Column(name='header', format='{}A'.format(width),
+                                   array=np.array(headers, dtype='U{}'.format(width))))
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(columns)])
+
+        # write to a temporary file and move it into place, so readers
+        # never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')
+        os.close(fd)
+        try:
+            hdul.writeto(tmp, overwrite=True)
+            os.chmod(tmp, 0o664)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        products.invalidate(self.path)
+
+    def ids(self):
+        if self.packed:
+            return sorted(self._packed)
+
+        pattern = str(self.legacy_path('*'))
+        return sorted(int(f.split('_1dprof_')[-1].split('.fits')[0])
+                      for f in glob.glob(pattern))
+
+    def has(self, trail_id):
+        if self.packed:
+            return int(trail_id) in self._packed
+
+        return self._exists(self.legacy_path(trail_id))
+
+    def read(self, trail_id):
+        '''Returns (profile, header) of a trail. Raises FileNotFoundError if
+        there is no profile for it.'''
+
+        if self.packed:
+            if int(trail_id) not in self._packed:
+                raise FileNotFoundError('No profile for trail {} in {}'.format(trail_id, self.path))
+            profile, header = self._packed[int(trail_id)]
+            return profile.copy(), header.copy()
+
+        return products.read(self.legacy_path(trail_id))
+
+    def file_path(self, trail_id):
+        '''The file the profile of a trail is (or would be) stored in'''
+
+        if self.packed:
+            return self.path
+        return self.legacy_path(trail_id)
+
+    def signature(self, trail_id):
+        '''Something that changes whenever the profile of a trail changes
+        (None if there is no profile)'''
+
+        if self.packed:
+            if int(trail_id) not in self._packed:
+                return None
+            profile, header = self._packed[int(trail_id)]
+            return digest(profile, header.tostring())
+
+        try:
+            stat = os.stat(self.legacy_path(trail_id))
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def write(self, trail_id, profile, header):
+        if self.packed:
+            self._packed[int(trail_id)] = (np.array(profile, dtype=float), header.copy())
+            self._write_packed()
+        else:
+            path = self.legacy_path(trail_id)
+            fits.writeto(path, profile, header=header, overwrite=True)
+            products.invalidate(path)
+
+    def remove(self, trail_id):
+        if self.packed:
+            if self._packed.pop(int(trail_id), None) is not None:
+                self._write_packed()
+        else:
+            path = self.legacy_path(trail_id)
+            if path.exists():
+                self._remove(path)
+            else:
+                products.invalidate(path)
+
+    def pack(self, remove_legacy=False):
+        '''Converts this chip from legacy files to the packed format'''
+
+        if self.packed:
+            return 0
+
+        ids = self.ids()
+        self._packed = {}
+        for trail_id in ids:
+            profile, header = products.read(self.legacy_path(trail_id))
+            self._packed[trail_id] = (np.array(profile, dtype=float), header)
+        self._write_packed()
+
+        # check the packed file before removing anything
+        check = self._read_packed()
+        for trail_id in ids:
+            if not np.array_equal(check[trail_id][0], self._packed[trail_id][0],
+                                  equal_nan=True):
+                raise RuntimeError('Packed profile of trail {} in {} does not '
+                                   'match the original'.format(trail_id, self.path))
+
+        if remove_legacy:
+            for trail_id in ids:
+                self._remove(self.legacy_path(trail_id))
+
+        return len(ids)
+
+
+def convert_directory(sat_dir, remove_legacy=False):
+    '''Packs the profiles of every exposure/chip in sat_dir. Chips already
+    packed are left alone. The legacy files are kept unless
+    remove_legacy=True.'''
+
+    catalogs = sorted(glob.glob(str(Path.joinpath(Path(sat_dir), '*_ext?_mrt_catalog.fits'))))
+    for catalog in catalogs:
+        name = Path(catalog).name
+        root = name[:-len('_ext4_mrt_catalog.fits')]
+        ext = int(name[-len('4_mrt_catalog.fits')])
+        store = ProfileStore(sat_dir, root, ext)
+        n = store.pack(remove_legacy=remove_legacy)
+        print('{} ext {}: packed {} profiles'.format(root, ext, n))
+
+
+if __name__ == '__main__':
+    convert_directory(sys.argv[1])
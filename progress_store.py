@@ -0,0 +1,377 @@
+'''
+Inspection progress of a satellites directory.
+
+The progress used to be kept in inspection_progress.csv, rewritten in full
+on every status change, with the last image looked at in a separate
+_left_off.txt. A ProgressStore keeps both in an SQLite database in the
+satellites directory instead: one row per exposure with its status, the
+reviewer and time of the last change, and the last chip/trail looked at.
+Every update is a single transaction, so a crash never leaves a half
+written file behind.
+
+An existing inspection_progress.csv / _left_off.txt is imported the first
+time the store is opened. export_csv() writes the CSV again (done when
+inspect_sat_masks exits).
+
+Several reviewers can work through the same directory at once: each
+inspection session claims the exposure it works on (claim_next / claim),
+so no two sessions edit the same exposure. Claims are kept alive by a
+ClaimHeartbeat while the session runs and expire claim_timeout seconds
+after the last heartbeat, e.g. when a session crashed.
+'''
+
+import os
+import time
+import socket
+import getpass
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table
+
+progress_name = '_inspection_progress.sqlite'
+csv_name = 'inspection_progress.csv'
+left_off_name = '_left_off.txt'
+
+schema = '''
+create table if not exists progress (
+    root text primary key,
+    status text not null default 'pending',
+    reviewer text,
+    updated real,
+    ext integer,
+    trail_index integer,
+    trail_id integer,
+    visited real,
+    claimed_by text,
+    claimed_at real
+);
+'''
+
+# columns added after the first version of the table
+added_columns = {'claimed_by': 'text', 'claimed_at': 'real'}
+
+# claims expire this many seconds after the last heartbeat
+claim_timeout = 30 * 60
+
+
+def default_reviewer():
+    try:
+        return getpass.getuser()
+    except Exception:
+        return None
+
+
+def session_id(reviewer=None):
+    '''Identifies one inspection session (reviewer, host and process)'''
+
+    if reviewer is None:
+        reviewer = default_reviewer()
+
+    return '{}@{}-{}'.format(reviewer, socket.gethostname(), os.getpid())
+
+
+class ProgressStore:
+    def __init__(self, sat_dir, reviewer=None):
+        '''
+        Input:
+
+        sat_dir = directory containing the findsat_mrt output
+
+        reviewer = name recorded with every change (defaults to the login
+        name)
+        '''
+
+        self.sat_dir = Path(sat_dir)
+        self.reviewer = reviewer if reviewer is not None else default_reviewer()
+        self.path = Path.joinpath(self.sat_dir, progress_name)
+
+        new = not self.path.exists()
+        self.db = sqlite3.connect(str(self.path), timeout=30)
+        self.db.executescript(schema)
+        self._add_columns()
+        if new:
+            self._import_legacy()
+
+    def _add_columns(self):
+        columns = [row[1] for row in self.db.execute('pragma table_info(progress)')]
+        with self.db:
+            for name, kind in added_columns.items():
+                if name not in columns:
+                    self.db.execute('alter table progress add column {} {}'.format(name, kind))
+
+    def close(self):
+        self.db.close()
+
+    def _import_legacy(self):
+        '''Imports inspection_progress.csv and _left_off.txt, if present'''
+
+        csv_file = Path.joinpath(self.sat_dir, csv_name)
+        left_off_file = Path.joinpath(self.sat_dir, left_off_name)
+
+        with self.db:
+            if csv_file.exists():
+                progress = Table.read(csv_file)
+                updated = os.path.getmtime(csv_file)
+                self.db.executemany(
+                    'insert or replace into progress (root, status, updated) values (?, ?, ?)',
+                    [(str(root), str(status), updated) for root, status in
+                     zip(progress['files'], progress['status'])])
+
+            if left_off_file.exists():
+                with open(left_off_file) as f:
+                    root = f.readline().strip()
+                if len(root) > 0:
+                    self.db.execute('insert or ignore into progress (root) values (?)', (root,))
+                    self.db.execute('update progress set visited = ? where root = ?',
+                                    (os.path.getmtime(left_off_file), root))
+
+    def add_roots(self, roots):
+        '''Adds exposures (as pending) that are not in the store yet'''
+
+        with self.db:
+            self.db.executemany('insert or ignore into progress (root) values (?)',
+                                [(str(root),) for root in roots])
+
+    def _available(self, session, roots=None, timeout=claim_timeout):
+        '''Pending exposures that are not claimed by another session'''
+
+        rows = self.db.execute(
+            "select root from progress where status = 'pending' and "
+            '(claimed_by is null or claimed_by = ? or claimed_at < ?) order by root',
+            (session, time.time() - timeout))
+        available = [row[0] for row in rows]
+
+        if roots is not None:
+            available = set(available)
+            available = [str(root) for root in roots if str(root) in available]
+
+        return available
+
+    def _transaction(self, func):
+        '''Runs func inside a transaction that holds the write lock from the
+        start, so two sessions can never both claim the same exposure'''
+
+        self.db.execute('begin immediate')
+        try:
+            result = func()
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+        return result
+
+    def _set_claim(self, root, session):
+        self.db.execute('update progress set claimed_by = ?, claimed_at = ?, reviewer = ? '
+                        'where root = ?', (session, time.time(), self.reviewer, str(root)))
+
+    def claim_next(self, session, roots=None, timeout=claim_timeout):
+        '''
+        Claims the first pending exposure (in the order of roots, if given)
+        that no other session holds a live claim on. Returns its root, or
+        None if there is nothing left.
+        '''
+
+        def claim():
+            available = self._available(session, roots=roots, timeout=timeout)
+            if len(available) == 0:
+                return None
+            self._set_claim(available[0], session)
+            return available[0]
+
+        return self._transaction(claim)
+
+    def claim(self, root, session, timeout=claim_timeout):
+        '''Claims a specific exposure, whatever its status. Returns False if
+        another session holds a live claim on it.'''
+
+        def claim():
+            holder = self.claimed_by(root, timeout=timeout)
+            if (holder is not None) and (holder != session):
+                return False
+            self.db.execute('insert or ignore into progress (root) values (?)', (str(root),))
+            self._set_claim(root, session)
+            return True
+
+        return self._transaction(claim)
+
+    def claimed_by(self, root, timeout=claim_timeout):
+        '''The session holding a live claim on root, or None'''
+
+        row = self.db.execute('select claimed_by from progress where root = ? and '
+                              'claimed_by is not null and claimed_at >= ?',
+                              (str(root), time.time() - timeout)).fetchone()
+        return None if row is None else row[0]
+
+    def holds(self, root, session, timeout=claim_timeout):
+        return self.claimed_by(root, timeout=timeout) == session
+
+    def release(self, root, session):
+        with self.db:
+            self.db.execute('update progress set claimed_by = null, claimed_at = null '
+                            'where root = ? and claimed_by = ?', (str(root), session))
+
+    def release_all(self, session, keep=None):
+        '''Releases every claim of a session, except on keep'''
+
+        with self.db:
+            self.db.execute('update progress set claimed_by = null, claimed_at = null '
+                            'where claimed_by = ? and root is not ?', (session, keep))
+
+    def upcoming(self, session, roots=None, exclude=None, n=1, timeout=claim_timeout):
+        '''The exposures claim_next would most likely hand out next'''
+
+        available = self._available(session, roots=roots, timeout=timeout)
+
+        return [root for root in available if root != exclude][:n]
+
+    def set_status(self, root, status):
+        with self.db:
+            self.db.execute(
+                'insert into progress (root, status, reviewer, updated) values (?, ?, ?, ?) '
+                'on conflict(root) do update set status = excluded.status, '
+                'reviewer = excluded.reviewer, updated = excluded.updated',
+                (str(root), status, self.reviewer, time.time()))
+
+    def status(self, root):
+        row = self.db.execute('select status from progress where root = ?',
+                              (str(root),)).fetchone()
+        return None if row is None else row[0]
+
+    def set_position(self, root, ext, trail_index=None, trail_id=None):
+        '''Records the chip/trail being looked at'''
+
+        if trail_index is not None:
+            trail_index = int(trail_index)
+        if trail_id is not None:
+            trail_id = int(trail_id)
+
+        with self.db:
+            self.db.execute(
+                'insert into progress (root, reviewer, ext, trail_index, trail_id, visited) '
+                'values (?, ?, ?, ?, ?, ?) '
+                'on conflict(root) do update set reviewer = excluded.reviewer, '
+                'ext = excluded.ext, trail_index = excluded.trail_index, '
+                'trail_id = excluded.trail_id, visited = excluded.visited',
+                (str(root), self.reviewer, int(ext), trail_index, trail_id, time.time()))
+
+    def left_off(self, reviewer=None):
+        '''
+        The exposure looked at last (by reviewer, if given) as a dictionary
+        with root, ext, trail_index and trail_id, or None.
+        '''
+
+        query = 'select root, ext, trail_index, trail_id from progress where visited is not null'
+        args = ()
+        if reviewer is not None:
+            query += ' and reviewer = ?'
+            args = (reviewer,)
+        row = self.db.execute(query + ' order by visited desc limit 1', args).fetchone()
+        if row is None:
+            return None
+
+        return dict(zip(['root', 'ext', 'trail_index', 'trail_id'], row))
+
+    def roots(self, status=None, min_trails=None, min_good=None, index=None):
+        '''
+        Sorted exposures, optionally only those with the given status (or
+        list of statuses). min_trails / min_good select exposures with more
+        than that many trails / good (status 2) trails over both chips;
+        these need the SatelliteIndex of the directory.
+
+        e.g. pending images with more than 5 trails:
+            store.roots(status='pending', min_trails=5, index=index)
+        '''
+
+        query = 'select p.root from progress p'
+        conditions = []
+        args = []
+
+        if (min_trails is not None) or (min_good is not None):
+            if index is None:
+                raise ValueError('Selecting on trail counts needs a SatelliteIndex')
+            self._attach(index)
+            query += (' join (select root, sum(n_trails) as n_trails, sum(n_good) as n_good '
+                      'from idx.catalogs group by root) c on c.root = p.root')
+            if min_trails is not None:
+                conditions.append('c.n_trails > ?')
+                args.append(min_trails)
+            if min_good is not None:
+                conditions.append('c.n_good > ?')
+                args.append(min_good)
+
+        if status is not None:
+            statuses = [status] if isinstance(status, str) else list(status)
+            conditions.append('p.status in ({})'.format(', '.join('?' * len(statuses))))
+            args.extend(statuses)
+
+        if len(conditions) > 0:
+            query += ' where ' + ' and '.join(conditions)
+
+        return [row[0] for row in self.db.execute(query + ' order by p.root', args)]
+
+    def _attach(self, index):
+        attached = [row[1] for row in self.db.execute('pragma database_list')]
+        if 'idx' not in attached:
+            self.db.execute('attach database ? as idx', (index.path,))
+
+    def table(self):
+        '''The progress as an astropy Table'''
+
+        rows = self.db.execute('select root, status, reviewer, updated, ext, trail_index, '
+                               'trail_id, visited from progress order by root').fetchall()
+        names = ['files', 'status', 'reviewer', 'updated', 'ext', 'trail_index',
+                 'trail_id', 'visited']
+        if len(rows) == 0:
+            return Table(names=names, dtype=[str, str, str, float, int, int, int, float])
+
+        columns = list(zip(*rows))
+        tbl = Table()
+        for name, column in zip(names, columns):
+            if name in ['files', 'status', 'reviewer']:
+                tbl[name] = np.array(['' if v is None else v for v in column])
+            else:
+                tbl[name] = np.array([np.nan if v is None else v for v in column], dtype=float)
+
+        return tbl
+
+    def export_csv(self, path=None):
+        '''Writes the progress to inspection_progress.csv (or path)'''
+
+        if path is None:
+            path = Path.joinpath(self.sat_dir, csv_name)
+        self.table().write(path, overwrite=True)
+
+
+class ClaimHeartbeat:
+    '''Renews the claims of a session every interval seconds from a
+    background thread (with its own database connection)'''
+
+    def __init__(self, store, session, interval=60):
+        self.path = str(store.path)
+        self.session = session
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    with db:
+                        db.execute('update progress set claimed_at = ? where claimed_by = ?',
+                                   (time.time(), self.session))
+                except sqlite3.OperationalError:
+                    # database busy; try again next time
+                    pass
+        finally:
+            db.close()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
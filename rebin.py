@@ -0,0 +1,209 @@
+'''
+Fast block rebinning of (masked) images.
+
+These replace astropy's block_reduce with func=np.nansum or np.nanmedian.
+Rather than handing a 4D view to a generic reduction function, the image is
+reshaped so each block is a contiguous row, masked pixels and NaNs are
+handled directly, and the sum/median is computed in one vectorized pass.
+Like block_reduce, rows/columns that do not fill a whole block are trimmed
+from the end of each axis.
+'''
+
+import time
+import warnings
+
+import numpy as np
+
+
+def _prepare(image, factor, mask=None, dtype=None):
+    '''Trims the image to a multiple of factor and returns the data (as
+    float) along with a boolean array of valid pixels (None if all valid).'''
+
+    if np.ma.isMaskedArray(image):
+        image_mask = np.ma.getmaskarray(image)
+        mask = image_mask if mask is None else (image_mask | mask)
+        image = image.data
+
+    if dtype is None:
+        dtype = image.dtype if np.issubdtype(image.dtype, np.floating) else np.float64
+    data = np.asarray(image, dtype=dtype)
+
+    ny = (data.shape[0] // factor) * factor
+    nx = (data.shape[1] // factor) * factor
+    data = data[:ny, :nx]
+
+    invalid = np.isnan(data)
+    if mask is not None:
+        invalid |= np.asarray(mask, dtype=bool)[:ny, :nx]
+    if not invalid.any():
+        invalid = None
+
+    return data, invalid
+
+
+def _as_block_rows(arr, factor):
+    '''Reshapes (ny, nx) to (ny/factor, nx/factor, factor*factor) so each
+    block is a contiguous row.'''
+
+    ny, nx = arr.shape
+    blocks = arr.reshape(ny // factor, factor, nx // factor, factor)
+    blocks = blocks.transpose(0, 2, 1, 3)
+
+    return blocks.reshape(ny // factor, nx // factor, factor * factor)
+
+
+def block_sum(image, factor, mask=None, dtype=None):
+    '''
+    NaN-aware block sum. Equivalent to block_reduce(image, factor,
+    func=np.nansum), with masked pixels treated like NaNs (i.e. ignored).
+
+    Input:
+
+    image = 2D array (may be a numpy masked array)
+
+    factor = integer block size
+
+    mask = optional boolean array; True pixels are excluded
+
+    dtype = output/working dtype (e.g. np.float32). Defaults to the input
+    float type, or float64 for integer input.
+    '''
+
+    factor = int(factor)
+    data, invalid = _prepare(image, factor, mask=mask, dtype=dtype)
+
+    if invalid is not None:
+        data = np.where(invalid, 0, data)
+
+    # sum groups of rows (contiguous), then add the strided columns. This
+    # avoids reducing over a tiny innermost axis, which numpy does slowly
+    ny, nx = data.shape
+    row_sum = data.reshape(ny // factor, factor, nx).sum(axis=1)
+    binned = row_sum[:, 0::factor].copy()
+    for k in range(1, factor):
+        binned += row_sum[:, k::factor]
+
+    return binned
+
+
+def _median_of_sorted(rows, counts):
+    '''Median of the first counts[i] entries of each (sorted) row. Rows with
+    no valid entries return NaN.'''
+
+    lo = np.maximum((counts - 1) // 2, 0)
+    hi = np.maximum(counts // 2, 0)
+    lo_val = np.take_along_axis(rows, lo[..., None], axis=-1)[..., 0]
+    hi_val = np.take_along_axis(rows, hi[..., None], axis=-1)[..., 0]
+
+    with warnings.catch_warnings():
+        # inf - inf can come up in blocks that contain real infinities
+        warnings.filterwarnings(action='ignore', message='invalid value encountered')
+        median = lo_val + (hi_val - lo_val) / 2
+    median[counts == 0] = np.nan
+
+    return median
+
+
+def block_median(image, factor, mask=None, dtype=None, approx=None,
+                 max_samples=16):
+    '''
+    NaN-aware block median. Equivalent to block_reduce(image, factor,
+    func=np.nanmedian) on a masked array: masked pixels and NaNs are ignored
+    and blocks with no valid pixels are NaN.
+
+    Input:
+
+    image = 2D array (may be a numpy masked array)
+
+    factor = integer block size
+
+    mask = optional boolean array; True pixels are excluded
+
+    dtype = working dtype (e.g. np.float32 to halve the memory use)
+
+    approx = None for the exact median, or 'subsample' to take the median
+    of a regular subset of (at most max_samples) pixels in each block (fine
+    for display purposes)
+    '''
+
+    factor = int(factor)
+    data, invalid = _prepare(image, factor, mask=mask, dtype=dtype)
+
+    rows = _as_block_rows(data, factor)
+    if invalid is not None:
+        valid = ~_as_block_rows(invalid, factor)
+    else:
+        valid = None
+
+    if approx == 'subsample':
+        step = max(1, int(np.ceil(factor * factor / max_samples)))
+        rows = rows[..., ::step]
+        if valid is not None:
+            valid = valid[..., ::step]
+    elif approx is not None:
+        raise ValueError('approx must be None or "subsample"')
+
+    # push invalid pixels to the end of each row by making them +inf
+    if valid is not None:
+        rows = np.where(valid, rows, np.inf)
+        counts = valid.sum(axis=-1)
+    else:
+        rows = np.array(rows)
+        counts = np.full(rows.shape[:-1], rows.shape[-1])
+
+    rows.sort(axis=-1)
+
+    return _median_of_sorted(rows, counts)
+
+
+def benchmark(shape=(2048, 4096), image_rebin=4, big_rebin=8, repeats=3):
+    '''
+    Times the astropy block_reduce calls used in this package against the
+    replacements here, for a synthetic chip of the given shape, and prints
+    the speedup and maximum difference.
+    '''
+
+    from astropy.nddata import block_reduce
+
+    rng = np.random.default_rng(0)
+    chip = rng.normal(10, 3, shape).astype(np.float32)
+    chip[rng.random(shape) < 1e-3] = np.nan
+
+    def timeit(func):
+        best = np.inf
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - t0)
+        return best, result
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        # full-resolution chip -> binned image (load_resources etc)
+        t_old, old = timeit(lambda: block_reduce(chip, image_rebin, func=np.nansum))
+        t_new, new = timeit(lambda: block_sum(chip, image_rebin))
+        print('block sum {}x{} /{}: block_reduce {:.3f}s, block_sum {:.3f}s '
+              '({:.1f}x), max diff {:.2e}'.format(shape[0], shape[1], image_rebin,
+                                                   t_old, t_new, t_old / t_new,
+                                                   np.nanmax(np.abs(old - new))))
+
+        # binned image with trails masked -> rebinned diagnostic panel
+        binned = new
+        mask = np.zeros(binned.shape, dtype=bool)
+        mask[:, binned.shape[1] // 3:binned.shape[1] // 3 + 20] = True
+        masked = np.ma.masked_where(mask, binned)
+
+        t_old, old = timeit(lambda: block_reduce(masked, big_rebin, func=np.nanmedian))
+        for label, kwargs in [('exact', {}),
+                              ('float32', {'dtype': np.float32}),
+                              ('subsample', {'approx': 'subsample'})]:
+            t_new, new = timeit(lambda: block_median(binned, big_rebin, mask=mask, **kwargs))
+            print('block median {} /{} ({}): block_reduce {:.3f}s, block_median {:.3f}s '
+                  '({:.1f}x), max diff {:.2e}'.format(binned.shape, big_rebin, label,
+                                                       t_old, t_new, t_old / t_new,
+                                                       np.nanmax(np.abs(old - new))))
+
+
+if __name__ == '__main__':
+    benchmark()
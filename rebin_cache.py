@@ -0,0 +1,164 @@
+'''
+Persistent on-disk cache of rebinned WFC chips.
+
+Reading a full FLC just to block-sum it down for a preview is slow,
+especially over a network filesystem. The rebinned WFC1/WFC2 arrays are
+stored as .npy files (opened memory-mapped) in a cache directory under the
+satellites directory. Entries are keyed by image path, modification time,
+size and bin size, so a changed image is never served stale. Least recently
+used entries are removed once the cache grows past max_bytes.
+'''
+
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import products
+from rebin import block_sum
+
+# default cache location (relative to the satellites directory) and size
+cache_dirname = '_rebin_cache'
+default_max_bytes = 4 * 1024**3
+
+# WFC1 is extension 4, WFC2 is extension 1
+chip_extensions = [4, 1]
+
+
+class RebinCache:
+    def __init__(self, cache_dir, max_bytes=default_max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, image_path, binsize):
+        '''Unique key for an image file (as it currently is on disk) and
+        bin size'''
+
+        image_path = Path(image_path).resolve()
+        stat = image_path.stat()
+        ident = '{}|{}|{}|{}'.format(image_path, stat.st_mtime_ns, stat.st_size,
+                                     int(binsize))
+
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def entry_path(self, key, ext):
+        return Path.joinpath(self.cache_dir, '{}_ext{}.npy'.format(key, ext))
+
+    def get(self, image_path, binsize, extensions=chip_extensions):
+        '''Returns the cached (memory-mapped) rebinned chips, or None if any
+        of them is not cached.'''
+
+        key = self.key(image_path, binsize)
+        paths = [self.entry_path(key, ext) for ext in extensions]
+
+        # copy-on-write, as some consumers (e.g. skimage) need writable
+        # buffers. Nothing is ever written back to the cache file.
+        try:
+            chips = [np.load(path, mmap_mode='c') for path in paths]
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # mark as recently used
+        for path in paths:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+        return chips
+
+    def put(self, image_path, binsize, chips, extensions=chip_extensions):
+        '''Stores rebinned chips. Files are written to a temporary name and
+        moved into place, so concurrent processes never see partial files.'''
+
+        key = self.key(image_path, binsize)
+        for ext, chip in zip(extensions, chips):
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(chip))
+                # mkstemp files are private; let other reviewers use them
+                os.chmod(tmp, 0o664)
+                os.replace(tmp, self.entry_path(key, ext))
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is no
+        larger than max_bytes'''
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy') or entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+
+
+def default_cache(sat_dir, max_bytes=default_max_bytes):
+    '''The cache shared by all tools working on a satellites directory'''
+
+    return RebinCache(Path.joinpath(Path(sat_dir), cache_dirname),
+                      max_bytes=max_bytes)
+
+
+def load_rebinned_chips(image_path, binsize, sat_dir=None, cache=None,
+                        extensions=chip_extensions):
+    '''
+    Returns [WFC1, WFC2] (by default) block-summed by binsize, from the
+    cache if possible. Otherwise the image is read once, rebinned, and the
+    result cached.
+
+    Input:
+
+    image_path = path to the flc/flt file
+
+    binsize = rebinning factor
+
+    sat_dir = satellites directory; its default cache is used
+
+    cache = a RebinCache to use instead of the default one. If neither
+    sat_dir or cache are given, nothing is cached.
+    '''
+
+    if cache is None and sat_dir is not None:
+        cache = default_cache(sat_dir)
+
+    if cache is not None:
+        chips = cache.get(image_path, binsize, extensions=extensions)
+        if chips is not None:
+            return chips
+
+    # through the shared reader, so the headers are read from the same open
+    chips = [products.reduce(image_path, lambda data: block_sum(data, binsize), ext=ext)
+             for ext in extensions]
+
+    if cache is not None:
+        cache.put(image_path, binsize, chips, extensions=extensions)
+
+    return chips
@@ -0,0 +1,216 @@
+'''
+On-disk index of a satellites directory.
+
+Globbing for images and checking files one by one with Path.exists() is
+slow on a networked filesystem with thousands of exposures. A
+SatelliteIndex lists the image directory, the satellites directory and the
+per-chip trail directories with one os.scandir pass each and keeps the
+result (names, sizes, mtimes, plus trail counts read from the catalogs) in
+an SQLite database in the satellites directory. Refreshing only rescans
+trail directories whose modification time changed, and only re-reads
+catalogs that changed.
+
+The index is only a cache and can be deleted at any time.
+'''
+
+import os
+import sqlite3
+
+import numpy as np
+
+import products
+
+index_name = '_index.sqlite'
+
+schema = '''
+create table if not exists files (
+    dir text not null,
+    name text not null,
+    mtime_ns integer,
+    size integer,
+    primary key (dir, name)
+);
+create table if not exists dirs (
+    path text primary key,
+    mtime_ns integer
+);
+create table if not exists catalogs (
+    root text not null,
+    ext integer not null,
+    mtime_ns integer,
+    n_trails integer,
+    n_good integer,
+    primary key (root, ext)
+);
+'''
+
+# products checked for each chip
+chip_products = ['catalog', 'segment', 'mask']
+
+
+class SatelliteIndex:
+    def __init__(self, sat_dir, image_dir=None, refresh=True):
+        '''
+        Input:
+
+        sat_dir = directory containing the findsat_mrt output
+
+        image_dir = directory containing the images (defaults to the parent
+        of sat_dir)
+
+        refresh = update the index from disk now. Set to False to use the
+        index as it is (e.g. in worker processes after the parent refreshed
+        it).
+        '''
+
+        self.sat_dir = os.path.abspath(sat_dir)
+        if image_dir is None:
+            image_dir = os.path.dirname(self.sat_dir)
+        self.image_dir = os.path.abspath(image_dir)
+
+        self.path = os.path.join(self.sat_dir, index_name)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.executescript(schema)
+
+        if refresh:
+            self.refresh()
+
+    def close(self):
+        self.db.close()
+
+    def _scan(self, path):
+        '''Lists a directory into the files table. Returns the names of
+        subdirectories.'''
+
+        entries = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((path, entry.name, stat.st_mtime_ns, stat.st_size))
+
+        self.db.execute('delete from files where dir = ?', (path,))
+        self.db.executemany('insert into files values (?, ?, ?, ?)', entries)
+        self.db.execute('insert or replace into dirs values (?, ?)',
+                        (path, os.stat(path).st_mtime_ns))
+
+        return subdirs
+
+    def refresh(self):
+        '''Brings the index up to date with what is on disk'''
+
+        with self.db:
+            if self.image_dir != self.sat_dir:
+                self._scan(self.image_dir)
+            subdirs = self._scan(self.sat_dir)
+
+            # trail directories only need rescanning if entries were added,
+            # removed or renamed (which changes the directory mtime)
+            known = dict(self.db.execute('select path, mtime_ns from dirs'))
+            for name in subdirs:
+                if not name.endswith('_mrt'):
+                    continue
+                path = os.path.join(self.sat_dir, name)
+                mtime = os.stat(path).st_mtime_ns
+                if known.get(path) != mtime:
+                    self._scan(path)
+
+            self._refresh_catalogs()
+
+    def _refresh_catalogs(self):
+        known = {(root, ext): mtime for root, ext, mtime in
+                 self.db.execute('select root, ext, mtime_ns from catalogs')}
+        current = {}
+        for name, mtime in self.db.execute('select name, mtime_ns from files where dir = ? '
+                                           'and name like ?',
+                                           (self.sat_dir, '%_ext__mrt_catalog.fits')):
+            root = name[:-len('_ext4_mrt_catalog.fits')]
+            ext = int(name[-len('4_mrt_catalog.fits')])
+            current[(root, ext)] = mtime
+
+        for (root, ext), mtime in current.items():
+            if known.get((root, ext)) == mtime:
+                continue
+            try:
+                status = products.read_table(os.path.join(
+                    self.sat_dir, '{}_ext{}_mrt_catalog.fits'.format(root, ext)))['status']
+                n_trails, n_good = len(status), int(np.sum(status == 2))
+            except Exception:
+                n_trails, n_good = None, None
+            self.db.execute('insert or replace into catalogs values (?, ?, ?, ?, ?)',
+                            (root, ext, mtime, n_trails, n_good))
+
+        for key in set(known) - set(current):
+            self.db.execute('delete from catalogs where root = ? and ext = ?', key)
+
+    def roots(self, suffix='.fits'):
+        '''Sorted roots of the images (files ending in suffix) in the image
+        directory'''
+
+        names = [row[0] for row in self.db.execute(
+            'select name from files where dir = ? and name like ?',
+            (self.image_dir, '%' + suffix))]
+        names = [name for name in names if name.endswith(suffix)]
+
+        return sorted(name[:-len('.fits')] for name in names)
+
+    def exists(self, path):
+        '''
+        Whether path exists. Files in indexed directories are looked up in
+        the index; anything the index does not know about (including files
+        created since the last refresh) is checked on disk. Files deleted
+        since the last refresh are still found unless they were removed
+        from the index with forget.
+        '''
+
+        path = os.path.abspath(path)
+        row = self.db.execute('select 1 from files where dir = ? and name = ?',
+                              os.path.split(path)).fetchone()
+        if row is not None:
+            return True
+
+        return os.path.exists(path)
+
+    def forget(self, path):
+        '''Removes a file from the index (after deleting it)'''
+
+        with self.db:
+            self.db.execute('delete from files where dir = ? and name = ?',
+                            os.path.split(os.path.abspath(path)))
+
+    def exists_all(self, paths):
+        return np.array([self.exists(path) for path in paths])
+
+    def mtime(self, path):
+        row = self.db.execute('select mtime_ns from files where dir = ? and name = ?',
+                              os.path.split(os.path.abspath(path))).fetchone()
+        return None if row is None else row[0]
+
+    def chip(self, root, ext):
+        '''Presence of the products of one chip, plus its trail counts'''
+
+        info = {}
+        for name in chip_products:
+            info[name] = self.exists(os.path.join(
+                self.sat_dir, '{}_ext{}_mrt_{}.fits'.format(root, ext, name)))
+        info['trail_dir'] = self.exists(os.path.join(self.sat_dir, '{}_ext{}_mrt'.format(root, ext)))
+        row = self.db.execute('select n_trails, n_good from catalogs where root = ? and ext = ?',
+                              (root, ext)).fetchone()
+        info['n_trails'], info['n_good'] = (None, None) if row is None else row
+
+        return info
+
+    def trail_counts(self):
+        '''{root: (number of trails, number with status 2)} over both chips'''
+
+        counts = {}
+        for root, n_trails, n_good in self.db.execute(
+                'select root, sum(n_trails), sum(n_good) from catalogs group by root'):
+            counts[root] = (n_trails, n_good)
+
+        return counts
@@ -0,0 +1,226 @@
+'''
+Run-length representation of trail segmentation maps.
+
+A segmentation map is almost entirely zeros with a few thin bands of trail
+ids, but was always handled as a dense array: relabelling it for the image
+diagnostic meant one full-array comparison per trail, and every consumer
+built its own full-size masks. SegmentRuns keeps only the runs of equal,
+non-zero pixels along each row (row, start, stop, label), so per-trail
+extraction, union and relabelling work on a few thousand runs rather than
+millions of pixels. Converting back to a dense map or a mask only touches
+the masked pixels (plus allocating the output).
+
+Runs never overlap. Where trails overlap, the larger label wins, as in
+create_mask and IncrementalMask.
+'''
+
+import numpy as np
+
+
+class SegmentRuns:
+    def __init__(self, shape, rows=None, starts=None, stops=None, labels=None):
+        '''
+        Input:
+
+        shape = (ny, nx) of the segmentation map
+
+        rows, starts, stops, labels = the runs; pixels
+        [row, start:stop] have the label. Use from_runs() for runs that may
+        overlap or touch.
+        '''
+
+        self.shape = tuple(shape)
+        empty = np.zeros(0, dtype=int)
+        self.rows = empty if rows is None else np.asarray(rows, dtype=int)
+        self.starts = empty if starts is None else np.asarray(starts, dtype=int)
+        self.stops = empty if stops is None else np.asarray(stops, dtype=int)
+        self.labels = empty if labels is None else np.asarray(labels, dtype=int)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_dense(cls, segment):
+        '''Runs of a dense segmentation map (one pass over the array)'''
+
+        segment = np.asarray(segment)
+        ny, nx = segment.shape
+
+        # only rows with something in them
+        nonzero_rows = np.flatnonzero(segment.any(axis=1))
+        if len(nonzero_rows) == 0:
+            return cls((ny, nx))
+
+        padded = np.zeros((len(nonzero_rows), nx + 2), dtype=segment.dtype)
+        padded[:, 1:-1] = segment[nonzero_rows]
+
+        # boundaries between pixels c-1 and c where the value changes; each
+        # row starts and ends with a zero, so every run that starts at a
+        # boundary ends at the next boundary of the same row
+        r, c = np.nonzero(padded[:, 1:] != padded[:, :-1])
+        values = padded[r, c + 1]
+        start = np.flatnonzero(values != 0)
+
+        return cls((ny, nx), rows=nonzero_rows[r[start]], starts=c[start],
+                   stops=c[start + 1], labels=values[start])
+
+    @classmethod
+    def from_mask(cls, mask, label=1):
+        return cls.from_dense(np.asarray(mask, dtype=bool).astype(int) * int(label))
+
+    @classmethod
+    def from_footprint(cls, footprint, label=1):
+        '''Runs of a trail_masks.Footprint, without making it dense'''
+
+        local = cls.from_mask(footprint.mask, label=label)
+
+        return cls(footprint.shape, rows=local.rows + footprint.y0,
+                   starts=local.starts + footprint.x0,
+                   stops=local.stops + footprint.x0, labels=local.labels)
+
+    @classmethod
+    def from_runs(cls, shape, rows, starts, stops, labels):
+        '''Runs that may overlap: overlaps take the larger label, touching
+        runs with the same label are merged and zero labels dropped'''
+
+        ny, nx = shape
+        rows = np.asarray(rows, dtype=int)
+        labels = np.asarray(labels, dtype=int)
+        if len(rows) == 0:
+            return cls(shape)
+
+        # lay the rows end to end, with a gap between them, so runs are
+        # intervals on a line
+        stride = nx + 1
+        a = rows * stride + np.asarray(starts, dtype=int)
+        b = rows * stride + np.asarray(stops, dtype=int)
+
+        # elementary intervals between consecutive boundaries, each labelled
+        # with the largest label of the runs covering it
+        bounds = np.unique(np.concatenate([a, b]))
+        lo = np.searchsorted(bounds, a)
+        n = np.searchsorted(bounds, b) - lo
+        idx = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())
+        interval_labels = np.zeros(len(bounds) - 1, dtype=int)
+        np.maximum.at(interval_labels, idx, np.repeat(labels, n))
+
+        # merge neighbouring intervals with the same label
+        keep = interval_labels != 0
+        same_as_previous = np.zeros(len(keep), dtype=bool)
+        same_as_previous[1:] = keep[:-1] & (interval_labels[1:] == interval_labels[:-1])
+        first = np.flatnonzero(keep & ~same_as_previous)
+        last = np.flatnonzero(keep & ~np.append(same_as_previous[1:], False))
+
+        run_start = bounds[first]
+        run_stop = bounds[last + 1]
+
+        return cls(shape, rows=run_start // stride, starts=run_start % stride,
+                   stops=run_stop - (run_start // stride) * stride,
+                   labels=interval_labels[first])
+
+    def _lengths(self):
+        return self.stops - self.starts
+
+    def _pixel_index(self):
+        '''Flat index of every pixel covered by the runs'''
+
+        lengths = self._lengths()
+        offsets = self.rows * self.shape[1] + self.starts - (np.cumsum(lengths) - lengths)
+        return np.repeat(offsets, lengths) + np.arange(lengths.sum())
+
+    def to_dense(self, dtype=int):
+        segment = np.zeros(self.shape, dtype=dtype)
+        segment.ravel()[self._pixel_index()] = np.repeat(self.labels, self._lengths())
+        return segment
+
+    def to_mask(self, labels=None):
+        '''Boolean mask of all runs (or only of the given labels)'''
+
+        runs = self if labels is None else self.select(labels)
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.ravel()[runs._pixel_index()] = True
+        return mask
+
+    def unique_labels(self):
+        return np.unique(self.labels)
+
+    def npix(self, label=None):
+        lengths = self._lengths()
+        if label is not None:
+            lengths = lengths[self.labels == label]
+        return int(lengths.sum())
+
+    def _subset(self, sel):
+        return SegmentRuns(self.shape, rows=self.rows[sel], starts=self.starts[sel],
+                           stops=self.stops[sel], labels=self.labels[sel])
+
+    def select(self, labels):
+        '''Runs of the given labels only'''
+
+        return self._subset(np.isin(self.labels, np.atleast_1d(labels)))
+
+    def trail(self, label):
+        '''Runs of a single trail'''
+
+        return self.select([label])
+
+    def drop(self, labels):
+        return self._subset(~np.isin(self.labels, np.atleast_1d(labels)))
+
+    def union(self, *others):
+        '''Combined runs of this and other segmentations (larger label wins
+        where they overlap)'''
+
+        parts = [self] + list(others)
+        return SegmentRuns.from_runs(self.shape,
+                                     np.concatenate([p.rows for p in parts]),
+                                     np.concatenate([p.starts for p in parts]),
+                                     np.concatenate([p.stops for p in parts]),
+                                     np.concatenate([p.labels for p in parts]))
+
+    def relabel(self, mapping):
+        '''
+        New labels from a {old: new} dictionary. Labels not in mapping are
+        kept; labels mapped to 0 are removed.
+        '''
+
+        if len(mapping) == 0 or len(self) == 0:
+            return self
+
+        old = np.array(sorted(mapping), dtype=int)
+        new = np.array([mapping[k] for k in sorted(mapping)], dtype=int)
+        idx = np.clip(np.searchsorted(old, self.labels), 0, len(old) - 1)
+        found = old[idx] == self.labels
+        labels = self.labels.copy()
+        labels[found] = new[idx[found]]
+
+        return SegmentRuns.from_runs(self.shape, self.rows, self.starts, self.stops, labels)
+
+    def consecutive(self):
+        '''
+        Relabels to 1..n in order of the original labels. Returns the new
+        runs and the original labels (the original label of new label i is
+        labels[i - 1]).
+        '''
+
+        labels, inverse = np.unique(self.labels, return_inverse=True)
+        runs = SegmentRuns(self.shape, rows=self.rows, starts=self.starts,
+                           stops=self.stops, labels=inverse.reshape(-1) + 1)
+
+        return runs, labels
+
+
+def as_runs(segment):
+    '''SegmentRuns of a segmentation map given either as runs or dense'''
+
+    if isinstance(segment, SegmentRuns):
+        return segment
+
+    return SegmentRuns.from_dense(segment)
+
+
+def as_dense(segment, dtype=int):
+    if isinstance(segment, SegmentRuns):
+        return segment.to_dense(dtype=dtype)
+
+    return np.asarray(segment)
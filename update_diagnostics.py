@@ -1,19 +1,39 @@
 # script to update the diagnostic plots for a set of images
 
 import os
-import glob
 from pathlib import Path
 import logging
 import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import matplotlib.pyplot as plt
-from new_diagnostics import make_trail_diagnostic, make_image_diagnostic
+from new_diagnostics import (make_trail_diagnostic, make_image_diagnostic,
+                             make_exposure_context, trail_renderer,
+                             TrailDiagnosticRenderer)
+from fast_diagnostics import CompositeTrailRenderer
 from astropy.table import Table
 from astropy.io import fits
-from astropy.nddata import block_reduce
+from rebin_cache import load_rebinned_chips
+import products
+from mask_storage import read_segment
+from segment_runs import SegmentRuns
+from profile_store import ProfileStore
+from trail_masks import trail_footprint
+from diagnostic_manifest import (DiagnosticManifest, exposure_key, exposure_inputs,
+                                 catalog_path, newer_than_inputs, trail_key, image_key)
+from sat_index import SatelliteIndex
 import acstools.utils_findsat_mrt as u
 
-def check_files_exist(files):
+# renderers of the trail diagnostics, by backend name
+trail_backends = {'matplotlib': TrailDiagnosticRenderer,
+                  'fast': CompositeTrailRenderer}
+
+def check_files_exist(files, index=None):
+
+    # look the files up in the satellites directory index if there is one
+    if index is not None:
+        return index.exists_all(files)
 
     exists = []
 
@@ -22,7 +42,15 @@ def check_files_exist(files):
     exists = np.array(exists)
     return exists    
 
-def load_resources(image_dir, sat_dir, root, logger=None):
+def trail_diagnostic_path(sat_dir, root, ext, trail_id):
+    return sat_dir + '/' + root + '_ext{}_mrt/{}_full_ext{}_mrt_{}_diagnostic.png'.format(ext, root, ext, trail_id)
+
+
+def image_diagnostic_path(sat_dir, root):
+    return sat_dir + '/' + root + '_full_mrt_diagnostic.png'
+
+
+def load_resources(image_dir, sat_dir, root, logger=None, index=None):
     # image 
     image_path = image_dir + '/' + root + '.fits'
 
@@ -37,7 +65,7 @@ def load_resources(image_dir, sat_dir, root, logger=None):
     # check for missing files
     file_list = [catalog_path_4, catalog_path_1, image_path,
                     segmentation_path_4, segmentation_path_1]
-    exist = check_files_exist(file_list)
+    exist = check_files_exist(file_list, index=index)
 
     # if any are missing, log them, then skip over this iteration
     if np.any(exist == False):
@@ -55,36 +83,282 @@ def load_resources(image_dir, sat_dir, root, logger=None):
                  'segmentation':{}
     }
     # catalogs
-    resources['catalog'][1] = Table.read(catalog_path_1)
-    resources['catalog'][4] = Table.read(catalog_path_4)
-
-    # image (rebin it)
-    hdu = fits.open(image_path)
-    wfc1 = block_reduce(hdu[4].data, 4, func=np.nansum)
-    wfc2 = block_reduce(hdu[1].data, 4, func=np.nansum)
-    hdu.close()
+    resources['catalog'][1] = products.read_table(catalog_path_1)
+    resources['catalog'][4] = products.read_table(catalog_path_4)
+
+    # image (rebinned, from the shared cache if possible)
+    wfc1, wfc2 = load_rebinned_chips(image_path, 4, sat_dir=sat_dir)
     resources['image'][4] = wfc1
     resources['image'][1] = wfc2
 
     # segmentation file
-    resources['segmentation'][4] = fits.getdata(segmentation_path_4)
-    resources['segmentation'][1] = fits.getdata(segmentation_path_1)
+    resources['segmentation'][4], __ = read_segment(segmentation_path_4, copy=False)
+    resources['segmentation'][1], __ = read_segment(segmentation_path_1, copy=False)
 
     return resources
 
 
+def process_root(root, sat_dir, image_dir, image_rebin=4,
+                 remake_trail_diagnostics=True, remake_image_diagnostics=True,
+                 overwrite=False, logger=None, trail_ids=None,
+                 use_manifest=True, index=None, backend='matplotlib'):
+    '''Remakes the trail and/or image diagnostics for a single exposure.
+
+    trail_ids = optional {ext: list of trail ids}. If given, only the
+    diagnostics of these trails are remade.
+
+    use_manifest = if True, existing diagnostics are remade when their
+    inputs changed since they were made (according to the manifest in
+    sat_dir), even if overwrite=False. Existing diagnostics not in the
+    manifest yet are only taken as up to date if they are newer than all
+    their input files.
+
+    index = SatelliteIndex of sat_dir used to check which files exist. If
+    None, the index on disk is opened as is (files it does not know about
+    are checked directly).
+
+    backend = how the trail diagnostics are drawn: 'matplotlib', or 'fast'
+    to compose the image panels with numpy (see fast_diagnostics)
+
+    Returns 'success' if everything requested was processed, or 'skipped'
+    if any input files were missing.
+    '''
+
+    cwd = sat_dir
+
+    print('On file = {}'.format(root))
+
+    if index is None:
+        index = SatelliteIndex(sat_dir, image_dir=image_dir, refresh=False)
+
+    # load the images/catalogs
+    resources = load_resources(image_dir, sat_dir, root, logger=logger, index=index)
+
+    # skip to next case if we're missing anything
+    if resources is None:
+        return 'skipped'
+
+
+    # 1D profiles of both chips
+    profiles = {ext: ProfileStore(sat_dir, root, ext, index=index) for ext in [4, 1]}
+
+    # work out which diagnostics need to be (re)made
+    manifest = DiagnosticManifest(sat_dir) if use_manifest else None
+    exposure = exposure_key(sat_dir, image_dir, root, image_rebin)
+
+    inputs = exposure_inputs(sat_dir, image_dir, root)
+
+    def needs_update(output_file, key, output_inputs):
+        if overwrite:
+            return True
+        if manifest is None:
+            return not index.exists(output_file)
+        if not manifest.known(output_file) and index.exists(output_file):
+            # made before the manifest existed. Only adopt it if nothing it
+            # was made from changed since (e.g. by adjust_products)
+            if not newer_than_inputs(output_file, output_inputs):
+                return True
+            manifest.record(output_file, key)
+            return False
+        return not manifest.is_current(output_file, key, exists=index.exists)
+
+    trail_plan = []
+    if remake_trail_diagnostics:
+        for ext in [1, 4]:
+            for row in resources['catalog'][ext]:
+                if (trail_ids is not None) and (row['id'] not in trail_ids.get(ext, [])):
+                    continue
+                output_file = trail_diagnostic_path(cwd, root, ext, row['id'])
+                key = trail_key(exposure, profiles[ext], row, backend=backend)
+                if needs_update(output_file, key,
+                                inputs + [catalog_path(sat_dir, root, ext),
+                                          profiles[ext].file_path(row['id'])]):
+                    trail_plan.append((ext, row, output_file, key))
+                else:
+                    print('Output file {} is up to date.'.format(output_file))
+
+    image_output_file = image_diagnostic_path(sat_dir, root)
+    image_output_key = image_key(exposure, profiles, resources['catalog'])
+    image_inputs = inputs + [catalog_path(sat_dir, root, ext) for ext in [4, 1]]
+    image_inputs += sorted({str(profiles[ext].file_path(row['id']))
+                            for ext in [4, 1] for row in resources['catalog'][ext]
+                            if row['status'] == 2})
+    remake_image = remake_image_diagnostics and needs_update(image_output_file,
+                                                             image_output_key,
+                                                             image_inputs)
+    if remake_image_diagnostics and not remake_image:
+        print('Output file {} is up to date.'.format(image_output_file))
+
+    if (len(trail_plan) == 0) and not remake_image:
+        if manifest is not None:
+            manifest.save()
+        return 'success'
+
+    # The mask_arr, image_arr, segmentation_arr, and catalog_arr can be created here
+
+    # segmentation, as runs of trail pixels
+    segmentation_arr = [SegmentRuns.from_dense(resources['segmentation'][4]),
+                        SegmentRuns.from_dense(resources['segmentation'][1])]
+
+    #total mask
+    mask_arr = [runs.to_mask() for runs in segmentation_arr]
+
+    # image
+    image_arr = [resources['image'][4], resources['image'][1]]
+
+    # catalog
+    catalog_arr = [resources['catalog'][4], resources['catalog'][1]]
+
+    # panels shared by every diagnostic of this exposure (computed once)
+    context = make_exposure_context(image_arr, mask_arr)
+
+
+    # begin remaking individual trail diagnostic plots
+    if remake_trail_diagnostics:
+        
+        print('Remaking trail diagnostic plots')
+
+        # one figure for all trail diagnostics of this exposure
+        renderer = trail_renderer(image_arr, mask_arr, root=root, context=context,
+                                  renderer_class=trail_backends[backend])
+
+        for ext in [1, 4]:
+
+            print('On extension = {}'.format(ext)) 
+
+            # check if there are any trails to update. Skip if none.
+            plan = [entry for entry in trail_plan if entry[0] == ext]
+            if len(plan) == 0:
+                print('no trail diagnostics to update')
+                continue
+
+            # otherwise, iterate through entries
+            for ext, row, output_file, key in plan:
+
+                print('Updating trail diagnostic plots for {}, ext {}, trail id {}'.format(root, ext, row['id']))
+
+                # Create the individual trail mask
+                image = resources['image'][ext]
+                trail_mask = trail_footprint(image.shape, row['endpoints'],
+                                             row['width'],
+                                             min_mask_width=40/image_rebin)
+
+                if ext == 4:
+                    trail_mask_wfc1 = trail_mask
+                    trail_mask_wfc2 = np.zeros_like(trail_mask_wfc1)
+                elif ext == 1:
+                    trail_mask_wfc2 = trail_mask
+                    trail_mask_wfc1 = np.zeros_like(trail_mask_wfc2)
+
+                # ...and corresponding arra
+                trail_mask_arr = [trail_mask_wfc1, trail_mask_wfc2]
+
+                # load the 1d trail profile and its header
+
+                # if profile is missing, skip over this step
+                if not profiles[ext].has(row['id']):
+                    logging.warning('Missing 1D profile: {} ext {} trail {}'.format(root, ext, row['id']))
+                    continue
+
+                profile, profile_hdr = profiles[ext].read(row['id'])
+
+                make_trail_diagnostic(image_arr, mask_arr, trail_mask_arr,
+                                      row,profile, profile_hdr, root=root,
+                                      output_file = output_file,
+                                      overwrite=True,
+                                      renderer=renderer)
+                if manifest is not None:
+                    manifest.record(output_file, key)
+
+
+    if remake_image:
+
+        make_image_diagnostic(image_arr,
+                            mask_arr,
+                            segmentation_arr,
+                            catalog_arr,
+                            root,
+                            sat_dir,
+                            scale=[-1,3],
+                            cmap='Greys',
+                            output_file = image_output_file, 
+                            min_mask_width=40/image_rebin, 
+                            overwrite=True,
+                            context=context)
+        if manifest is not None:
+            manifest.record(image_output_file, image_output_key)
+
+    if manifest is not None:
+        manifest.save()
+
+    return 'success'
+
+
+def setup_logger(logfile):
+    '''Returns the module logger, writing to logfile. Handlers are only added
+    once per logfile so repeated calls (or worker processes) don't duplicate
+    log lines.'''
+
+    logger = logging.getLogger(__name__)
+    logfile = os.path.abspath(logfile)
+    if not any(getattr(h, 'baseFilename', None) == logfile for h in logger.handlers):
+        logger.addHandler(logging.FileHandler(logfile))
+    logger.setLevel('DEBUG')
+
+    return logger
+
+
+def _init_worker(logfile):
+    # workers only ever write files, so use the non-interactive backend
+    plt.switch_backend('agg')
+    setup_logger(logfile)
+
+
+def _process_root_safe(root, sat_dir, image_dir, logfile, **kwargs):
+    '''Wrapper around process_root that never raises, so that one bad
+    exposure does not stop the others. Returns (root, status, message).'''
+
+    logger = setup_logger(logfile)
+    try:
+        status = process_root(root, sat_dir, image_dir, logger=logger, **kwargs)
+        message = ''
+    except Exception as e:
+        status = 'error'
+        message = '{}: {}'.format(type(e).__name__, e)
+        logger.exception('Error processing ' + root)
+
+    return root, status, message
+
+
 def update_diagnostics(sat_dir, image_rebin=4, remake_trail_diagnostics = True, 
                        remake_image_diagnostics = True, overwrite=False, 
-                       image_list=None):
+                       image_list=None, workers=1, backend='matplotlib'):
+    '''Remakes diagnostic plots for every exposure in image_list (or every
+    flc in the parent of sat_dir). Setting workers > 1 spreads the exposures
+    over a process pool. backend='fast' draws the trail diagnostics without
+    matplotlib axes, which is much faster (see fast_diagnostics).
+
+    Returns a dictionary with the status ('success', 'skipped' or 'error')
+    and any error message for each root.
+    '''
 
 
+    if backend not in trail_backends:
+        raise ValueError('Unknown backend {} (choose from {})'.format(
+            backend, ', '.join(trail_backends)))
+
     # get the list of files:
     cwd = sat_dir  #'/Users/dstark/supercal/09575/satellites'
     image_dir = cwd + '/../'
 
+    # bring the index of the image/satellites directories up to date; the
+    # workers then use it as is
+    index = SatelliteIndex(sat_dir, image_dir=image_dir)
+
     # if no image_list specified, use everything in the image directory
     if image_list is None:
-        image_list = glob.glob(image_dir + '*flc.fits')
+        image_list = [os.path.join(index.image_dir, root + '.fits')
+                      for root in index.roots('flc.fits')]
 
     print('updating diagnostics for the following:')
     print(image_list)
@@ -93,11 +367,7 @@ def update_diagnostics(sat_dir, image_rebin=4, remake_trail_diagnostics = True,
     logfile = cwd + '/update_diagnostics_log.txt'
     print('Log file is {}'.format(logfile))
 
-    logger = logging.getLogger(__name__)
-    FileOutputHandler = logging.FileHandler(logfile)
-
-    logger.addHandler(FileOutputHandler)
-    logger.setLevel('DEBUG')
+    logger = setup_logger(logfile)
 
     # note the start time
     now = datetime.datetime.now()
@@ -110,115 +380,69 @@ def update_diagnostics(sat_dir, image_rebin=4, remake_trail_diagnostics = True,
     # extract the roots
     roots = np.array([image.split('/')[-1].split('.fits')[0] for image in image_list])
 
-    # cycle
-    for root in roots:
-        
-        print('On file = {}'.format(root))
-
-        # load the images/catalogs
-        resources = load_resources(image_dir, sat_dir, root, logger=logger)
-
-        # skip to next case if we're missing anything
-        if resources is None:
-            continue
-
-
-        # The mask_arr, image_arr, segmentation_arr, and catalog_arr can be created here
+    kwargs = {'image_rebin': image_rebin,
+              'remake_trail_diagnostics': remake_trail_diagnostics,
+              'remake_image_diagnostics': remake_image_diagnostics,
+              'overwrite': overwrite,
+              'backend': backend}
 
-        #total mask
-        mask_arr = [resources['segmentation'][4] > 0, resources['segmentation'][1] > 0]
+    results = {}
 
-        # segmentation
-        segmentation_arr = [resources['segmentation'][4], resources['segmentation'][1]]
-
-        # image
-        image_arr = [resources['image'][4], resources['image'][1]]
-
-        # catalog
-        catalog_arr = [resources['catalog'][4], resources['catalog'][1]]
-
-
-        # begin remaking individual trail diagnostic plots
-        if remake_trail_diagnostics:
-            
-            print('Remaking trail diagnostic plots')
-
-            for ext in [1, 4]:
-
-                print('On extension = {}'.format(ext)) 
-
-                catalog = resources['catalog'][ext]
-
-                # check if there are any entries in the catalog. Skip if none.
-                if len(catalog) == 0:
-                    print('no trail diagnostics to update')
+    # cycle
+    if (workers is None) or (workers <= 1) or (len(roots) <= 1):
+        for root in roots:
+            root, status, message = _process_root_safe(str(root), sat_dir, image_dir,
+                                                       logfile, **kwargs)
+            results[root] = (status, message)
+    else:
+        print('Processing {} exposures with {} workers'.format(len(roots), workers))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(logfile,)) as pool:
+            futures = {pool.submit(_process_root_safe, str(root), sat_dir,
+                                   image_dir, logfile, **kwargs): str(root)
+                       for root in roots}
+            broken = []
+            for future in as_completed(futures):
+                # _process_root_safe catches errors in process_root, but not
+                # the death of a worker (killed for running out of memory, a
+                # segfault, ...). That breaks the pool and fails every
+                # exposure still queued, so those are retried below
+                try:
+                    root, status, message = future.result()
+                except BrokenProcessPool:
+                    broken.append(futures[future])
                     continue
+                results[root] = (status, message)
+                print('Finished {} ({})'.format(root, status))
+
+        # each in a new process of its own, so only the exposure that
+        # kills its worker fails
+        for root in sorted(broken):
+            print('Retrying {} after a worker died'.format(root))
+            with ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                     initargs=(logfile,)) as pool:
+                future = pool.submit(_process_root_safe, root, sat_dir,
+                                     image_dir, logfile, **kwargs)
+                try:
+                    root, status, message = future.result()
+                except BrokenProcessPool as e:
+                    status = 'error'
+                    message = 'worker died: {}'.format(e)
+                    logger.error('Error processing {}: {}'.format(root, message))
+            results[root] = (status, message)
+            print('Finished {} ({})'.format(root, status))
+
+    # summarize
+    print('\nupdate_diagnostics summary:')
+    for status in ['success', 'skipped', 'error']:
+        subset = [root for root in roots if results[root][0] == status]
+        print('{}: {}'.format(status, len(subset)))
+        logger.info('{}: {}'.format(status, len(subset)))
+        if status == 'success':
+            continue
+        for root in subset:
+            line = '    {} {}'.format(root, results[root][1])
+            print(line)
+            logger.info(line)
 
-                # otherwise, iterate through entries
-                for row in catalog:
-
-                    print('Updating trail diagnostic plots for {}, ext {}, trail id {}'.format(root, ext, row['id']))
-
-                    # set up output file. Check if it exists, and skip if overwrite not allowed
-                    output_file = cwd + '/' + root + '_ext{}_mrt/{}_full_ext{}_mrt_{}_diagnostic.png'.format(ext, root, ext, row['id'])
-                    if Path(output_file).exists() & (overwrite == False):
-                        print('Output file {} already exists.'.format(output_file))
-                        print('Set overwrite=True to replace it')
-                        continue
-
-                    # Create the individual trail mask
-                    image = resources['image'][ext]
-                    trail_seg, trail_mask = u.create_mask(image, [row['id']],
-                                                        [row['endpoints']], 
-                                                        [row['width']], 
-                                                        min_mask_width=40/image_rebin)
-
-                    if ext == 4:
-                        trail_mask_wfc1 = trail_mask
-                        trail_mask_wfc2 = np.zeros_like(trail_mask_wfc1)
-                    elif ext == 1:
-                        trail_mask_wfc2 = trail_mask
-                        trail_mask_wfc1 = np.zeros_like(trail_mask_wfc2)
-
-                    # ...and corresponding arra
-                    trail_mask_arr = [trail_mask_wfc1, trail_mask_wfc2]
-
-                    # load the 1d trail profile and its header
-                    profile_file = sat_dir + '/' + root + '_ext{}_mrt/'.format(ext) + root + '_ext{}_mrt_1dprof_{}.fits'.format(ext, row['id'])
-
-                    # if profile is missing, skip over this step
-                    if not Path(profile_file).exists():
-                        logging.warning('Missing 1D profile file: ' + profile_file)
-                        continue
-
-                    profile = fits.getdata(profile_file)
-                    profile_hdr = fits.getheader(profile_file)
-
-                    make_trail_diagnostic(image_arr, mask_arr, trail_mask_arr,
-                                          row,profile, profile_hdr, root=root,
-                                          output_file = output_file,
-                                          overwrite=overwrite)
-
-
-        if remake_image_diagnostics:
-
-            # see if the diagnostic already exists
-            output_file = sat_dir + '/' + root + '_full_mrt_diagnostic.png'
-
-            if Path(output_file).exists() & (overwrite == False):
-                print('Output file {} already exists.'.format(output_file))
-                print('Set overwrite=True to replace it')
-
-            else:
-
-                make_image_diagnostic(image_arr,
-                                    mask_arr,
-                                    segmentation_arr,
-                                    catalog_arr,
-                                    root,
-                                    sat_dir,
-                                    scale=[-1,3],
-                                    cmap='Greys',
-                                    output_file = output_file, 
-                                    min_mask_width=40/image_rebin, 
-                                    overwrite=overwrite)
+    return results
@@ -0,0 +1,316 @@
+'''
+Interactive trail width control for the trail diagnostic window.
+
+Changing a width used to mean typing a number at a prompt, rebuilding the
+mask and redrawing the whole diagnostic before the result could be seen.
+WidthControl changes the width with the keyboard on the trail window and
+shows the result straight away:
+
+  * the trail mask overlay comes from a TrailBand (the rotated coordinates
+    of the pixels around the trail are computed once, so a new width is
+    only a threshold), and only the pixels of the old and new footprints
+    are changed
+  * the overlay and the profile width markers are animated artists, drawn
+    on a saved background of the rest of the figure (blitting), so nothing
+    else is redrawn
+  * while the width changes, the overlay only covers the footprint's
+    bounding box, pooled to about the resolution of the screen (a block is
+    shown if any of its pixels is masked), so drawing it does not depend
+    on the binning
+
+The mask and segmentation map are only updated (incrementally) once the
+width is accepted.
+
+Keys: up/right widen and down/left narrow the trail (hold shift for bigger
+steps), enter accepts the width and escape goes back to the original one.
+
+Each key press should take less than latency_target seconds. Run this
+module directly for a benchmark on synthetic chips at the binnings used by
+the inspector (4 and 2).
+'''
+
+import time
+
+import numpy as np
+from matplotlib.backend_bases import FigureCanvasBase
+
+from trail_masks import TrailBand, trail_footprint
+
+latency_target = 0.1
+
+# width change per key (in steps)
+keys = {'up': 1, 'right': 1, 'down': -1, 'left': -1}
+
+
+def pool_any(visible, factor):
+    '''Whether any pixel of each factor x factor block of a boolean array is
+    set (partial blocks at the edges are padded)'''
+
+    if factor == 1:
+        return visible
+
+    ny, nx = visible.shape
+    visible = np.pad(visible, ((0, -ny % factor), (0, -nx % factor)))
+    ny, nx = visible.shape
+    return visible.reshape(ny // factor, factor, nx // factor, factor).any(axis=(1, 3))
+
+
+def interactive(fig):
+    '''Whether a figure is in a GUI window that can run its own event loop
+    (not e.g. on an Agg canvas)'''
+
+    return type(fig.canvas).start_event_loop is not FigureCanvasBase.start_event_loop
+
+
+class WidthControl:
+    def __init__(self, renderer, chip, endpoints, width, center, min_mask_width=0,
+                 step=1, big_step=5):
+        '''
+        Input:
+
+        renderer = new_diagnostics.TrailDiagnosticRenderer showing the trail
+
+        chip = index of the chip the trail is on in the renderer (0: WFC1,
+        1: WFC2)
+
+        endpoints, width = trail endpoints and current width (binned pixels)
+
+        center = trail center in the 1D profile
+
+        min_mask_width = minimum width of the trail mask
+
+        step, big_step = width change per key press (without/with shift)
+        '''
+
+        self.fig = renderer.fig
+        self.overlay = renderer.overlays[chip]
+        self.profile = renderer.profile
+        self.center = center
+        self.step = step
+        self.big_step = big_step
+
+        shape = self.overlay.get_array().shape
+        self.band = TrailBand(shape, endpoints, min_mask_width=min_mask_width,
+                              max_width=width + 10*big_step)
+
+        self.initial_width = float(width)
+        self.width = float(width)
+        self.footprint = self.band.footprint(width)
+
+        # the overlay data, updated in place
+        hidden = np.ones(shape, dtype=bool)
+        hidden[self.footprint.slices] = ~self.footprint.mask
+        self.data = np.ma.array(np.zeros(shape), mask=hidden)
+
+        self.animated = [self.overlay] + self.profile.width_lines + [self.profile.width_text]
+        self.background = None
+        self.accepted = False
+        # chip pixels per overlay pixel while the width changes (see start)
+        self.factor = 1
+
+    def show_overlay(self):
+        '''
+        While the width is changing, the overlay only covers the bounding box
+        of the footprint, pooled by factor and resampled without
+        antialiasing: resampling the whole chip at full resolution is most
+        of the time of a key press.
+        '''
+
+        if not self.footprint.mask.any():
+            self.overlay.set_visible(False)
+            return
+
+        # blocks aligned with the chip, so they don't shift with the width
+        f = self.factor
+        ys, xs = self.footprint.slices
+        y0 = ys.start - ys.start % f
+        x0 = xs.start - xs.start % f
+        visible = pool_any(~self.data.mask[y0:ys.stop, x0:xs.stop], f)
+
+        ny, nx = visible.shape
+        self.overlay.set_data(np.ma.array(np.zeros(visible.shape), mask=~visible))
+        self.overlay.set_extent((x0 - 0.5, x0 + nx*f - 0.5, y0 - 0.5, y0 + ny*f - 0.5))
+        self.overlay.set_visible(True)
+
+    def start(self):
+        '''Draws everything but the animated artists once and keeps it as
+        the background'''
+
+        for artist in self.animated:
+            artist.set_animated(True)
+        self.interpolation = self.overlay.get_interpolation()
+        self.overlay.set_interpolation('nearest')
+        # moving the overlay must not rescale the axes
+        self.autoscale = self.overlay.axes.get_autoscale_on()
+        self.overlay.axes.set_autoscale_on(False)
+
+        # no coarser than the screen resolution of the chip
+        ny, nx = self.data.shape
+        bbox = self.overlay.axes.get_window_extent()
+        self.factor = max(1, int(min(nx / max(bbox.width, 1), ny / max(bbox.height, 1))))
+        self.show_overlay()
+
+        canvas = self.fig.canvas
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        self.blit()
+
+    def finish(self):
+        '''Back to a normal (whole chip) overlay'''
+
+        ny, nx = self.data.shape
+        self.overlay.set_data(self.data)
+        self.overlay.set_extent((-0.5, nx - 0.5, -0.5, ny - 0.5))
+        self.overlay.set_interpolation(self.interpolation)
+        self.overlay.axes.set_autoscale_on(self.autoscale)
+        for artist in self.animated:
+            artist.set_animated(False)
+        self.background = None
+        self.fig.canvas.draw_idle()
+
+    def blit(self):
+        if self.background is None:
+            return
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for artist in self.animated:
+            self.fig.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+
+    def set_width(self, width):
+        '''Shows the trail at a new width'''
+
+        width = max(float(width), 0.)
+        footprint = self.band.footprint(width)
+
+        # only the pixels of the old and new footprints change
+        self.data.mask[self.footprint.slices] = True
+        self.data.mask[footprint.slices] &= ~footprint.mask
+        self.footprint = footprint
+        self.width = width
+
+        self.show_overlay()
+        self.profile.set_width(self.center, width)
+        self.blit()
+
+    def on_key(self, event):
+        key = event.key
+        if key is None:
+            return
+
+        step = self.step
+        if key.startswith('shift+'):
+            key = key[len('shift+'):]
+            step = self.big_step
+
+        if key in keys:
+            self.set_width(self.width + keys[key]*step)
+        elif key == 'enter':
+            self.accepted = True
+            self.fig.canvas.stop_event_loop()
+        elif key == 'escape':
+            self.set_width(self.initial_width)
+            self.accepted = False
+            self.fig.canvas.stop_event_loop()
+
+    def on_close(self, event):
+        self.accepted = False
+        self.fig.canvas.stop_event_loop()
+
+    def run(self):
+        '''
+        Lets the width be changed until it is accepted (enter) or cancelled
+        (escape, or closing the window). Returns the new width, or None if
+        it was cancelled.
+        '''
+
+        canvas = self.fig.canvas
+        self.accepted = False
+        self.start()
+
+        cids = [canvas.mpl_connect('key_press_event', self.on_key),
+                canvas.mpl_connect('close_event', self.on_close)]
+        try:
+            canvas.start_event_loop(timeout=0)
+        finally:
+            for cid in cids:
+                canvas.mpl_disconnect(cid)
+            self.finish()
+
+        if self.accepted:
+            return self.width
+        return None
+
+
+def benchmark(binsizes=(4, 2), steps=40):
+    '''
+    Times width changes on a synthetic exposure at each binning the
+    inspector uses (two chips of 2048x4096 pixels binned by binsize, a
+    diagonal trail on the first one, min_mask_width as in the inspector)
+    drawn on an Agg canvas: WidthControl.set_width, against rasterizing the
+    trail and redrawing the whole trail diagnostic. Prints the mean and
+    maximum time per key press and compares it with latency_target.
+    '''
+
+    for binsize in binsizes:
+        shape = (2048 // binsize, 4096 // binsize)
+        min_mask_width = 40. / binsize
+        time_width_steps(shape, min_mask_width + 2, steps=steps,
+                         min_mask_width=min_mask_width)
+
+
+def time_width_steps(shape, width, steps=40, min_mask_width=10):
+    '''The benchmark for one binned chip shape'''
+
+    from new_diagnostics import TrailDiagnosticRenderer, make_exposure_context
+
+    rng = np.random.default_rng(0)
+    image_arr = [rng.normal(10, 3, shape) for i in range(2)]
+    mask_arr = [np.zeros(shape, dtype=bool) for i in range(2)]
+    context = make_exposure_context(image_arr, mask_arr)
+
+    endpoints = [(0, shape[0] * 0.2), (shape[1] - 1, shape[0] * 0.7)]
+    profile = rng.normal(10, 1, 200)
+    row = {'id': 1, 'status': 2}
+    profile_hdr = {'width': width, 'center': 100}
+
+    renderer = TrailDiagnosticRenderer(image_arr, context, root='benchmark',
+                                       min_mask_width=min_mask_width)
+    trail_mask = trail_footprint(shape, endpoints, width, min_mask_width=min_mask_width)
+    renderer.update([trail_mask, np.zeros(shape, dtype=bool)], row, profile, profile_hdr)
+
+    # widen, then narrow again past the starting width
+    widths = width + np.concatenate([np.arange(1, steps // 2 + 1),
+                                     np.arange(steps // 2 - 1, -steps // 2, -1)])
+
+    control = WidthControl(renderer, 0, endpoints, width, profile_hdr['center'],
+                           min_mask_width=min_mask_width)
+    control.start()
+    times = []
+    for new_width in widths:
+        t0 = time.perf_counter()
+        control.set_width(new_width)
+        times.append(time.perf_counter() - t0)
+    control.finish()
+
+    # the same steps as a full redraw (a few are enough)
+    redraw_times = []
+    for new_width in widths[:5]:
+        t0 = time.perf_counter()
+        trail_mask = trail_footprint(shape, endpoints, new_width, min_mask_width=min_mask_width)
+        profile_hdr['width'] = new_width
+        renderer.update([trail_mask, np.zeros(shape, dtype=bool)], row, profile, profile_hdr)
+        renderer.fig.canvas.draw()
+        redraw_times.append(time.perf_counter() - t0)
+
+    times = np.array(times) * 1000
+    print('{} width steps on {} chips: mean {:.1f} ms, max {:.1f} ms per key press '
+          '(target {:.0f} ms: {}); full redraw {:.1f} ms'.format(
+              len(times), shape, times.mean(), times.max(), latency_target * 1000,
+              'met' if times.max() < latency_target * 1000 else 'NOT met',
+              np.mean(redraw_times) * 1000))
+
+
+if __name__ == '__main__':
+    benchmark()